@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Batch mode: builds the maps of several settings files in one process, the sites running
+concurrently and sharing their trace store, stage worker pool, http client and ftp sessions.
+
+Usage:
+    python batch_main.py settings.json camino_settings.json
+    python batch_main.py settings.json other_runner.json --workers 8 --force
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from connections import HttpClient, FtpPool
+from scheduler import Scheduler
+from sites import detect_site, load_site_class
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def create_sites(settings_files, trace_store_folder):
+    """Create the map object of every settings file, sharing one trace store and the connections
+
+    Args:
+        settings_files (list): json settings files
+        trace_store_folder (string): folder of the trace store shared by all sites
+
+    Return:
+        (tuple): list of (settings file, site), shared http client, ftp pool and trace store
+    """
+
+    import trace_store
+
+    http = HttpClient()
+    ftp_pool = FtpPool()
+    store = trace_store.TraceStore(trace_store_folder)
+
+    sites = []
+    for settings in settings_files:
+        site = load_site_class(detect_site(settings))(settings)
+        site.http = http
+        site.ftp_pool = ftp_pool
+        site.trace_store = store
+        site.trace_store_folder = store.folder
+        # traces of the other sites must stay in the store, it is pruned once all sites are loaded
+        site.prune_trace_store = False
+        sites.append((settings, site))
+    return sites, http, ftp_pool, store
+
+
+def build_site(site, executor, force=False):
+    """Run the pipeline of a site on the shared stage executor
+
+    Return:
+        (tuple): stage statuses, build time in seconds
+    """
+
+    start = time.perf_counter()
+    scheduler = Scheduler(site.pipeline_stages(), state_file=site.pipeline_state, executor=executor)
+    status = scheduler.run(force=force)
+    return status, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build several maps in one process with shared caches and connections')
+    parser.add_argument('settings', nargs='+', help='json settings files (run or camino map, detected from their keys)')
+    parser.add_argument('--workers', type=int, default=8, help='stages running at the same time across all sites')
+    parser.add_argument('--trace-store', default='cache/batch_traces', help='folder of the trace store shared by the sites')
+    parser.add_argument('--force', action='store_true', help='run all stages, even if their inputs did not change')
+    parser.add_argument('--verbose', action='store_true', help='show debug logs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+
+    start = time.perf_counter()
+    sites, http, ftp_pool, store = create_sites(args.settings, os.path.join(CURRENT_FOLDER, args.trace_store))
+    results = {}
+
+    try:
+        # sites wait on their stages in their own threads, the stages of all sites share one pool
+        with ThreadPoolExecutor(max_workers=args.workers) as executor, \
+                ThreadPoolExecutor(max_workers=len(sites)) as site_executor:
+            futures = {settings: site_executor.submit(build_site, site, executor, args.force) for settings, site in sites}
+            for settings, future in futures.items():
+                try:
+                    results[settings] = future.result()
+                except Exception as e:
+                    logger.exception(f'Build of {settings} failed: {e}')
+                    results[settings] = ({'build': 'failed'}, 0)
+
+        # prune the traces no site uses anymore, only when every site loaded its spreadsheet
+        if all(status.get('load') in ('done', 'skipped') for status, _ in results.values()):
+            gpx_files = [gpx for _, site in sites for gpx in site.gpx_files]
+            store.update(gpx_files, prune=True)
+    finally:
+        ftp_pool.close_all()
+        http.close()
+        for _, site in sites:
+            site.close_database()
+
+    failed = []
+    for settings, site in sites:
+        site.write_profile_report()
+        status, seconds = results[settings]
+        failures = [name for name, value in status.items() if value in ('failed', 'cancelled')]
+        if failures:
+            failed.append(settings)
+            logger.warning(f"{settings}: built in {seconds:.2f}s, failed stages: {', '.join(failures)}")
+        else:
+            logger.info(f'{settings}: built in {seconds:.2f}s')
+
+    logger.info(f'{len(sites)} sites built in {time.perf_counter() - start:.2f}s, {len(store)} traces in the shared store')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the RunMap and CaminoMap pipelines.
+Generates synthetic spreadsheets and gpx files in a temporary workspace, times each stage
+and saves the results as json so that runs can be compared.
+
+Usage:
+    python benchmark.py --events 500 --points 5000
+    python benchmark.py --site camino --stamps 300 --compare benchmarks/previous.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from datetime import date, datetime, timedelta
+
+import run_map
+import camino_map
+from instrumentation import process_peak_rss_mb
+from trace_store import TraceStore
+
+CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FOLDER = os.path.join(CURRENT_FOLDER, 'benchmarks')
+
+# templates copied from the repository into the temporary workspace
+TEMPLATES = ['popup_contents.html', 'events_table_template.html', 'events_table.css', 'eventometer_template.html',
+             'pb_pr_template.html', 'camino_popup_contents.html', 'stamp_popup_contents.html', 'camino_table_template.html', 'camino_table.css',
+             'data_table.js']
+
+RUN_COLORS = {5: 'grey', 10: 'grey', 21.1: 'blue', 42.2: 'red', 50: 'green'}
+CAMINOS = ['Camino Frances', 'Camino del Norte', 'Camino Portugues']
+
+
+class LocalFTP:
+    """Local stand-in for ftplib.FTP, storing uploaded files in a folder"""
+
+    root = None
+
+    def __init__(self, address):
+        self.cwd_path = self.root
+
+    def login(self, user='', passwd='', acct=''):
+        return '230 Login successful.'
+
+    def _path(self, directory):
+        if directory.startswith('/'):
+            return os.path.join(self.root, directory.lstrip('/'))
+        return os.path.normpath(os.path.join(self.cwd_path, directory))
+
+    def cwd(self, directory):
+        path = self._path(directory)
+        if not os.path.isdir(path):
+            raise OSError(f'550 {directory}: No such directory')
+        self.cwd_path = path
+
+    def mkd(self, directory):
+        os.makedirs(self._path(directory), exist_ok=True)
+
+    def retrlines(self, cmd, callback):
+        for name in os.listdir(self.cwd_path):
+            callback(name)
+
+    def storbinary(self, cmd, file):
+        with open(os.path.join(self.cwd_path, cmd.split(' ', 1)[1]), 'wb') as f:
+            shutil.copyfileobj(file, f)
+
+    def pwd(self):
+        return '/' + os.path.relpath(self.cwd_path, self.root).lstrip('.')
+
+    def delete(self, filename):
+        os.remove(self._path(filename))
+
+    def voidcmd(self, cmd):
+        return '200 OK'
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def write_gpx(path, lat, lon, points, start_time):
+    """Write a synthetic gpx trace, a random walk of ~10 m steps with elevation and timestamps"""
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">',
+             '<trk><trkseg>']
+    heading = random.uniform(0, 2 * math.pi)
+    ele = random.uniform(0, 500)
+    for i in range(points):
+        heading += random.uniform(-0.2, 0.2)
+        lat += 0.00009 * math.cos(heading)
+        lon += 0.00009 * math.sin(heading) / max(math.cos(math.radians(lat)), 0.1)
+        ele += random.uniform(-1, 1)
+        timestamp = (start_time + timedelta(seconds=3 * i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        lines.append(f'<trkpt lat="{lat:.6f}" lon="{lon:.6f}"><ele>{ele:.1f}</ele><time>{timestamp}</time></trkpt>')
+    lines.append('</trkseg></trk></gpx>')
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def csv_line(values):
+    """Format a csv line, quoting values containing commas"""
+    return ','.join(f'"{v}"' if ',' in str(v) else str(v) for v in values)
+
+
+def event_dates(count):
+    """Unique descending dates, one event every 3 days"""
+    start = date(2025, 12, 31)
+    return [start - timedelta(days=3 * i) for i in range(count)]
+
+
+def create_run_workspace(workspace, events, points, gpx_ratio):
+    """Generate a synthetic events spreadsheet and gpx files, return the settings file path"""
+
+    gpx_folder = os.path.join(workspace, 'gpx')
+    os.makedirs(gpx_folder, exist_ok=True)
+    os.makedirs(os.path.join(workspace, 'jpg'), exist_ok=True)
+
+    rows = [csv_line(['Date', 'Race', 'Location', 'Latitude', 'Longitude', 'Type', 'Notes', 'Distance', 'D+',
+                      'Time', 'Link', 'Post', 'Color', 'Jpg', 'Gpx'])]
+    for i, day in enumerate(event_dates(events)):
+        lat, lon = random.uniform(36, 60), random.uniform(-9, 25)
+        dist = random.choice(list(RUN_COLORS))
+        color = RUN_COLORS[dist]
+        gpx = ''
+        if random.random() < gpx_ratio:
+            gpx = f'event_{i}.gpx'
+            write_gpx(os.path.join(gpx_folder, gpx), lat, lon, points, datetime(day.year, day.month, day.day, 9))
+        rows.append(csv_line([day.strftime('%d.%m.%Y'), f'Race {i}', f'City {i}', f'{lat:.5f}', f'{lon:.5f}', 'Road',
+                              'Synthetic event', dist, random.randint(0, 2000), '1:23:45',
+                              'https://example.com', 'https://example.com/post', color, '', gpx]))
+
+    with open(os.path.join(workspace, 'events.csv'), 'w') as f:
+        f.write('\n'.join(rows))
+
+    settings = {
+        'sheet_id': '', 'tab_id': '',
+        'events_csv': os.path.join(workspace, 'events.csv'),
+        'run_map_html': os.path.join(workspace, 'run_map.html'),
+        'events_table_template': os.path.join(workspace, 'events_table_template.html'),
+        'events_table_html': os.path.join(workspace, 'events_table.html'),
+        'events_table_css': os.path.join(workspace, 'events_table.css'),
+        'eventometer_template': os.path.join(workspace, 'eventometer_template.html'),
+        'eventometer_html': os.path.join(workspace, 'eventometer.html'),
+        'popup_contents_html': os.path.join(workspace, 'popup_contents.html'),
+        'pb_pr_template': os.path.join(workspace, 'pb_pr_template.html'),
+        'pb_pr_html': os.path.join(workspace, 'pb_pr.html'),
+        'jpg_web_prefix': 'https://example.com/jpg/',
+        'jpg_folder': os.path.join(workspace, 'jpg'),
+        'gpx_folder': gpx_folder,
+        'pic_default': 'default.jpg',
+        'popup_width': 520, 'popup_height': 360, 'zoom_start': 5,
+        'gpx_weight': 5, 'gpx_opacity': 0.85, 'gpx_smoothness': 5,
+        'blog_event_page': 'https://example.com',
+        'database': os.path.join(workspace, 'run_map.db'),
+        'minify_outputs': True,
+        'dist_folder': os.path.join(workspace, 'dist'),
+        'trace_store': os.path.join(workspace, 'traces'),
+        'stream_map': True,
+        'draw_repeats_once': True,
+        'year_chunks': True,
+        'heatmap': True,
+        'heatmap_cache': os.path.join(workspace, 'heatmap.npz'),
+        'sparkline_cache': os.path.join(workspace, 'sparklines.json'),
+        'tiles': True,
+        'tiles_folder': os.path.join(workspace, 'tiles'),
+        'search_index': os.path.join(workspace, 'run_map_search.json'),
+        'csv_report_folder': os.path.join(workspace, 'reports'),
+        'table_mode': 'virtual',
+        'events_table_json': os.path.join(workspace, 'events_table.json'),
+        'data_table_js': os.path.join(workspace, 'data_table.js'),
+    }
+
+    settings_path = os.path.join(workspace, 'settings.json')
+    with open(settings_path, 'w') as f:
+        json.dump(settings, f, indent=4)
+    return settings_path
+
+
+def create_camino_workspace(workspace, events, stamps, points, gpx_ratio):
+    """Generate synthetic stages and stamps spreadsheets and gpx files, return the settings file path"""
+
+    gpx_folder = os.path.join(workspace, 'gpx')
+    os.makedirs(gpx_folder, exist_ok=True)
+    os.makedirs(os.path.join(workspace, 'jpg'), exist_ok=True)
+
+    rows = [csv_line(['Date', 'Title', 'Camino', 'Start', 'Start Lat', 'Start Lon', 'End', 'End Lat', 'End Lon',
+                      'Distance', 'D+', 'Time', 'Notes', 'Color', 'Post', 'Jpg', 'Gpx'])]
+    lat, lon = 42.9, -8.5
+    for i, day in enumerate(reversed(event_dates(events))):
+        camino = CAMINOS[i * len(CAMINOS) // max(events, 1)]
+        end_lat, end_lon = lat + random.uniform(-0.1, 0.1), lon + random.uniform(0.05, 0.2)
+        gpx = ''
+        if random.random() < gpx_ratio:
+            gpx = f'stage_{i}.gpx'
+            write_gpx(os.path.join(gpx_folder, gpx), lat, lon, points, datetime(day.year, day.month, day.day, 8))
+        rows.append(csv_line([day.strftime('%d.%m.%Y'), f'Stage {i}', camino, f'Town {i}', f'{lat:.5f}', f'{lon:.5f}',
+                              f'Town {i + 1}', f'{end_lat:.5f}', f'{end_lon:.5f}',
+                              f'{random.uniform(15, 35):.1f}'.replace('.', ','), random.randint(100, 900),
+                              '6:12:00', 'Synthetic stage', 'orange', '', '', gpx]))
+        lat, lon = end_lat, end_lon
+
+    with open(os.path.join(workspace, 'camino_events.csv'), 'w') as f:
+        f.write('\n'.join(rows))
+
+    rows = [csv_line(['Date', 'Place', 'Location', 'Camino', 'Lat', 'Lon', 'Note', 'Link', 'Jpg'])]
+    for i, day in enumerate(event_dates(stamps)):
+        rows.append(csv_line([day.strftime('%d.%m.%Y'), f'Albergue {i}', f'Town {i}', random.choice(CAMINOS),
+                              f'{random.uniform(42, 43.5):.5f}', f'{random.uniform(-8.5, -1):.5f}', '', '', '']))
+
+    with open(os.path.join(workspace, 'stamps.csv'), 'w') as f:
+        f.write('\n'.join(rows))
+
+    settings = {
+        'sheet_id': '', 'tab_id': '', 'stamps_tab_id': '',
+        'events_csv': os.path.join(workspace, 'camino_events.csv'),
+        'stamps_csv': os.path.join(workspace, 'stamps.csv'),
+        'camino_map_html': os.path.join(workspace, 'camino_map.html'),
+        'ftp_dir': '/camino_map',
+        'table_template': os.path.join(workspace, 'camino_table_template.html'),
+        'table_html': os.path.join(workspace, 'camino_table.html'),
+        'table_css': os.path.join(workspace, 'camino_table.css'),
+        'popup_contents_html': os.path.join(workspace, 'camino_popup_contents.html'),
+        'stamp_popup_contents_html': os.path.join(workspace, 'stamp_popup_contents.html'),
+        'jpg_web_prefix': 'https://example.com/jpg/',
+        'jpg_folder': os.path.join(workspace, 'jpg'),
+        'gpx_folder': gpx_folder,
+        'pic_default': 'default.jpg', 'stamp_pic_default': 'camino_shell.png',
+        'popup_width': 520, 'popup_height': 400, 'stamp_popup_width': 520, 'stamp_popup_height': 350,
+        'zoom_start': 4, 'gpx_weight': 5, 'gpx_opacity': 0.85, 'gpx_smoothness': 5,
+        'blog_event_page': 'https://example.com',
+        'database': os.path.join(workspace, 'camino_map.db'),
+        'minify_outputs': True,
+        'dist_folder': os.path.join(workspace, 'dist'),
+        'trace_store': os.path.join(workspace, 'traces'),
+        'stream_map': True,
+        'draw_repeats_once': True,
+        'year_chunks': True,
+        'heatmap': True,
+        'heatmap_cache': os.path.join(workspace, 'heatmap.npz'),
+        'sparkline_cache': os.path.join(workspace, 'sparklines.json'),
+        'tiles': True,
+        'tiles_folder': os.path.join(workspace, 'tiles'),
+        'search_index': os.path.join(workspace, 'camino_map_search.json'),
+        'csv_report_folder': os.path.join(workspace, 'reports'),
+        'table_mode': 'virtual',
+        'table_json': os.path.join(workspace, 'camino_table.json'),
+        'data_table_js': os.path.join(workspace, 'data_table.js'),
+        'stitch_routes': True,
+    }
+
+    settings_path = os.path.join(workspace, 'camino_settings.json')
+    with open(settings_path, 'w') as f:
+        json.dump(settings, f, indent=4)
+    return settings_path
+
+
+def output_size(paths):
+    """Total size in bytes of the existing files and folders"""
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for folder, _, files in os.walk(path):
+                size += sum(os.path.getsize(os.path.join(folder, f)) for f in files)
+    return size
+
+
+def time_stages(stages):
+    """Run stages in sequence and measure them
+
+    Args:
+        stages (list): list of tuples (stage name, callable, list of output paths)
+
+    Return:
+        (list): one result dict per stage
+    """
+
+    results = []
+    for name, func, outputs in stages:
+        rss_start = process_peak_rss_mb()
+        start = time.perf_counter()
+        func()
+        wall = time.perf_counter() - start
+        # the process peak is cumulative, its growth is the memory the stage needed beyond the previous stages
+        peak = process_peak_rss_mb()
+        results.append({'stage': name, 'wall_s': round(wall, 4), 'rss_growth_mb': round(peak - rss_start, 1),
+                        'process_peak_rss_mb': round(peak, 1), 'output_bytes': output_size(outputs)})
+    return results
+
+
+def parse_gpx(site, gpx_files, folder):
+    """Get the map points of the gpx files through a new trace store, so that every file is parsed
+
+    update_trace_store has already stored the traces in the store of the site, where process_gpx_to_df
+    would only look them up.
+
+    Args:
+        site (RunMap or CaminoMap): site whose process_gpx_to_df is timed
+        gpx_files (list): gpx file paths
+        folder (string): folder of the new trace store, must not exist
+    """
+
+    store = site.trace_store
+    site.trace_store = TraceStore(folder)
+    try:
+        return [site.process_gpx_to_df(f) for f in gpx_files]
+    finally:
+        site.trace_store = store
+
+
+def benchmark_run_map(workspace, args):
+    """Benchmark the RunMap pipeline"""
+
+    settings = create_run_workspace(workspace, args.events, args.points, args.gpx_ratio)
+    rm = run_map.RunMap(settings)
+    gpx_files = [os.path.join(rm.gpx_folder, f) for f in os.listdir(rm.gpx_folder)]
+
+    stages = [
+        ('load_csv_file', lambda: rm.load_csv_file(download=False), []),
+        ('update_database', rm.update_database, [rm.database_path]),
+        ('update_trace_store', rm.update_trace_store, [rm.trace_store_folder]),
+        ('update_trace_metrics', rm.update_trace_metrics, [rm.database_path]),
+        ('process_gpx', lambda: parse_gpx(rm, gpx_files, os.path.join(workspace, 'parse_store')), []),
+        ('update_sparklines', rm.update_sparklines, [rm.sparkline_cache]),
+        ('update_overlaps', rm.update_overlaps, [rm.database_path]),
+        ('generate_map', rm.generate_map, []),
+        ('generate_events_table', rm.generate_events_table, [rm.events_table_html]),
+        ('generate_eventometer', rm.generate_eventometer, [rm.eventometer_html]),
+        ('generate_search_index', rm.generate_search_index, [rm.search_index_json]),
+        ('update_records', rm.update_records, [rm.database_path]),
+        ('generate_records_table', rm.generate_records_table, [rm.pb_pr_html]),
+        ('save_map', rm.save_map, [rm.run_map_html]),
+        ('post_process_outputs', rm.post_process_outputs, [rm.dist_folder]),
+        ('upload_to_ftp', lambda: rm.upload_to_ftp(force=True), [LocalFTP.root]),
+    ]
+    return time_stages(stages)
+
+
+def benchmark_camino_map(workspace, args):
+    """Benchmark the CaminoMap pipeline"""
+
+    settings = create_camino_workspace(workspace, args.events, args.stamps, args.points, args.gpx_ratio)
+    cm = camino_map.CaminoMap(settings)
+    gpx_files = [os.path.join(cm.gpx_folder, f) for f in os.listdir(cm.gpx_folder)]
+
+    stages = [
+        ('load_csv_file', lambda: cm.load_csv_file(download=False), []),
+        ('load_stamps_csv', lambda: cm.load_stamps_csv(download=False), []),
+        ('update_database', cm.update_database, [cm.database_path]),
+        ('update_trace_store', cm.update_trace_store, [cm.trace_store_folder]),
+        ('update_trace_metrics', cm.update_trace_metrics, [cm.database_path]),
+        ('process_gpx', lambda: parse_gpx(cm, gpx_files, os.path.join(workspace, 'parse_store')), []),
+        ('update_sparklines', cm.update_sparklines, [cm.sparkline_cache]),
+        ('update_overlaps', cm.update_overlaps, [cm.database_path]),
+        ('update_stamp_stages', cm.update_stamp_stages, [cm.database_path]),
+        ('generate_map', cm.generate_map, []),
+        ('generate_table', cm.generate_table, [cm.table_html]),
+        ('generate_search_index', cm.generate_search_index, [cm.search_index_json]),
+        ('save_map', cm.save_map, [cm.camino_map_html]),
+        ('post_process_outputs', cm.post_process_outputs, [cm.dist_folder]),
+        ('upload_to_ftp', lambda: cm.upload_to_ftp(force=True), [LocalFTP.root]),
+    ]
+    return time_stages(stages)
+
+
+def compare_results(current, previous_path):
+    """Print the wall time difference per stage with a previous benchmark file"""
+
+    with open(previous_path, 'r') as f:
+        previous = json.load(f)
+
+    print('\n' + ' COMPARISON '.center(100, '#'))
+    print(f"Previous run: {previous_path} ({previous['date']})")
+    previous_stages = {(r['site'], r['stage']): r for r in previous['results']}
+
+    for result in current['results']:
+        old = previous_stages.get((result['site'], result['stage']))
+        if not old:
+            continue
+        delta = (result['wall_s'] - old['wall_s']) / old['wall_s'] * 100 if old['wall_s'] else 0
+        print(f"{result['site']:<8}{result['stage']:<25}{old['wall_s']:>10.3f}s {result['wall_s']:>10.3f}s {delta:>+8.1f}%")
+
+
+def benchmark_subprocess(site, args, results_path):
+    """Benchmark one site in a new python process, so that its memory is not mixed with the other site
+
+    Return:
+        (list): one result dict per stage, see time_stages
+    """
+
+    command = [sys.executable, os.path.abspath(__file__), '--site', site, '--events', str(args.events),
+               '--stamps', str(args.stamps), '--points', str(args.points), '--gpx-ratio', str(args.gpx_ratio),
+               '--seed', str(args.seed), '--results', results_path]
+    if args.keep:
+        command.append('--keep')
+    if args.verbose:
+        command.append('--verbose')
+    subprocess.run(command, check=True)
+
+    with open(results_path, 'r') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the run map and camino map pipelines on synthetic data')
+    parser.add_argument('--site', choices=['run', 'camino', 'both'], default='both', help='pipeline to benchmark')
+    parser.add_argument('--events', type=int, default=200, help='number of events or stages')
+    parser.add_argument('--stamps', type=int, default=100, help='number of camino stamps')
+    parser.add_argument('--points', type=int, default=2000, help='number of points per gpx file')
+    parser.add_argument('--gpx-ratio', type=float, default=1.0, help='share of events having a gpx file')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic data')
+    parser.add_argument('--output', help='results json file (default: benchmarks/<date>.json)')
+    parser.add_argument('--compare', help='previous results json file to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary workspace')
+    parser.add_argument('--verbose', action='store_true', help='show the pipeline logs')
+    # results file of a single site benchmarked in a subprocess, see benchmark_subprocess
+    parser.add_argument('--results', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # both sites: one process per site, the peak RSS of a process never goes down
+    if args.site == 'both':
+        results_folder = tempfile.mkdtemp(prefix='run_map_bench_results_')
+        try:
+            results = [dict(site=site, **r) for site in ('run', 'camino')
+                       for r in benchmark_subprocess(site, args, os.path.join(results_folder, f'{site}.json'))]
+        finally:
+            shutil.rmtree(results_folder, ignore_errors=True)
+        report_results(results, args)
+        return
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+
+    random.seed(args.seed)
+    workspace = tempfile.mkdtemp(prefix='run_map_bench_')
+
+    # route uploads to a local folder instead of a real ftp server
+    LocalFTP.root = os.path.join(workspace, 'ftp')
+    os.makedirs(os.path.join(LocalFTP.root, 'camino_map'), exist_ok=True)
+    for folder in ('jpg', 'gpx'):
+        os.makedirs(os.path.join(LocalFTP.root, folder), exist_ok=True)
+    run_map.FTP = camino_map.FTP = LocalFTP
+    os.environ.update({'FTP_ADDRESS': 'localhost', 'FTP_USER': 'bench', 'FTP_PWD': 'bench', 'FTP_START_DIR': '/'})
+
+    results = []
+    try:
+        if args.site in ('run', 'both'):
+            site_workspace = os.path.join(workspace, 'run')
+            shutil.copytree(os.path.join(CURRENT_FOLDER, 'html'), site_workspace, ignore=lambda d, f: [n for n in f if n not in TEMPLATES])
+            results += [dict(site='run', **r) for r in benchmark_run_map(site_workspace, args)]
+        if args.site in ('camino', 'both'):
+            site_workspace = os.path.join(workspace, 'camino')
+            shutil.copytree(os.path.join(CURRENT_FOLDER, 'html'), site_workspace, ignore=lambda d, f: [n for n in f if n not in TEMPLATES])
+            results += [dict(site='camino', **r) for r in benchmark_camino_map(site_workspace, args)]
+    finally:
+        if args.keep:
+            print(f'Workspace kept at location {workspace}')
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump([{k: v for k, v in r.items() if k != 'site'} for r in results], f)
+        return
+    report_results(results, args)
+
+
+def report_results(results, args):
+    """Print the results, save them and compare them with a previous run
+
+    Args:
+        results (list): one result dict per site and stage
+        args (argparse.Namespace): benchmark arguments
+    """
+
+    report = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'keep', 'verbose', 'results')},
+        'results': results,
+    }
+
+    print('\n' + ' BENCHMARK RESULTS '.center(100, '#'))
+    print(f"{'site':<8}{'stage':<25}{'wall':>11} {'rss growth':>12} {'process rss':>13} {'output':>14}")
+    for r in results:
+        print(f"{r['site']:<8}{r['stage']:<25}{r['wall_s']:>10.3f}s {r['rss_growth_mb']:>+9.1f} MB {r['process_peak_rss_mb']:>10.1f} MB "
+              f"{r['output_bytes']:>12} B")
+
+    output = args.output or os.path.join(RESULTS_FOLDER, datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f'Benchmark results saved at location {output}')
+
+    if args.compare:
+        compare_results(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
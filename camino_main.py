@@ -1,18 +1,18 @@
+import logging
 from camino_map import CaminoMap
+from scheduler import Scheduler
 
 if __name__ == '__main__':
 
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # stages run concurrently when independent and are skipped when their inputs did not change
     camino_map = CaminoMap()
-    camino_map.load_csv_file()
-    camino_map.load_stamps_csv()
-    camino_map.update_database()
-    camino_map.generate_map()
-    camino_map.generate_table()
-    camino_map.save_map()
-    ftp_success = camino_map.upload_to_ftp(html=True, jpg=True, gpx=True, force=False)
+    scheduler = Scheduler(camino_map.pipeline_stages(), state_file=camino_map.pipeline_state)
+    status = scheduler.run(force=False)
+    camino_map.write_profile_report()
 
-    if ftp_success:
+    if 'failed' not in status.values():
         camino_map.open_blog_page()
     else:
-        print("Skipping blog page opening due to FTP upload failure.")
-
+        print("Skipping blog page opening due to failed stages: " + ', '.join(k for k, v in status.items() if v == 'failed'))
@@ -1,19 +1,27 @@
 import os
 import json
+import logging
 import sqlite3
-import folium
-import calendar
-import gpxpy
-import pandas as pd
 import webbrowser
+import minify
+import spatial_index
+from instrumentation import Profiler, stage
+from scheduler import Stage
 from statistics import mean
 from ftplib import FTP
 from dotenv import load_dotenv
 from collections import OrderedDict
+from html import escape
 load_dotenv()
 
+# folium, numpy and pandas are imported in the methods using them, so that commands only
+# querying the database or uploading files start without their import cost
+
+logger = logging.getLogger(__name__)
+
 CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
 DATABASE_PATH = os.path.join(CURRENT_FOLDER, "camino_map.db")
+SPATIAL_INDEX_TABLE = "camino_map_rtree"
 
 
 class CaminoMap:
@@ -25,6 +33,8 @@ class CaminoMap:
             settings (string): path to json file containing all map settings
         """
 
+        self.settings_path = os.path.abspath(settings)
+
         with open(settings, 'r') as jf:
             spreadsheet_json = json.loads(jf.read())
 
@@ -54,18 +64,75 @@ class CaminoMap:
             self.gpx_smoothness = spreadsheet_json['gpx_smoothness']
             self.blog_event_page = spreadsheet_json['blog_event_page']
             self.ftp_dir = spreadsheet_json['ftp_dir']
+            self.database_path = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('database', DATABASE_PATH))
+            self.pipeline_state = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('pipeline_state', 'reports/camino_map_state.json'))
+            self.profile_report = spreadsheet_json.get('profile_report', '')
+            self.profile_memory = spreadsheet_json.get('profile_memory', False)
+            self.minify_outputs = spreadsheet_json.get('minify_outputs', False)
+            self.dist_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('dist_folder', 'dist/camino_map'))
+            self.trace_store_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('trace_store', 'cache/camino_map_traces'))
+            self.heatmap = spreadsheet_json.get('heatmap', False)
+            self.stream_map = spreadsheet_json.get('stream_map', False)
+            self.draw_repeats_once = spreadsheet_json.get('draw_repeats_once', False)
+            self.year_chunks = spreadsheet_json.get('year_chunks', False)
+            self.year_chunks_recent = spreadsheet_json.get('year_chunks_recent', 2)
+            self.stamp_max_distance = spreadsheet_json.get('stamp_max_distance', 1000)
+            self.heatmap_cache = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('heatmap_cache', 'cache/camino_map_heatmap.npz'))
+            self.sparkline_cache = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('sparkline_cache', 'cache/camino_map_sparklines.json'))
+            self.tiles = spreadsheet_json.get('tiles', False)
+            self.tiles_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('tiles_folder', 'html/tiles/camino_map'))
+            self.tile_max_zoom = spreadsheet_json.get('tile_max_zoom', 10)
+            self.search_index_json = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('search_index', 'html/camino_map_search.json'))
+            self.csv_report_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('csv_report_folder', 'reports'))
+            self.export_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('export_folder', 'export/camino_map'))
+            self.export_formats = spreadsheet_json.get('export_formats', [])
+            self.export_tolerance = spreadsheet_json.get('export_tolerance', 5)
+            self.table_mode = spreadsheet_json.get('table_mode', 'static')
+            self.table_json = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('table_json', 'html/camino_table.json'))
+            self.data_table_js = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('data_table_js', 'html/data_table.js'))
+            self.stitch_routes = spreadsheet_json.get('stitch_routes', False)
+
+            logger.info('Json settings loaded successfully')
+
+        # instrumentation of the pipeline stages
+        self.profiler = Profiler('camino_map', trace_memory=self.profile_memory)
+
+        # packed gpx traces, heatmap grid, tile renderer and database connection, opened on first use and kept for the lifetime of the object
+        self.trace_store = None
+        self.heatmap_grid = None
+        self.sparklines = None
+        self.tile_renderer = None
+        self.db_connection = None
+        # results of the stages read by generate_map, which computes them only when their stage did not run
+        self.trace_store_updated = False
+        self.courses = None
+        self.stage_stamps = None
+        # writer of the map being built when streaming it to its html file
+        self.map_writer = None
+        # year layers of the map being built, the older years written to javascript chunks
+        self.year_layers = None
+
+        # connections shared between sites by batch_main.py, curl and a new ftp session per upload when None
+        self.http = None
+        self.ftp_pool = None
+        # stored traces of gpx files not in the spreadsheet are removed, unless the store is shared
+        self.prune_trace_store = True
+
+        self.load_templates()
+        self.reset_counters()
+
+    def load_templates(self):
+        """Load html popup contents for stages and stamps"""
 
-            print('Json settings loaded successfully')
-
-        # load html popup contents
         with open(self.popup_contents_html) as f:
             self.html_popup = f.read()
 
-        # load stamp popup contents
         with open(self.stamp_popup_contents_html) as f:
             self.stamp_html_popup = f.read()
 
-        # define counters for stats
+    def reset_counters(self):
+        """Define counters for stats"""
+
         self.dist_count = 0
         self.dplus_count = 0
         self.stages_count = 0
@@ -76,33 +143,50 @@ class CaminoMap:
 
         os.makedirs(os.path.dirname(self.events_csv), exist_ok=True)
 
-        command = f'curl -L "https://docs.google.com/spreadsheets/d/{self.sheet_id}/export?exportFormat=csv" -o {self.events_csv}'
-        os.system(command)
+        url = f'https://docs.google.com/spreadsheets/d/{self.sheet_id}/export?exportFormat=csv'
+        if self.http:
+            self.http.download(url, self.events_csv)
+        else:
+            os.system(f'curl -L "{url}" -o {self.events_csv}')
 
         if not os.path.isfile(self.events_csv):
-            print(f'Error downloading the spreadsheet at location {self.events_csv}')
+            logger.warning(f'Error downloading the spreadsheet at location {self.events_csv}')
 
     def download_stamps_as_csv(self):
         """Download stamps spreadsheet as csv file"""
 
         os.makedirs(os.path.dirname(self.stamps_csv), exist_ok=True)
 
-        command = f'curl -L "https://docs.google.com/spreadsheets/d/{self.sheet_id}/export?exportFormat=csv&gid={self.stamps_tab_id}" -o {self.stamps_csv}'
-        os.system(command)
+        url = f'https://docs.google.com/spreadsheets/d/{self.sheet_id}/export?exportFormat=csv&gid={self.stamps_tab_id}'
+        if self.http:
+            self.http.download(url, self.stamps_csv)
+        else:
+            os.system(f'curl -L "{url}" -o {self.stamps_csv}')
 
         if not os.path.isfile(self.stamps_csv):
-            print(f'Error downloading the stamps spreadsheet at location {self.stamps_csv}')
+            logger.warning(f'Error downloading the stamps spreadsheet at location {self.stamps_csv}')
+
+    @stage()
+    def load_csv_file(self, download=True):
+        """Extracts and formats data from the csv file
+
+        Args:
+            download (bool): download the spreadsheet first, otherwise read the local csv file
+        """
 
-    def load_csv_file(self):
-        """Extracts and formats data from the csv file"""
+        import csv_schema
 
-        print('\n' + ' DOWNLOAD AND READ SPREADSHEET '.center(100, '#'))
+        logger.info('\n' + ' DOWNLOAD AND READ SPREADSHEET '.center(100, '#'))
 
         # download and update csv file
-        self.download_spreadsheet_as_csv()
+        if download:
+            self.download_spreadsheet_as_csv()
 
-        # extract camino infos into a panda dataframe
-        data = pd.read_csv(self.events_csv).fillna('')
+        # typed camino infos, rows with a missing or invalid date, title or start position are skipped and reported
+        data, report = csv_schema.read_csv(self.events_csv, csv_schema.CAMINO_STAGES)
+        report.log()
+        report.write(csv_schema.report_path(self.csv_report_folder, self.events_csv))
+        self.profiler.count('csv_rows_skipped', len(report.dropped_lines))
 
         # store information into lists
         self.date_list = list(data['Date'])
@@ -114,34 +198,19 @@ class CaminoMap:
         self.end_list = list(data['End'])
         self.end_lat_list = list(data['End Lat'])
         self.end_lon_list = list(data['End Lon'])
-        self.dist_list = list(data['Distance'])
+        self.distF_list = list(data['Distance'])
         self.dplus_list = list(data['D+'])
         self.time_list = list(data['Time'])
         self.notes_list = list(data['Notes'])
         self.color_list = list(data['Color'])
         self.post_list = list(data['Post'])
 
-        # format date as 'Day FullMonthName Year'
-        self.dateF_list = []
-        for date in self.date_list:
-            date = [int(d) for d in date.split('.')]
-            date = f'{date[0]} {calendar.month_name[date[1]]} {date[2]}'
-            self.dateF_list.append(date)
-
-        # format time entries as 'Xh Ymin Zsec'
-        self.timeF_list = []
-        for time in self.time_list:
-            if len(time.split(':')) == 3:
-                time = time.split(':')
-                time = f'{time[0]}h {time[1]}min {time[2]}sec'
-            self.timeF_list.append(time)
-
-        # get distance list as floats (handle comma as decimal separator)
-        self.distF_list = []
-        for dist in self.dist_list:
-            if isinstance(dist, str):
-                dist = dist.replace(',', '.')
-            self.distF_list.append(float(dist) if dist else 0.0)
+        # distances parsed by the schema (comma or dot decimal separator), shown with a decimal comma
+        self.dist_list = [f'{dist:g}'.replace('.', ',') for dist in self.distF_list]
+
+        # format date as 'Day FullMonthName Year' and time entries as 'Xh Ymin Zsec'
+        self.dateF_list = csv_schema.format_dates(self.date_list)
+        self.timeF_list = csv_schema.format_times(self.time_list)
 
         # list of jpg web links
         self.jpg_links = []
@@ -156,17 +225,29 @@ class CaminoMap:
         for gpx_file in data['Gpx']:
             path = os.path.join(self.gpx_folder, gpx_file) if gpx_file else ''
             self.gpx_files.append(path)
+        self.forget_stage_results()
+
+    @stage()
+    def load_stamps_csv(self, download=True):
+        """Extracts and formats data from the stamps csv file
+
+        Args:
+            download (bool): download the spreadsheet first, otherwise read the local csv file
+        """
 
-    def load_stamps_csv(self):
-        """Extracts and formats data from the stamps csv file"""
+        import csv_schema
 
-        print('\n' + ' DOWNLOAD AND READ STAMPS SPREADSHEET '.center(100, '#'))
+        logger.info('\n' + ' DOWNLOAD AND READ STAMPS SPREADSHEET '.center(100, '#'))
 
         # download and update stamps csv file
-        self.download_stamps_as_csv()
+        if download:
+            self.download_stamps_as_csv()
 
-        # extract stamps infos into a panda dataframe
-        data = pd.read_csv(self.stamps_csv).fillna('')
+        # typed stamps infos, rows with a missing or invalid date, place or position are skipped and reported
+        data, report = csv_schema.read_csv(self.stamps_csv, csv_schema.CAMINO_STAMPS)
+        report.log()
+        report.write(csv_schema.report_path(self.csv_report_folder, self.stamps_csv))
+        self.profiler.count('csv_rows_skipped', len(report.dropped_lines))
 
         # store information into lists
         self.stamp_date_list = list(data['Date'])
@@ -179,11 +260,7 @@ class CaminoMap:
         self.stamp_link_list = list(data['Link'])
 
         # format date as 'Day FullMonthName Year'
-        self.stamp_dateF_list = []
-        for date in self.stamp_date_list:
-            date = [int(d) for d in date.split('.')]
-            date = f'{date[0]} {calendar.month_name[date[1]]} {date[2]}'
-            self.stamp_dateF_list.append(date)
+        self.stamp_dateF_list = csv_schema.format_dates(self.stamp_date_list)
 
         # list of jpg web links for stamps
         self.stamp_jpg_links = []
@@ -192,13 +269,29 @@ class CaminoMap:
                 self.stamp_jpg_links.append(f'{self.jpg_web_prefix}{jpg}')
             else:
                 self.stamp_jpg_links.append(f'{self.jpg_web_prefix}{self.stamp_pic_default}')
+        self.stage_stamps = None
+
+    def connect_database(self):
+        """Open the database connection, or reuse the one already opened by this object"""
 
+        if self.db_connection is None:
+            self.db_connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        return self.db_connection
+
+    def close_database(self):
+        """Close the database connection"""
+
+        if self.db_connection is not None:
+            self.db_connection.close()
+            self.db_connection = None
+
+    @stage()
     def update_database(self, rebuild=False):
         """Update database with new data"""
 
-        print('\n' + ' UPDATE DATABASE '.center(100, '#'))
+        logger.info('\n' + ' UPDATE DATABASE '.center(100, '#'))
 
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = self.connect_database()
         cursor = conn.cursor()
 
         # drop table to rebuild a brand new one
@@ -236,7 +329,8 @@ class CaminoMap:
             if date not in self.date_list:
                 # entry has been deleted from csv file, remove it from db too
                 cursor.execute("DELETE FROM camino_map WHERE date=?", (date,))
-                print(f"Deleting from database entry with date {date}: Not in CSV file.")
+                self.profiler.count('db_deleted')
+                logger.debug(f"Deleting from database entry with date {date}: Not in CSV file.")
 
         # iterate through database, add or update entries
         data_iter = zip(self.date_list, self.title_list, self.camino_list, self.start_list,
@@ -266,7 +360,8 @@ class CaminoMap:
                                    WHERE date=?
                                    """, (title, camino, start, start_lt, start_ln, end, end_lt, end_ln, dist, dplus, time, notes, post, jpg, gpx, date))
 
-                    print(f"Updating to database entry with date {date}: different values in CSV file.")
+                    self.profiler.count('db_updated')
+                    logger.debug(f"Updating to database entry with date {date}: different values in CSV file.")
 
             # new entry -> add it
             else:
@@ -274,20 +369,20 @@ class CaminoMap:
                                (date, title, camino, start, start_lt, start_ln, end, end_lt, end_ln, dist, dplus, time, notes, post, jpg, gpx) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
                                """, (date, title, camino, start, start_lt, start_ln, end, end_lt, end_ln, dist, dplus, time, notes, post, jpg, gpx))
 
-                print(f"Adding to database entry with date {date}: New entry.")
+                self.profiler.count('db_added')
+                logger.debug(f"Adding to database entry with date {date}: New entry.")
 
         # commit and close
         conn.commit()
         cursor.close()
-        conn.close()
 
-        print("Database updated successfully.")
+        logger.info("Database updated successfully.")
         self.check_database()
 
     def check_database(self):
         """Check the database properties"""
 
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = self.connect_database()
         cursor = conn.cursor()
 
         # database rows
@@ -298,17 +393,16 @@ class CaminoMap:
         cursor.execute("PRAGMA table_info(camino_map)")
         columns = cursor.fetchall()
 
-        print(f"Path: {DATABASE_PATH}")
-        print(f"Rows: {rows}")
-        print(f"Columns: {len(columns)}")
+        logger.info(f"Path: {self.database_path}")
+        logger.info(f"Rows: {rows}")
+        logger.info(f"Columns: {len(columns)}")
 
         cursor.close()
-        conn.close()
 
     def search_database(self, sql_query):
         """Search the database"""
 
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = self.connect_database()
         cursor = conn.cursor()
 
         # print sql query results
@@ -323,12 +417,190 @@ class CaminoMap:
             print('SQL request returned no result.')
 
         cursor.close()
-        conn.close()
 
+    @stage()
+    def update_spatial_index(self):
+        """Index the stage start locations, the stamps and the gpx trace bounding boxes in a database R*Tree"""
+
+        logger.info('\n' + ' UPDATE SPATIAL INDEX '.center(100, '#'))
+
+        store = self.current_trace_store()
+        features = []
+        for date, title, lt, ln, gpx in zip(self.date_list, self.title_list, self.start_lat_list, self.start_lon_list, self.gpx_files):
+            if lt != '' and ln != '':
+                features.append(('stage', date, title, (lt, ln, lt, ln)))
+            if gpx and store.bbox(gpx):
+                features.append(('trace', date, title, store.bbox(gpx)))
+
+        for date, place, lt, ln in zip(self.stamp_date_list, self.stamp_place_list, self.stamp_lat_list, self.stamp_lon_list):
+            if lt != '' and ln != '':
+                features.append(('stamp', date, place, (lt, ln, lt, ln)))
+
+        count = spatial_index.rebuild_index(self.connect_database(), SPATIAL_INDEX_TABLE, features)
+        self.profiler.count('indexed_features', count)
+        logger.info(f'Spatial index updated: {count} features')
+
+    def features_within(self, lat, lon, radius_km, kinds=None):
+        """Indexed features within a distance of a point, sorted by distance
+
+        Args:
+            lat (float): latitude of the point
+            lon (float): longitude of the point
+            radius_km (float): search radius in km
+            kinds (list): restrict the results to these feature kinds (stage, stamp, trace)
+
+        Return:
+            (list): dicts with kind, date, label, bbox and distance_km
+        """
+        return spatial_index.query_radius(self.connect_database(), SPATIAL_INDEX_TABLE, lat, lon, radius_km, kinds)
+
+    def features_in_bbox(self, min_lat, min_lon, max_lat, max_lon, kinds=None):
+        """Indexed features intersecting a bounding box (cli.py query --bbox)
+
+        Args:
+            kinds (list): restrict the results to these feature kinds (stage, stamp, trace)
+
+        Return:
+            (list): dicts with kind, date, label and bbox
+        """
+        return spatial_index.query_bbox(self.connect_database(), SPATIAL_INDEX_TABLE, min_lat, min_lon, max_lat, max_lon, kinds)
+
+    @stage()
+    def update_trace_metrics(self):
+        """Compute distance, D+, moving time and km splits from the full resolution gpx files
+
+        Results are stored in the trace_metrics table next to the spreadsheet values, traces whose
+        metrics differ from the spreadsheet are flagged and logged.
+        """
+
+        import trace_metrics
+
+        logger.info('\n' + ' UPDATE TRACE METRICS '.center(100, '#'))
+
+        store = self.current_trace_store()
+        entries = zip(self.date_list, self.gpx_files, self.distF_list, self.dplus_list)
+        mismatches = trace_metrics.update_metrics(self.connect_database(), entries, store, profiler=self.profiler)
+
+        for date, gpx, mismatch in mismatches:
+            logger.warning(f'Trace metrics of {date} ({os.path.basename(gpx)}) differ from the spreadsheet: {mismatch}')
+        self.profiler.count('metrics_mismatches', len(mismatches))
+        logger.info(f'Trace metrics updated: {len(mismatches)} mismatches')
+
+    @stage()
+    def update_overlaps(self):
+        """Find the repeated courses and the paths shared by the gpx traces, stored in the trace_overlap table
+
+        Return:
+            (dict): gpx path -> gpx path of the newest stage of its course
+        """
+
+        import overlap
+
+        logger.info('\n' + ' UPDATE TRACE OVERLAPS '.center(100, '#'))
+
+        store = self.current_trace_store()
+        courses = overlap.update_overlaps(self.connect_database(), zip(self.date_list, self.gpx_files), store, profiler=self.profiler)
+
+        repeats = sum(gpx != course for gpx, course in courses.items())
+        self.profiler.count('repeated_courses', repeats)
+        logger.info(f'Trace overlaps updated: {len(courses)} traces, {repeats} repeats of {len(set(courses.values()))} courses')
+        self.courses = courses
+        return courses
+
+    @stage()
+    def update_stamp_stages(self):
+        """Assign every stamp to its nearest stage trace and km marker, stored in the stamp_stages table
+
+        Stamps far from all traces, or whose camino or date differ from their stage, are flagged and logged.
+
+        Return:
+            (dict): stage date -> stamps of the stage, see stamp_join.update_stamp_stages
+        """
+
+        import stamp_join
+
+        logger.info('\n' + ' UPDATE STAMP STAGES '.center(100, '#'))
+
+        store = self.current_trace_store()
+        stages = [dict(date=date, title=title, camino=camino, gpx=gpx, start=(start_lt, start_ln), end=(end_lt, end_ln), dist=dist)
+                  for date, title, camino, gpx, start_lt, start_ln, end_lt, end_ln, dist
+                  in zip(self.date_list, self.title_list, self.camino_list, self.gpx_files, self.start_lat_list,
+                         self.start_lon_list, self.end_lat_list, self.end_lon_list, self.distF_list)]
+        stamps = [dict(date=date, place=place, camino=camino, lat=lat, lon=lon)
+                  for date, place, camino, lat, lon
+                  in zip(self.stamp_date_list, self.stamp_place_list, self.stamp_camino_list, self.stamp_lat_list, self.stamp_lon_list)]
+        results = stamp_join.update_stamp_stages(self.connect_database(), stages, stamps, store,
+                                                 max_distance=self.stamp_max_distance, profiler=self.profiler)
+
+        stage_stamps = {}
+        flagged = 0
+        for result in results:
+            stamp, stage = result['stamp'], result['stage']
+            if result['flags']:
+                flagged += 1
+                nearest = f"nearest stage {stage['date']} {stage['title']} at {result['distance']} m" if stage else 'no stage'
+                logger.warning(f"Stamp {stamp['date']} {stamp['place']} flagged ({', '.join(result['flags'])}): {nearest}")
+            if stage:
+                stage_stamps.setdefault(stage['date'], []).append(result)
+
+        self.profiler.count('flagged_stamps', flagged)
+        logger.info(f'Stamp stages updated: {len(results)} stamps on {len(stage_stamps)} stages, {flagged} flagged')
+        self.stage_stamps = stage_stamps
+        return stage_stamps
+
+    @staticmethod
+    def stamps_html(stamps):
+        """Stamps line of a stage popup ({stamps} field): place and km marker of the stamps, flagged stamps marked
+
+        Args:
+            stamps (list): stamps of the stage, see update_stamp_stages
+        """
+
+        if not stamps:
+            return ''
+
+        items = []
+        for result in sorted(stamps, key=lambda r: r['km']):
+            km = f"{result['km']:.1f}".replace('.', ',')
+            flags = f" ⚠ {', '.join(result['flags'])}" if result['flags'] else ''
+            items.append(f"{escape(result['stamp']['place'])} (km {km}{flags})")
+        return f"<b>Stamps:</b> {', '.join(items)}<br/>"
+
+    def database_stats(self):
+        """Compute the camino statistics from the database
+
+        Return:
+            (dict): number of stages and caminos, total distance and D+
+        """
+
+        conn = self.connect_database()
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT COUNT(*), COUNT(DISTINCT camino), TOTAL(dist), TOTAL(dplus) FROM camino_map")
+        stages, caminos, dist, dplus = cursor.fetchone()
+        cursor.close()
+
+        return {'stages': stages, 'caminos': caminos, 'distance_km': round(dist, 1), 'dplus_m': int(dplus)}
+
+    @stage()
     def generate_map(self):
         """Generates the map as a html file"""
 
-        print('\n' + ' GENERATING HTML MAP '.center(100, '#'))
+        import folium
+        import folium_elements
+        import map_writer
+        import year_layers
+        import overlap
+
+        logger.info('\n' + ' GENERATING HTML MAP '.center(100, '#'))
+
+        # results of the stages run before the map by the pipeline, computed here when missing (watch and cli builds)
+        self.current_trace_store()
+        sparklines = self.sparklines if self.sparklines is not None else self.update_sparklines()
+        stage_stamps = self.stage_stamps if self.stage_stamps is not None else self.update_stamp_stages()
+
+        # counters are computed while adding the stages and stamps
+        self.reset_counters()
 
         # center map based on all location coordinates (start, end points and stamps)
         all_lats = self.start_lat_list + self.end_lat_list + self.stamp_lat_list
@@ -342,6 +614,13 @@ class CaminoMap:
 
         # create map object
         self.camino_map = folium.Map(location=[start_lat, start_lon], tiles=None, zoom_start=self.zoom_start)
+        self.vector_layers = {}
+        self.marker_layers = {}
+        # traces written to the html file as they are added instead of being kept until save_map
+        self.map_writer = map_writer.MapWriter(self.camino_map) if self.stream_map else None
+        # markers and traces of every year in a layer of their feature group, older years loaded on demand
+        self.year_layers = year_layers.YearLayers(self.camino_map, self.camino_map_html, map(year_layers.event_year, self.date_list + self.stamp_date_list),
+                                                  self.year_chunks_recent) if self.year_chunks else None
 
         # Add custom CSS to remove focus outline on paths
         custom_css = """
@@ -386,15 +665,35 @@ class CaminoMap:
             color = camino_colors[camino]
             feature_groups[camino] = folium.FeatureGroup(name=legend_txt.format(txt=camino, col=color)).add_to(self.camino_map)
 
+        # stages of each camino (and year) stitched into a single route per stage color:
+        # (layer name, color) -> (layer, color, stages), stages being tuples (date, points, popup html, tooltip)
+        route_stages = OrderedDict()
+        # traces also drawn as raster tiles at low zooms, with the color they are drawn with
+        tile_entries = []
+        # repeated courses drawn once per layer (feature group and year): gpx -> course gpx
+        courses = (self.courses if self.courses is not None else self.update_overlaps()) if self.draw_repeats_once else {}
+        drawn_courses = set()
+
+        def layer_key(group, raw_date):
+            return (group if group in feature_groups else None, year_layers.event_year(raw_date) if self.year_layers else None)
+
+        # trace drawn for every course of every layer, the one of its newest stage by date: (layer key, course gpx) -> gpx
+        course_traces = overlap.course_traces(((layer_key(camino, raw_date), raw_date, gpx) for raw_date, camino, gpx
+                                               in zip(self.date_list, self.camino_list, self.gpx_files)), courses)
+
+        # custom shell icon using the camino_shell.png image, shared by all stage markers
+        shell_icon = folium_elements.custom_icon(f'{self.jpg_web_prefix}camino_shell.png')
+
         # add markers based on csv file data
-        data_iter = zip(self.dateF_list, self.title_list, self.camino_list, self.start_list,
+        data_iter = zip(self.date_list, self.dateF_list, self.title_list, self.camino_list, self.start_list,
                         self.start_lat_list, self.start_lon_list, self.end_list, self.end_lat_list,
                         self.end_lon_list, self.distF_list, self.dplus_list, self.timeF_list,
                         self.notes_list, self.post_list, self.jpg_links, self.gpx_files, self.color_list)
 
-        for date, title, camino, start, start_lt, start_ln, end, end_lt, end_ln, dist, dplus, time, notes, post, jpg, gpx, color in data_iter:
+        for raw_date, date, title, camino, start, start_lt, start_ln, end, end_lt, end_ln, dist, dplus, time, notes, post, jpg, gpx, color in data_iter:
 
-            print(f'Loading {title}')
+            logger.debug(f'Loading {title}')
+            self.profiler.count('stages')
 
             # add distance and dplus to counter
             self.dist_count += dist
@@ -420,42 +719,39 @@ class CaminoMap:
             if dplus:
                 str_dist += f' | {int(dplus)} D+'
 
-            # create the iFrame popup for marker
-            iframe = folium.IFrame(
-                width=self.popup_width, height=self.popup_height, html=html_contents.format(
-                    title=title, date=date, camino=camino, start=start, end=end,
-                    dist=str_dist, time=time, notes=notes, post=post, pic=jpg
-                )
-            )
-
-            # create custom shell icon using the camino_shell.png image
-            shell_icon_url = f'{self.jpg_web_prefix}camino_shell.png'
-            shell_icon = folium.CustomIcon(
-                icon_image=shell_icon_url,
-                icon_size=(32, 32),
-                icon_anchor=(16, 16),
-                popup_anchor=(0, -16)
-            )
-
-            # add marker at START location with shell icon
-            folium_marker = folium.Marker(
-                location=[start_lt, start_ln],
-                tooltip=f"{title}: {start} → {end}",
-                popup=folium.Popup(iframe),
-                icon=shell_icon
-            )
-
-            # process gpx data
+            # marker at START location with shell icon, popup template and fields formatted in the browser
+            popup_fields = dict(title=title, date=date, camino=camino, start=start, end=end,
+                                dist=str_dist, time=time, notes=notes, post=post, pic=jpg, profile=sparklines.svg(gpx),
+                                stamps=self.stamps_html(stage_stamps.get(raw_date, [])))
+            marker = ([start_lt, start_ln], shell_icon, f"{title}: {start} → {end}", html_contents, popup_fields)
+
+            # marker and gpx trace go to the Feature Group of their Camino route (to map directly if no camino
+            # or camino not in feature groups), in the layer of their year
+            layer = feature_groups[camino] if camino and camino in feature_groups else self.camino_map
+            if self.year_layers:
+                layer = self.year_layers.layer(layer, year_layers.event_year(raw_date))
+
+            # process gpx data, unless the course is drawn in the layer with the trace of another event
             folium_gpx = None
-            if gpx:
-                points = self.process_gpx_to_df(gpx)
+            course = (layer_key(camino, raw_date), courses.get(gpx, gpx))
+            if gpx and (course in drawn_courses or course_traces[course] != gpx):
+                self.profiler.count('repeat_traces')
+            elif gpx:
+                with self.profiler.span(os.path.basename(gpx), category='gpx'):
+                    points = self.process_gpx_to_df(gpx)
                 if points:
+                    drawn_courses.add(course)
+                if points and self.stitch_routes and camino in feature_groups:
+                    # drawn later with the other stages of the route, ordered by date
+                    popup_html = html_contents.format(**popup_fields)
+                    day, month, year = (int(d) for d in raw_date.split('.'))
+                    route_stages.setdefault((layer.get_name(), stage_color), (layer, stage_color, []))[2].append(
+                        ((year, month, day), points, popup_html, f"{title}: {start} → {end}"))
+                    tile_entries.append((gpx, stage_color))
+                elif points:
                     # Create popup for the GPX trace (same as marker)
                     iframe_gpx = folium.IFrame(
-                        width=self.popup_width, height=self.popup_height, html=html_contents.format(
-                            title=title, date=date, camino=camino, start=start, end=end,
-                            dist=str_dist, time=time, notes=notes, post=post, pic=jpg
-                        )
+                        width=self.popup_width, height=self.popup_height, html=html_contents.format(**popup_fields)
                     )
                     folium_gpx = folium.PolyLine(
                         points,
@@ -463,76 +759,283 @@ class CaminoMap:
                         weight=self.gpx_weight,
                         opacity=self.gpx_opacity
                     )
+                    tile_entries.append((gpx, stage_color))
                     # Add popup and tooltip to the polyline
                     folium_gpx.add_child(folium.Popup(iframe_gpx))
                     folium.Tooltip(f"{title}: {start} → {end}").add_to(folium_gpx)
 
-            # add marker and gpx trace to Feature Groups based on Camino route
-            if camino and camino in feature_groups:
-                folium_marker.add_to(feature_groups[camino])
-                if folium_gpx:
-                    folium_gpx.add_to(feature_groups[camino])
-            else:
-                # Add to map directly if no camino or camino not in feature groups
-                folium_marker.add_to(self.camino_map)
-                if folium_gpx:
-                    folium_gpx.add_to(self.camino_map)
+            # add marker and gpx trace to their layer
+            self.marker_layer(layer).add_marker(*marker)
+            if folium_gpx:
+                folium_gpx.add_to(self.vector_layer(layer))
+
+            # write the trace right away instead of keeping its points until the map is saved
+            writer = self.layer_writer(layer)
+            if folium_gpx and writer:
+                writer.flush(folium_gpx)
+
+        # one multi-part polyline per camino route (and year) and stage color
+        for layer, color, stages in route_stages.values():
+            route = self.add_stitched_route(self.vector_layer(layer), sorted(stages, key=lambda s: s[0]), color)
+            writer = self.layer_writer(layer)
+            if writer:
+                writer.flush(route)
 
         # Create a feature group for stamps
         legend_txt = '<span style="color: {col};">{txt}</span>'
         stamps_feature_group = folium.FeatureGroup(name=legend_txt.format(txt='Stamps', col='black')).add_to(self.camino_map)
 
+        # custom stamp icon using the stamp.png image, shared by all stamp markers
+        stamp_icon = folium_elements.custom_icon(f'{self.jpg_web_prefix}stamp.png')
+
         # Add stamp markers
-        stamp_data_iter = zip(self.stamp_dateF_list, self.stamp_place_list, self.stamp_location_list,
+        stamp_data_iter = zip(self.stamp_date_list, self.stamp_dateF_list, self.stamp_place_list, self.stamp_location_list,
                               self.stamp_camino_list, self.stamp_lat_list, self.stamp_lon_list,
                               self.stamp_note_list, self.stamp_link_list, self.stamp_jpg_links)
 
-        for date, place, location, camino, lat, lon, note, link, jpg in stamp_data_iter:
-            print(f'Loading stamp: {place}')
+        for raw_date, date, place, location, camino, lat, lon, note, link, jpg in stamp_data_iter:
+            logger.debug(f'Loading stamp: {place}')
+            self.profiler.count('stamps')
 
             # count stamps
             self.stamps_count += 1
 
-            # create the iFrame popup for stamp marker
-            iframe = folium.IFrame(
-                width=self.stamp_popup_width, height=self.stamp_popup_height,
-                html=self.stamp_html_popup.format(
-                    place=place, date=date, location=location, camino=camino,
-                    note=note, link=link, pic=jpg
-                )
-            )
-
-            # create custom stamp icon using the stamp.png image
-            stamp_icon_url = f'{self.jpg_web_prefix}stamp.png'
-            stamp_icon = folium.CustomIcon(
-                icon_image=stamp_icon_url,
-                icon_size=(32, 32),
-                icon_anchor=(16, 16),
-                popup_anchor=(0, -16)
-            )
-
             # add stamp marker with custom stamp icon
-            stamp_marker = folium.Marker(
-                location=[lat, lon],
-                tooltip=place,
-                popup=folium.Popup(iframe),
-                icon=stamp_icon
-            )
+            popup_fields = dict(place=place, date=date, location=location, camino=camino, note=note, link=link, pic=jpg)
+            layer = self.year_layers.layer(stamps_feature_group, year_layers.event_year(raw_date)) if self.year_layers else stamps_feature_group
+            self.marker_layer(layer, self.stamp_popup_width, self.stamp_popup_height).add_marker(
+                [lat, lon], stamp_icon, place, self.stamp_html_popup, popup_fields)
 
-            stamp_marker.add_to(stamps_feature_group)
+        logger.info(f'Total stamps loaded: {self.stamps_count}')
 
-        print(f'Total stamps loaded: {self.stamps_count}')
+        if self.year_layers:
+            self.year_layers.close()
 
         # add layer control (legend), each feature group will be a different Camino route
+        if self.tiles:
+            self.add_trace_tiles(self.camino_map, tile_entries)
+        if self.heatmap:
+            self.add_heatmap(self.camino_map)
+
+        # search box over the index written next to the map (published in the same folder)
+        folium_elements.SearchControl(os.path.basename(self.search_index_json)).add_to(self.camino_map)
+
         self.camino_map.add_child(folium.LayerControl(position='topright', collapsed=True, autoZIndex=True))
 
+    def add_stitched_route(self, feature_group, stages, color):
+        """Add the stages of a route to the map as one multi-part polyline
+
+        Args:
+            feature_group (folium.FeatureGroup): feature group of the camino
+            stages (list): tuples (date, points, popup html, tooltip) ordered by date
+            color (string): route color
+
+        Return:
+            (folium_elements.StitchedRoute): route element
+        """
+
+        import routes
+        import folium_elements
+
+        parts, stage_index = routes.stitch_route([points for _, points, _, _ in stages])
+        route = folium_elements.StitchedRoute(
+            parts, stage_index,
+            popups=[popup for _, _, popup, _ in stages],
+            tooltips=[tooltip for _, _, _, tooltip in stages],
+            popup_width=self.popup_width,
+            popup_height=self.popup_height,
+            color=color,
+            weight=self.gpx_weight,
+            opacity=self.gpx_opacity
+        ).add_to(feature_group)
+
+        self.profiler.count('stitched_stages', len(stages))
+        self.profiler.count('route_parts', len(parts))
+        logger.debug(f'{len(stages)} stages stitched into {len(parts)} parts')
+        return route
+
+    def layer_writer(self, layer):
+        """Writer of the features of a layer: the chunk of its year, the map writer or None"""
+
+        if self.year_layers:
+            return self.year_layers.writer(layer, self.map_writer)
+        return self.map_writer
+
+    def marker_layer(self, parent, popup_width=None, popup_height=None):
+        """Bulk marker layer of a feature group or of the map, created on first use
+
+        Args:
+            parent (folium.FeatureGroup or folium.Map): layer showing the markers
+            popup_width (int): popup iframe width in pixels, popup_width setting if None
+            popup_height (int): popup iframe height in pixels, popup_height setting if None
+        """
+
+        import folium_elements
+
+        name = parent.get_name()
+        if name not in self.marker_layers:
+            self.marker_layers[name] = folium_elements.BulkMarkers(popup_width or self.popup_width,
+                                                                   popup_height or self.popup_height).add_to(parent)
+            writer = self.layer_writer(parent)
+            if writer:
+                # still receiving markers, written with the rest of the map by save_map (or with its year chunk)
+                writer.defer(self.marker_layers[name])
+        return self.marker_layers[name]
+
+    def vector_layer(self, parent):
+        """Layer receiving the vector traces of a feature group or of the map
+
+        With raster tiles the traces go to a sub group of the parent only shown above the zooms
+        of the tiles, see add_trace_tiles.
+
+        Args:
+            parent (folium.FeatureGroup or folium.Map): layer showing the traces without tiles
+        """
+
+        if not self.tiles:
+            return parent
+
+        import folium
+        import folium_elements
+
+        name = parent.get_name()
+        if name not in self.vector_layers:
+            layer = folium.FeatureGroup(control=False, show=False).add_to(parent)
+            band = folium_elements.ZoomBand(layer, self.tile_max_zoom + 1).add_to(parent)
+            writer = self.layer_writer(parent)
+            if writer:
+                # rendered after the layer, which may be written to a year chunk
+                writer.defer(band)
+            self.vector_layers[name] = layer
+        return self.vector_layers[name]
+
+    def add_trace_tiles(self, folium_map, entries):
+        """Render the raster tiles of the traces and add them to the map up to the tile max zoom
+
+        Args:
+            folium_map (folium.Map): map receiving the tile layer
+            entries (list): (gpx path, color) of every trace drawn on the map
+        """
+
+        import folium
+
+        renderer = self.load_tile_renderer()
+        rendered = renderer.update(entries, self.load_trace_store(), profiler=self.profiler)
+        if rendered:
+            self.profiler.count('tiles_rendered', rendered)
+            logger.info(f'Trace tiles updated: {rendered} tiles rendered')
+
+        folium.TileLayer(renderer.tile_url(self.camino_map_html), attr='Traces', name='Traces', overlay=True, control=False,
+                         min_zoom=0, max_zoom=self.tile_max_zoom).add_to(folium_map)
+
+    @stage()
+    def update_sparklines(self):
+        """Compute the elevation profiles of the new or modified traces, drawn in the popups ({profile} field)
+
+        Return:
+            (sparkline.ProfileCache): profiles of all traces
+        """
+
+        import sparkline
+
+        if self.sparklines is None:
+            self.sparklines = sparkline.ProfileCache(self.sparkline_cache)
+        computed = self.sparklines.update(self.gpx_files, self.load_trace_store(), profiler=self.profiler)
+        if computed:
+            self.profiler.count('profiles', computed)
+            logger.info(f'Elevation profiles updated: {computed} traces')
+        return self.sparklines
+
+    def add_heatmap(self, folium_map):
+        """Add the heatmap of all traces as a hidden feature group, with one heat layer per zoom band
+
+        Args:
+            folium_map (folium.Map): map receiving the feature group
+        """
+
+        import folium
+        import heatmap
+        import folium_elements
+        from folium.plugins import HeatMap
+
+        if self.heatmap_grid is None:
+            self.heatmap_grid = heatmap.HeatmapGrid(self.heatmap_cache)
+        binned = self.heatmap_grid.update(self.gpx_files, self.load_trace_store(), profiler=self.profiler)
+        if binned:
+            logger.info(f'Heatmap updated: {binned} traces binned')
+
+        feature_group = folium.FeatureGroup(name='Heatmap', show=False).add_to(folium_map)
+        for band, (min_zoom, max_zoom) in enumerate(self.heatmap_grid.bands):
+            heat = self.heatmap_grid.band_heat(band)
+            # full intensity from the lowest zoom of the band, the layer is hidden outside of it
+            layer = HeatMap(heat, min_opacity=0.3, max_zoom=min_zoom, radius=heatmap.CELL_PIXELS + 2,
+                            blur=heatmap.CELL_PIXELS, control=False, show=False).add_to(feature_group)
+            folium_elements.ZoomBand(layer, min_zoom, max_zoom).add_to(feature_group)
+            self.profiler.count('heat_cells', len(heat))
+
+    def export_features(self):
+        """Stages of the database with their simplified traces and the stamps as GeoJSON features (generator)"""
+
+        import export
+        import data_table
+
+        store = self.current_trace_store()
+        cursor = self.connect_database().execute("""SELECT date, title, camino, start, start_lt, start_ln, end, dist, dplus, time, post, gpx
+                                                 FROM camino_map ORDER BY id""")
+        for date, title, camino, start, lt, ln, end, dist, dplus, time, post, gpx in cursor:
+            properties = export.feature_properties('stage', data_table.iso_date(date), title, f'{start} → {end}', camino, dist, dplus, time, post)
+            yield export.point_feature(lt, ln, properties)
+            track = store.track(gpx) if gpx else None
+            if track is not None:
+                yield export.trace_feature(track, self.export_tolerance, dict(properties, kind='trace'))
+
+        # stamps are not in the database, they come from the stamps spreadsheet
+        stamps = zip(self.stamp_date_list, self.stamp_place_list, self.stamp_location_list, self.stamp_camino_list,
+                     self.stamp_lat_list, self.stamp_lon_list, self.stamp_link_list)
+        for date, place, location, camino, lt, ln, link in stamps:
+            yield export.point_feature(lt, ln, export.feature_properties('stamp', data_table.iso_date(date), place, location, camino, link=link))
+
+    @stage()
+    def export_data(self, formats=None):
+        """Stream the stages, traces and stamps to GeoJSONSeq, KML and FlatGeobuf files in the export folder
+
+        Args:
+            formats (list): export formats, see export.FORMATS, defaults to the export_formats setting
+        """
+
+        import export
+
+        logger.info('\n' + ' EXPORT DATA '.center(100, '#'))
+
+        paths = {fmt: os.path.join(self.export_folder, 'camino_map' + export.FORMATS[fmt]) for fmt in formats or self.export_formats}
+        count = export.export_features(self.export_features(), paths, name='Camino map')
+        self.profiler.count('exported_features', count)
+        logger.info(f'Data exported: {count} features to {self.export_folder}')
+
+    @stage()
+    def generate_search_index(self):
+        """Write the search index of the stages and stamps, loaded by the search box of the map"""
+
+        import search_index
+
+        docs = [(title, f'{camino} | {start} → {end} | {date}', 'stage', lt, ln)
+                for title, camino, start, end, date, lt, ln in zip(self.title_list, self.camino_list, self.start_list, self.end_list,
+                                                                   self.dateF_list, self.start_lat_list, self.start_lon_list)]
+        docs += [(place, f'{location} | {camino}', 'stamp', lt, ln)
+                 for place, location, camino, lt, ln in zip(self.stamp_place_list, self.stamp_location_list, self.stamp_camino_list,
+                                                            self.stamp_lat_list, self.stamp_lon_list)]
+        size = search_index.write_index(self.search_index_json, docs)
+        self.profiler.count('search_docs', len(docs))
+        logger.info(f'Search index written: {len(docs)} entries, {size} bytes')
+
+    @stage()
     def generate_table(self):
         """Generate the html table embebbed on the website"""
 
-        print('\n' + ' GENERATING TABLE HTML FILE '.center(100, '#'))
+        logger.info('\n' + ' GENERATING TABLE HTML FILE '.center(100, '#'))
 
         if not os.path.isfile(self.table_template):
-            print(f'{self.table_template} is not a valid filepath. Skipping this step.')
+            logger.warning(f'{self.table_template} is not a valid filepath. Skipping this step.')
             return
 
         with open(self.table_template, 'r', encoding='utf-8') as input_file:
@@ -543,7 +1046,11 @@ class CaminoMap:
         current_year = ''
 
         if html_marker not in html_contents:
-            print('html marker not found in template file. Skipping this step.')
+            logger.warning('html marker not found in template file. Skipping this step.')
+            return
+
+        if self.table_mode == 'virtual':
+            self.write_table_data(html_contents)
             return
 
         # create data iterator from spreadsheet
@@ -593,40 +1100,161 @@ class CaminoMap:
         with open(self.table_html, 'w', encoding='utf-8') as output_file:
             output_file.write(html_contents)
 
-        print(f'Table html file created successfully at location {self.table_html}')
+        logger.info(f'Table html file created successfully at location {self.table_html}')
+
+    def write_table_data(self, template):
+        """Write the stages as json rows drawn by the virtualized table page (table_mode 'virtual')
+
+        Args:
+            template (string): html contents of the table template
+        """
+
+        import data_table
 
+        rows = []
+        data_iter = zip(self.date_list, self.camino_list, self.start_list, self.end_list,
+                        self.dist_list, self.dplus_list, self.time_list, self.post_list)
+        for date, camino, start, end, dist, dplus, time, post in data_iter:
+            dist_cell = f'{dist} km | {int(dplus)} m' if dplus else f'{dist} km'
+            rows.append([data_table.date_cell(date, post), camino, f'{start} → {end}', dist_cell, time])
+
+        # sort and filter keys of every row
+        keys = {
+            'date': [data_table.iso_date(date) for date in self.date_list],
+            'year': [int(date.split('.')[-1]) for date in self.date_list],
+            'camino': self.camino_list,
+            'start': self.start_list,
+            'dist': self.distF_list,
+            'time': [data_table.duration_seconds(time) for time in self.time_list],
+        }
+
+        options = {
+            'classes': ['tg-yw4l', 'tg-9hbo', 'tg-yw4l', 'tg-yw4l', 'tg-yw4l'],
+            'sort': ['date', 'camino', 'start', 'dist', 'time'],
+            'filters': [{'field': 'year', 'label': 'Year', 'kind': 'select'},
+                        {'field': 'camino', 'label': 'Camino', 'kind': 'select'},
+                        {'field': 'dist', 'label': 'Distance (km)', 'kind': 'range'}],
+            'separator': 'tg-d1kj',
+        }
+
+        if data_table.write_table(template, self.table_html, self.table_json, self.data_table_js, rows, keys, options):
+            self.profiler.count('table_rows', len(rows))
+            logger.info(f'Table html and json files created successfully at location {self.table_html}')
+
+    @stage()
     def save_map(self):
         """Saves the map as html file"""
-        print('\n' + ' SAVING HTML MAP '.center(100, '#'))
-        self.camino_map.save(self.camino_map_html)
-        print(f'Map saved at location {self.camino_map_html}')
+        logger.info('\n' + ' SAVING HTML MAP '.center(100, '#'))
+        if self.map_writer:
+            # the traces were written while the map was built, see generate_map
+            self.map_writer.close(self.camino_map_html)
+            self.map_writer = None
+        else:
+            self.camino_map.save(self.camino_map_html)
+        logger.info(f'Map saved at location {self.camino_map_html}')
+
+    def html_outputs(self):
+        """List of html/css/json files published on the web server"""
+        outputs = [self.camino_map_html, self.table_html, self.table_css, self.search_index_json]
+        if self.table_mode == 'virtual':
+            outputs += [self.table_json, self.data_table_js]
+        if self.year_chunks:
+            import year_layers
+            outputs += year_layers.chunk_files(self.camino_map_html)
+        return outputs
+
+    @stage()
+    def post_process_outputs(self):
+        """Minify html/css outputs and write precompressed .gz/.br copies in the dist folder"""
+
+        if not self.minify_outputs:
+            return
+
+        logger.info('\n' + ' MINIFYING AND COMPRESSING OUTPUTS '.center(100, '#'))
+        processed, skipped = minify.process_outputs(self.html_outputs(), self.dist_folder)
+        self.profiler.miss('minify', processed)
+        self.profiler.hit('minify', skipped)
+        logger.info(f'Outputs processed: {processed} minified, {skipped} unchanged')
+
+    def load_tile_renderer(self):
+        """Open the raster tiles renderer, or reuse the one already opened by this object"""
+
+        import tile_renderer
+
+        if self.tile_renderer is None:
+            # thinner lines than the vector traces, the tiles are only shown zoomed out
+            self.tile_renderer = tile_renderer.TileRenderer(self.tiles_folder, max_zoom=self.tile_max_zoom,
+                                                            width=max(1, self.gpx_weight // 2), opacity=self.gpx_opacity)
+        return self.tile_renderer
+
+    def load_trace_store(self):
+        """Open the packed trace store, or reuse the one already opened by this object"""
+
+        import trace_store
+
+        if self.trace_store is None:
+            self.trace_store = trace_store.TraceStore(self.trace_store_folder)
+        return self.trace_store
+
+    @stage()
+    def update_trace_store(self):
+        """Pack the gpx traces of the spreadsheet into the trace store, reading only new or modified files
+
+        Return:
+            (TraceStore): the updated store
+        """
+
+        store = self.load_trace_store()
+        read = store.update(self.gpx_files, prune=self.prune_trace_store, profiler=self.profiler)
+        if read:
+            self.profiler.count('gpx_files', read)
+            logger.info(f'Trace store updated: {read} gpx files read, {len(store)} traces stored')
+        self.trace_store_updated = True
+        return store
+
+    def current_trace_store(self):
+        """Trace store up to date with the gpx files of the spreadsheet, updated only if not done since the spreadsheet was read"""
+
+        return self.load_trace_store() if self.trace_store_updated else self.update_trace_store()
+
+    def forget_stage_results(self):
+        """Forget the trace store state and the results of the trace stages, computed again on next use (new spreadsheet or gpx files)"""
+
+        self.trace_store_updated = False
+        self.sparklines = None
+        self.courses = None
+        self.stage_stamps = None
 
     def process_gpx_to_df(self, gpx_file):
-        """Parse the gpx data into a dataframe
+        """Get the points of a trace (gpx, tcx or fit file) from the trace store
 
         Args:
-            gpx_file (string): path to gpx file
-            step (int): slicing step for storing gpx points to avoid using too much data
+            gpx_file (string): path to the trace file
 
         Return:
-            (list): list of tuples (lat, long) for each data point
+            (list): list of [lat, long] for every gpx_smoothness point
         """
 
-        if not os.path.isfile(gpx_file) or not gpx_file.lower().endswith('.gpx'):
-            print(f'Invalid gpx file {gpx_file}')
+        import traces
+
+        if not os.path.isfile(gpx_file) or not gpx_file.lower().endswith(traces.TRACK_EXTENSIONS):
+            logger.warning(f'Invalid trace file {gpx_file}')
             return None
 
-        gpx = gpxpy.parse(open(gpx_file))
+        store = self.load_trace_store()
+        if not store.is_current(gpx_file):
+            store.update([gpx_file], profiler=self.profiler)
 
-        # Make points tuple for lines
-        points = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points[::self.gpx_smoothness]:
-                    points.append(tuple([point.latitude, point.longitude]))
+        coordinates = store.coordinates(gpx_file)
+        if coordinates is None:
+            return None
 
+        # float32 coordinates rounded back to 6 decimals (~0.1 m) to keep the html small
+        points = coordinates[::self.gpx_smoothness].astype('float64').round(6).tolist()
+        self.profiler.count('gpx_points', len(points))
         return points
 
+    @stage()
     def upload_to_ftp(self, html=True, jpg=True, gpx=True, force=False):
         """Uploads map and files to ftp server
 
@@ -643,31 +1271,33 @@ class CaminoMap:
 
         # Check if all required environment variables are set
         if not all([ftp_address, ftp_user, ftp_pwd]):
-            print("❌ Error: Missing FTP environment variables in .env file")
-            print("Required variables: FTP_ADDRESS, FTP_USER, FTP_PWD")
+            logger.error("❌ Error: Missing FTP environment variables in .env file")
+            logger.error("Required variables: FTP_ADDRESS, FTP_USER, FTP_PWD")
             return False
 
         try:
-            print(f"🔄 Connecting to FTP server: {ftp_address}")
-            ftp = FTP(ftp_address)
-
-            print("🔄 Logging in...")
-            ftp.login(user=ftp_user, passwd=ftp_pwd, acct='')
+            logger.info(f"🔄 Connecting to FTP server: {ftp_address}")
+            if self.ftp_pool:
+                ftp = self.ftp_pool.acquire(ftp_address, ftp_user, ftp_pwd)
+            else:
+                ftp = FTP(ftp_address)
+                logger.info("🔄 Logging in...")
+                ftp.login(user=ftp_user, passwd=ftp_pwd, acct='')
 
             # Try to change to directory, create it if it doesn't exist
-            print(f"🔄 Changing to directory: {self.ftp_dir}")
+            logger.info(f"🔄 Changing to directory: {self.ftp_dir}")
             try:
                 ftp.cwd(self.ftp_dir)
             except Exception:
-                print(f"📁 Directory {self.ftp_dir} doesn't exist, creating it...")
+                logger.info(f"📁 Directory {self.ftp_dir} doesn't exist, creating it...")
                 ftp.mkd(self.ftp_dir)
                 ftp.cwd(self.ftp_dir)
-            print("✅ FTP connection successful!")
+            logger.info("✅ FTP connection successful!")
 
         except Exception as e:
-            print(f"❌ FTP connection failed: {str(e)}")
-            print("💡 Please check your .env file and FTP credentials.")
-            print(f"💡 Make sure the FTP directory {self.ftp_dir} can be created on the server.")
+            logger.error(f"❌ FTP connection failed: {str(e)}")
+            logger.warning("💡 Please check your .env file and FTP credentials.")
+            logger.warning(f"💡 Make sure the FTP directory {self.ftp_dir} can be created on the server.")
             return False
 
         def get_ftp_file_list(directory='.'):
@@ -677,7 +1307,7 @@ class CaminoMap:
                 ftp.cwd(directory)
                 ftp.retrlines('NLST', files.append)
             except Exception as e:
-                print(f"Warning: Could not list files in {directory}: {e}")
+                logger.warning(f"Warning: Could not list files in {directory}: {e}")
             return files
 
         def file_needs_upload(filename, ftp_files, force_upload=False):
@@ -687,34 +1317,36 @@ class CaminoMap:
             return filename not in ftp_files
 
         if html:
-            print('\n' + ' TRANSFERING HTML FILES '.center(100, '#'))
+            logger.info('\n' + ' TRANSFERING HTML FILES '.center(100, '#'))
 
             # Get list of files in root directory
             ftp_files = get_ftp_file_list('.')
 
-            # Upload camino_map.html
-            with open(self.camino_map_html, 'rb') as file:
-                ftp.storbinary('STOR camino_map.html', file)
-            print('camino_map.html transfered')
-
-            # Upload camino_table.html
-            with open(self.table_html, 'rb') as file:
-                ftp.storbinary('STOR camino_table.html', file)
-            print('camino_table.html transfered')
-
-            # Upload camino_table.css
-            with open(self.table_css, 'rb') as file:
-                ftp.storbinary('STOR camino_table.css', file)
-            print('camino_table.css transfered')
+            # Upload html/css files, with their precompressed copies if any
+            dist_folder = self.dist_folder if self.minify_outputs else None
+            for output in self.html_outputs():
+                for local_path, remote_name in minify.publish_files(output, dist_folder):
+                    with open(local_path, 'rb') as file:
+                        ftp.storbinary(f'STOR {remote_name}', file)
+                    logger.debug(f'{remote_name} transfered')
+                    self.profiler.count('uploaded_bytes', os.path.getsize(local_path))
+
+            # raster tiles of the traces rendered or removed since the last upload
+            if self.tiles:
+                import tile_renderer
+                renderer = self.load_tile_renderer()
+                uploaded = tile_renderer.publish_tiles(ftp, renderer, renderer.relative_folder(self.camino_map_html), force=force)
+                self.profiler.count('uploaded_tiles', uploaded)
+                logger.info(f'Tiles transfer complete: {uploaded} uploaded')
 
         # transfer jpg files
         if jpg:
-            print('\n' + ' TRANSFERING JPG FILES '.center(100, '#'))
+            logger.info('\n' + ' TRANSFERING JPG FILES '.center(100, '#'))
             try:
                 try:
                     ftp.cwd('jpg')
                 except Exception:
-                    print("📁 Creating jpg/ directory...")
+                    logger.info("📁 Creating jpg/ directory...")
                     ftp.mkd('jpg')
                     ftp.cwd('jpg')
                 ftp_jpg_files = get_ftp_file_list('.')
@@ -730,29 +1362,30 @@ class CaminoMap:
                             pic_path = os.path.join(jpg_folder, jpg_file)
                             with open(pic_path, 'rb') as file:
                                 ftp.storbinary('STOR {}'.format(jpg_file), file)
-                            print('{} transfered'.format(jpg_file))
+                            logger.debug(f'{jpg_file} transfered')
                             uploaded_count += 1
+                            self.profiler.count('uploaded_files')
                         else:
                             skipped_count += 1
 
-                    print(f'JPG transfer complete: {uploaded_count} uploaded, {skipped_count} skipped')
+                    logger.info(f'JPG transfer complete: {uploaded_count} uploaded, {skipped_count} skipped')
                 else:
-                    print(f'JPG folder {jpg_folder} does not exist')
+                    logger.warning(f'JPG folder {jpg_folder} does not exist')
 
                 # Return to start directory
                 ftp.cwd(self.ftp_dir)
             except Exception as e:
-                print(f'Error accessing JPG directory: {e}')
+                logger.warning(f'Error accessing JPG directory: {e}')
                 ftp.cwd(self.ftp_dir)
 
         # transfer gpx files
         if gpx:
-            print('\n' + ' TRANSFERING GPX FILES '.center(100, '#'))
+            logger.info('\n' + ' TRANSFERING GPX FILES '.center(100, '#'))
             try:
                 try:
                     ftp.cwd('gpx')
                 except Exception:
-                    print("📁 Creating gpx/ directory...")
+                    logger.info("📁 Creating gpx/ directory...")
                     ftp.mkd('gpx')
                     ftp.cwd('gpx')
                 ftp_gpx_files = get_ftp_file_list('.')
@@ -768,29 +1401,136 @@ class CaminoMap:
                             gpx_path = os.path.join(gpx_folder, gpx_file)
                             with open(gpx_path, 'rb') as file:
                                 ftp.storbinary('STOR {}'.format(gpx_file), file)
-                            print('{} transfered'.format(gpx_file))
+                            logger.debug(f'{gpx_file} transfered')
                             uploaded_count += 1
+                            self.profiler.count('uploaded_files')
                         else:
                             skipped_count += 1
 
-                    print(f'GPX transfer complete: {uploaded_count} uploaded, {skipped_count} skipped')
+                    logger.info(f'GPX transfer complete: {uploaded_count} uploaded, {skipped_count} skipped')
                 else:
-                    print(f'GPX folder {gpx_folder} does not exist')
+                    logger.warning(f'GPX folder {gpx_folder} does not exist')
 
                 # Return to start directory
                 ftp.cwd(self.ftp_dir)
             except Exception as e:
-                print(f'Error accessing GPX directory: {e}')
+                logger.warning(f'Error accessing GPX directory: {e}')
                 ftp.cwd(self.ftp_dir)
 
         try:
-            ftp.quit()
-            print("✅ FTP upload completed successfully!")
+            if self.ftp_pool:
+                self.ftp_pool.release(ftp)
+            else:
+                ftp.quit()
+            logger.info("✅ FTP upload completed successfully!")
             return True
         except Exception as e:
-            print(f"Warning: Error closing FTP connection: {e}")
+            logger.warning(f"Warning: Error closing FTP connection: {e}")
             return True
 
+    def pipeline_stages(self):
+        """Stages of the build pipeline with their dependencies, inputs and outputs, see scheduler.py"""
+
+        map_inputs = [self.settings_path, self.events_csv, self.stamps_csv, self.popup_contents_html,
+                      self.stamp_popup_contents_html, self.gpx_folder]
+
+        return [
+            Stage('fetch', self.download_spreadsheet_as_csv, always=True),
+            Stage('fetch_stamps', self.download_stamps_as_csv, always=True),
+            Stage('load', lambda: self.load_csv_file(download=False), deps=['fetch'], always=True),
+            Stage('load_stamps', lambda: self.load_stamps_csv(download=False), deps=['fetch_stamps'], always=True),
+            # stages sharing the database connection run one at a time (resources)
+            Stage('database', self.update_database, deps=['load'], inputs=[self.events_csv],
+                  outputs=[self.database_path], resources=['database']),
+            # always checked (a few stat calls): the store may be shared with other sites, see batch_main.py
+            Stage('trace_store', self.update_trace_store, deps=['load'], always=True),
+            Stage('spatial_index', self.update_spatial_index, deps=['database', 'trace_store', 'load_stamps'],
+                  inputs=[self.events_csv, self.stamps_csv, self.gpx_folder], outputs=[self.database_path], resources=['database']),
+            Stage('trace_metrics', self.update_trace_metrics, deps=['database', 'trace_store'],
+                  inputs=[self.events_csv, self.gpx_folder], outputs=[self.database_path], resources=['database']),
+            Stage('sparklines', self.update_sparklines, deps=['load', 'trace_store'],
+                  inputs=[self.events_csv, self.gpx_folder], outputs=[self.sparkline_cache]),
+            Stage('overlap', self.update_overlaps, deps=['database', 'trace_store'],
+                  inputs=[self.events_csv, self.gpx_folder], outputs=[self.database_path], resources=['database']),
+            Stage('stamp_stages', self.update_stamp_stages, deps=['load', 'load_stamps', 'trace_store'],
+                  inputs=[self.events_csv, self.stamps_csv, self.gpx_folder], outputs=[self.database_path], resources=['database']),
+            # after every stage writing to the database, whose results the map reads
+            Stage('map', lambda: (self.generate_map(), self.save_map()),
+                  deps=['trace_store', 'sparklines', 'load_stamps', 'database', 'spatial_index', 'trace_metrics', 'overlap', 'stamp_stages'],
+                  inputs=map_inputs, outputs=[self.camino_map_html], resources=['database']),
+            Stage('table', self.generate_table, deps=['load'],
+                  inputs=[self.events_csv, self.table_template],
+                  outputs=[self.table_html] + ([self.table_json] if self.table_mode == 'virtual' else [])),
+            Stage('search', self.generate_search_index, deps=['load', 'load_stamps'],
+                  inputs=[self.events_csv, self.stamps_csv], outputs=[self.search_index_json]),
+            Stage('minify', self.post_process_outputs, deps=['map', 'table', 'search'],
+                  inputs=self.html_outputs(), outputs=[self.dist_folder] if self.minify_outputs else []),
+            Stage('upload_html', lambda: self.upload_to_ftp(html=True, jpg=False, gpx=False), deps=['minify'],
+                  inputs=self.html_outputs() + [self.dist_folder] + ([self.tiles_folder] if self.tiles else [])),
+            Stage('upload_jpg', lambda: self.upload_to_ftp(html=False, jpg=True, gpx=False), inputs=[self.jpg_folder]),
+            Stage('upload_gpx', lambda: self.upload_to_ftp(html=False, jpg=False, gpx=True), inputs=[self.gpx_folder]),
+        ] + ([
+            # on demand (cli.py export) unless export formats are set
+            Stage('export', self.export_data,
+                  deps=['database', 'trace_store', 'load_stamps'],
+                  inputs=[self.events_csv, self.stamps_csv, self.gpx_folder], outputs=[self.export_folder], resources=['database']),
+        ] if self.export_formats else [])
+
+    def watch_targets(self):
+        """Files and folders monitored in watch mode, with the build steps depending on them"""
+
+        return {
+            self.events_csv: ['csv', 'map', 'table', 'search'],
+            self.stamps_csv: ['stamps', 'map', 'search'],
+            self.popup_contents_html: ['templates', 'map'],
+            self.stamp_popup_contents_html: ['templates', 'map'],
+            self.table_template: ['table'],
+            self.gpx_folder: ['map'],
+            self.jpg_folder: ['jpg'],
+        }
+
+    def rebuild(self, steps, upload=False):
+        """Rebuild the outputs affected by a set of build steps, reusing the trace store
+
+        Args:
+            steps (set): build steps to run, see watch_targets
+            upload (bool): upload the rebuilt outputs to the ftp server
+        """
+
+        if 'templates' in steps:
+            self.load_templates()
+        if 'csv' in steps:
+            self.load_csv_file(download=False)
+            self.update_database()
+        if 'stamps' in steps:
+            self.load_stamps_csv(download=False)
+        if 'map' in steps:
+            # the gpx files may have changed
+            self.forget_stage_results()
+            self.generate_map()
+            self.save_map()
+        if 'table' in steps:
+            self.generate_table()
+        if 'search' in steps:
+            self.generate_search_index()
+        self.post_process_outputs()
+
+        if upload:
+            self.upload_to_ftp(html=True, jpg='jpg' in steps, gpx='map' in steps)
+
+    def write_profile_report(self, path=None):
+        """Log the profile summary and write the run report as json or chrome trace (.trace.json)
+
+        Args:
+            path (string): report file path, defaults to the profile_report setting
+        """
+
+        self.profiler.print_summary()
+
+        path = path or self.profile_report
+        if path:
+            self.profiler.write_report(os.path.join(CURRENT_FOLDER, path))
+
     def open_blog_page(self):
         """Opens the map on the blog web page"""
         webbrowser.open(self.blog_event_page)
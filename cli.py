@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Command line interface over the run map and camino map pipelines.
+Heavy libraries (folium, pandas, numpy) are only imported by the subcommands needing them,
+so that stats, query and upload start instantly.
+
+Usage:
+    python cli.py fetch
+    python cli.py --site camino build --download
+    python cli.py stats
+    python cli.py query "SELECT race, time FROM run_map WHERE dist > 42"
+    python cli.py query --near 52.52 13.40 50 --kind event
+    python cli.py upload --no-jpg --no-gpx
+    python cli.py --site camino export --format geojsonseq --format flatgeobuf
+"""
+
+import os
+import sys
+import logging
+import sqlite3
+import argparse
+from sites import SITES, load_site_class
+
+logger = logging.getLogger(__name__)
+
+
+def load_data(site, download):
+    """Load the spreadsheets of a site, downloading them first if asked"""
+
+    site.load_csv_file(download=download)
+    if hasattr(site, 'load_stamps_csv'):
+        site.load_stamps_csv(download=download)
+
+
+def database_ready(site, tables):
+    """Check that the database of a site exists and holds some tables, logging what to run otherwise
+
+    Opened read-only, so that a missing database file is not created empty.
+
+    Args:
+        site (RunMap or CaminoMap): site whose database_path is checked
+        tables (list): table names
+
+    Return:
+        (bool): True if the database file and all tables exist
+    """
+
+    if os.path.isfile(site.database_path):
+        conn = sqlite3.connect(f'file:{site.database_path}?mode=ro', uri=True)
+        found = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        conn.close()
+        missing = [table for table in tables if table not in found]
+    else:
+        missing = tables
+    if missing:
+        logger.error(f"Missing tables {', '.join(missing)} in {site.database_path}: run `cli.py sync` first")
+        return False
+    return True
+
+
+def cmd_fetch(site, args):
+    """Download the spreadsheets as csv files"""
+
+    site.download_spreadsheet_as_csv()
+    if hasattr(site, 'download_stamps_as_csv'):
+        site.download_stamps_as_csv()
+
+
+def cmd_sync(site, args):
+    """Update the database, its spatial index, the trace metrics (and the stamp stages) from the csv and gpx files"""
+
+    load_data(site, args.download)
+    site.update_database(rebuild=args.rebuild)
+    site.update_spatial_index()
+    site.update_trace_metrics()
+    if hasattr(site, 'update_stamp_stages'):
+        site.update_stamp_stages()
+
+
+def cmd_build(site, args):
+    """Generate, save and post-process the html map"""
+
+    load_data(site, args.download)
+    site.generate_map()
+    site.save_map()
+    site.post_process_outputs()
+
+
+def cmd_table(site, args):
+    """Generate the html tables (and the eventometer and PB/PR table for the run map)"""
+
+    # the PB/PR table joins the records with the events of the database
+    if hasattr(site, 'generate_records_table') and not database_ready(site, [SITES[args.site][0]]):
+        return False
+
+    site.load_csv_file(download=args.download)
+    if hasattr(site, 'generate_events_table'):
+        site.generate_events_table()
+        site.generate_eventometer()
+        site.update_records()
+        site.generate_records_table()
+    else:
+        site.generate_table()
+    site.post_process_outputs()
+
+
+def cmd_stats(site, args):
+    """Print statistics from the database"""
+
+    if not database_ready(site, [SITES[args.site][0]]):
+        return False
+    for key, value in site.database_stats().items():
+        print(f'{key}: {value}')
+
+
+def cmd_upload(site, args):
+    """Upload the outputs to the ftp server"""
+
+    return site.upload_to_ftp(html=not args.no_html, jpg=not args.no_jpg, gpx=not args.no_gpx, force=args.force)
+
+
+def cmd_export(site, args):
+    """Export the events, stamps and simplified traces to GeoJSONSeq, KML or FlatGeobuf files"""
+
+    load_data(site, args.download)
+    site.update_database()
+    site.export_data(formats=args.format or site.export_formats or ['geojsonseq', 'kml'])
+
+
+def cmd_query(site, args):
+    """Run a sql query or a spatial query on the database"""
+
+    if not (args.near or args.bbox or args.sql):
+        logger.error('Nothing to query: give a sql query, --near or --bbox')
+        return False
+
+    # the map table, and the spatial index (same name with an _rtree suffix) for spatial queries
+    table = SITES[args.site][0]
+    if not database_ready(site, [table, f'{table}_rtree'] if args.near or args.bbox else [table]):
+        return False
+
+    if args.near:
+        lat, lon, radius_km = args.near
+        features = site.features_within(lat, lon, radius_km, kinds=args.kind)
+    elif args.bbox:
+        features = site.features_in_bbox(*args.bbox, kinds=args.kind)
+    else:
+        site.search_database(args.sql)
+        return
+
+    for feature in features:
+        distance = f" {feature['distance_km']} km" if 'distance_km' in feature else ''
+        print(f"{feature['kind']:<7}{feature['date']:<12}{feature['label']}{distance}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build and publish the run map and camino map')
+    parser.add_argument('--site', choices=list(SITES), default='run', help='map to work on')
+    parser.add_argument('--settings', help='json settings file (default depends on the site)')
+    parser.add_argument('--verbose', action='store_true', help='show debug logs')
+    parser.add_argument('--profile', help='write a profile report (.json or .trace.json)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('fetch', help=cmd_fetch.__doc__).set_defaults(func=cmd_fetch)
+
+    sub = subparsers.add_parser('sync', help=cmd_sync.__doc__)
+    sub.add_argument('--download', action='store_true', help='download the spreadsheet first')
+    sub.add_argument('--rebuild', action='store_true', help='drop and rebuild the database table')
+    sub.set_defaults(func=cmd_sync)
+
+    sub = subparsers.add_parser('build', help=cmd_build.__doc__)
+    sub.add_argument('--download', action='store_true', help='download the spreadsheets first')
+    sub.set_defaults(func=cmd_build)
+
+    sub = subparsers.add_parser('table', help=cmd_table.__doc__)
+    sub.add_argument('--download', action='store_true', help='download the spreadsheet first')
+    sub.set_defaults(func=cmd_table)
+
+    subparsers.add_parser('stats', help=cmd_stats.__doc__).set_defaults(func=cmd_stats)
+
+    sub = subparsers.add_parser('upload', help=cmd_upload.__doc__)
+    sub.add_argument('--no-html', action='store_true', help='skip html/css files')
+    sub.add_argument('--no-jpg', action='store_true', help='skip jpg files')
+    sub.add_argument('--no-gpx', action='store_true', help='skip gpx files')
+    sub.add_argument('--force', action='store_true', help='upload files already on the server')
+    sub.set_defaults(func=cmd_upload)
+
+    sub = subparsers.add_parser('export', help=cmd_export.__doc__)
+    sub.add_argument('--download', action='store_true', help='download the spreadsheets first')
+    sub.add_argument('--format', action='append', choices=['geojsonseq', 'kml', 'flatgeobuf'],
+                     help='export format (default geojsonseq and kml), files are written to export_folder')
+    sub.set_defaults(func=cmd_export)
+
+    sub = subparsers.add_parser('query', help=cmd_query.__doc__)
+    sub.add_argument('sql', nargs='?', help='sql query, tables are run_map and camino_map')
+    sub.add_argument('--near', nargs=3, type=float, metavar=('LAT', 'LON', 'KM'), help='features within KM of a point')
+    sub.add_argument('--bbox', nargs=4, type=float, metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                     help='features intersecting a bounding box')
+    sub.add_argument('--kind', action='append', help='restrict spatial queries to a feature kind (event, stage, stamp, trace)')
+    sub.set_defaults(func=cmd_query)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+
+    site_class = load_site_class(args.site)
+    site = site_class(args.settings or SITES[args.site][2])
+
+    result = args.func(site, args)
+
+    if args.profile:
+        site.write_profile_report(args.profile)
+    site.close_database()
+
+    return 1 if result is False else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
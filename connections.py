@@ -0,0 +1,219 @@
+import os
+import logging
+import threading
+import http.client
+from ftplib import FTP, all_errors
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, urljoin
+
+logger = logging.getLogger(__name__)
+
+# redirects followed by a request (google sheets exports redirect to googleusercontent.com)
+MAX_REDIRECTS = 5
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+
+class HttpClient:
+    """Minimal http client keeping one keep-alive connection per host open between requests
+
+    Downloads of several spreadsheets from the same hosts reuse the tcp and tls sessions instead
+    of starting a curl process and a new connection for each file. Safe to share between threads.
+    """
+
+    def __init__(self, timeout=60):
+        """Initialise the client
+
+        Args:
+            timeout (float): connection and read timeout in seconds
+        """
+
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def acquire(self, scheme, host):
+        """Idle connection to a host, or a new one"""
+
+        with self.lock:
+            connections = self.idle.get((scheme, host))
+            if connections:
+                return connections.pop(), True
+
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return connection_class(host, timeout=self.timeout), False
+
+    def release(self, scheme, host, connection):
+        """Keep a connection open for the next request to the same host"""
+
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(connection)
+
+    def request(self, url):
+        """Send a GET request on a pooled connection
+
+        Args:
+            url (string): http or https url
+
+        Return:
+            (tuple): response status, headers and body
+        """
+
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        connection, reused = self.acquire(parts.scheme, parts.netloc)
+        try:
+            connection.request('GET', path, headers={'User-Agent': 'run_map', 'Connection': 'keep-alive'})
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if not reused:
+                raise
+            # the server closed the idle connection, retry once on a new one
+            connection, _ = self.acquire(parts.scheme, parts.netloc)
+            connection.request('GET', path, headers={'User-Agent': 'run_map', 'Connection': 'keep-alive'})
+            response = connection.getresponse()
+            body = response.read()
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(parts.scheme, parts.netloc, connection)
+        return response.status, response.headers, body
+
+    def get(self, url):
+        """Content of an url, following redirects
+
+        Return:
+            (bytes): response body
+
+        Raises:
+            urllib.error.HTTPError: the server did not answer 200, or too many redirects
+        """
+
+        for _ in range(MAX_REDIRECTS + 1):
+            status, headers, body = self.request(url)
+            if status in REDIRECT_STATUS and headers.get('Location'):
+                url = urljoin(url, headers['Location'])
+                continue
+            if status != 200:
+                raise HTTPError(url, status, f'HTTP error {status}', headers, None)
+            return body
+        raise HTTPError(url, status, 'Too many redirects', headers, None)
+
+    def download(self, url, path):
+        """Download an url to a file, replaced only once the download is complete
+
+        Return:
+            (bool): True if the file was downloaded
+        """
+
+        try:
+            body = self.get(url)
+        except (http.client.HTTPException, OSError) as e:
+            logger.warning(f'Error downloading {url}: {e}')
+            return False
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        return True
+
+    def close(self):
+        """Close the idle connections"""
+
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
+class FtpPool:
+    """Pool of logged in ftp sessions shared by the uploads of several sites
+
+    A released session goes back to the pool and is handed to the next upload to the same server
+    and user, back in its login directory, saving the connection and login round trips.
+    """
+
+    def __init__(self, factory=FTP):
+        """Initialise the pool
+
+        Args:
+            factory (callable): creates an ftp session from a server address, ftplib.FTP by default
+        """
+
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.sessions = {}
+
+    def acquire(self, address, user, pwd):
+        """Logged in ftp session in its login directory
+
+        Args:
+            address (string): ftp server address
+            user (string): ftp user
+            pwd (string): ftp password
+
+        Return:
+            (ftplib.FTP): session to give back with release
+        """
+
+        key = (address, user)
+        while True:
+            with self.lock:
+                sessions = self.idle.get(key)
+                if not sessions:
+                    break
+                ftp = sessions.pop()
+
+            try:
+                # check the session did not time out
+                ftp.voidcmd('NOOP')
+                ftp.cwd(self.sessions[ftp][1])
+                return ftp
+            except all_errors:
+                self.discard(ftp)
+
+        ftp = self.factory(address)
+        ftp.login(user=user, passwd=pwd, acct='')
+        with self.lock:
+            self.sessions[ftp] = (key, ftp.pwd())
+        return ftp
+
+    def release(self, ftp):
+        """Give a session back to the pool"""
+
+        with self.lock:
+            key, _ = self.sessions[ftp]
+            self.idle.setdefault(key, []).append(ftp)
+
+    def discard(self, ftp):
+        """Close a session and forget it"""
+
+        with self.lock:
+            self.sessions.pop(ftp, None)
+        try:
+            ftp.close()
+        except all_errors:
+            pass
+
+    def close_all(self):
+        """Quit the idle sessions"""
+
+        with self.lock:
+            idle = [ftp for sessions in self.idle.values() for ftp in sessions]
+            self.idle = {}
+
+        for ftp in idle:
+            try:
+                ftp.quit()
+            except all_errors:
+                pass
+            self.discard(ftp)
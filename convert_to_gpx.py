@@ -1,2 +1,54 @@
-# command line:
-# tcx2gpx -d ./tcx -o ./gpx
\ No newline at end of file
+#!/usr/bin/env python3
+"""
+Batch import of watch exports (tcx, fit) and gpx files into the trace store.
+
+No conversion to gpx is needed anymore: the Gpx column of the spreadsheets can name .tcx and .fit
+files of the gpx folder directly, they are read by importer.py when the trace store is updated.
+This script reads a whole folder in parallel ahead of a build, e.g. after copying a season of
+watch exports, so that the next build finds all traces already stored.
+
+Usage:
+    python convert_to_gpx.py ./tcx
+    python convert_to_gpx.py ./gpx --trace-store cache/camino_map_traces --workers 4
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import traces
+from trace_store import TraceStore
+
+logger = logging.getLogger(__name__)
+
+CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import tcx, fit and gpx files into the trace store')
+    parser.add_argument('folder', help='folder of trace files')
+    parser.add_argument('--trace-store', default='cache/run_map_traces',
+                        help='trace store folder, relative paths are resolved against the script folder like the trace_store setting')
+    parser.add_argument('--workers', type=int, help='worker processes (default: number of cpus)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    paths = sorted(os.path.join(args.folder, name) for name in os.listdir(args.folder)
+                   if name.lower().endswith(traces.TRACK_EXTENSIONS))
+    if not paths:
+        logger.error(f'No trace file in {args.folder}')
+        return 1
+
+    # same folder as RunMap and CaminoMap, which join the trace_store setting to their own folder
+    store = TraceStore(os.path.join(CURRENT_FOLDER, args.trace_store))
+    start = time.perf_counter()
+    read = store.update(paths, workers=args.workers)
+    points = sum(len(store.points(path)) for path in paths if path in store)
+    logger.info(f'{read} of {len(paths)} files imported in {time.perf_counter() - start:.1f}s, '
+                f'{points} points, {len(store)} traces stored')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
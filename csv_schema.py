@@ -0,0 +1,192 @@
+import os
+import json
+import logging
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# column name -> (kind, required, default of an empty optional cell)
+# kinds: 'str', 'float' (comma or dot decimal separator), 'date' (dd.mm.yyyy) and 'time' (h:mm:ss or mm:ss)
+RUN_EVENTS = {
+    'Date': ('date', True, ''),
+    'Race': ('str', True, ''),
+    'Location': ('str', False, ''),
+    'Latitude': ('float', True, None),
+    'Longitude': ('float', True, None),
+    'Type': ('str', False, ''),
+    'Notes': ('str', False, ''),
+    'Distance': ('float', False, 0.0),
+    'D+': ('float', False, 0.0),
+    'Time': ('time', False, ''),
+    'Link': ('str', False, ''),
+    'Post': ('str', False, ''),
+    'Color': ('str', False, ''),
+    'Jpg': ('str', False, ''),
+    'Gpx': ('str', False, ''),
+}
+
+CAMINO_STAGES = {
+    'Date': ('date', True, ''),
+    'Title': ('str', True, ''),
+    'Camino': ('str', False, ''),
+    'Start': ('str', False, ''),
+    'Start Lat': ('float', True, None),
+    'Start Lon': ('float', True, None),
+    'End': ('str', False, ''),
+    'End Lat': ('float', False, None),
+    'End Lon': ('float', False, None),
+    'Distance': ('float', False, 0.0),
+    'D+': ('float', False, 0.0),
+    'Time': ('time', False, ''),
+    'Notes': ('str', False, ''),
+    'Color': ('str', False, ''),
+    'Post': ('str', False, ''),
+    'Jpg': ('str', False, ''),
+    'Gpx': ('str', False, ''),
+}
+
+CAMINO_STAMPS = {
+    'Date': ('date', True, ''),
+    'Place': ('str', True, ''),
+    'Location': ('str', False, ''),
+    'Camino': ('str', False, ''),
+    'Lat': ('float', True, None),
+    'Lon': ('float', True, None),
+    'Note': ('str', False, ''),
+    'Link': ('str', False, ''),
+    'Jpg': ('str', False, ''),
+}
+
+DATE_FORMAT = '%d.%m.%Y'
+TIME_PATTERN = r'\d+:\d{1,2}(:\d{1,2})?'
+
+
+class ValidationReport:
+    """Problems found in a csv file: rows dropped and cells replaced by their default"""
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.rows = 0
+        self.issues = []
+
+    def add(self, lines, column, values, message, dropped):
+        """Record the same problem on several rows
+
+        Args:
+            lines (iterable): spreadsheet line numbers (header is line 1)
+            column (string): column name
+            values (iterable): cell values
+            message (string): problem description
+            dropped (bool): the rows are left out of the data
+        """
+
+        for line, value in zip(lines, values):
+            self.issues.append({'line': int(line), 'column': column, 'value': value, 'message': message, 'dropped': dropped})
+
+    @property
+    def dropped_lines(self):
+        return sorted({issue['line'] for issue in self.issues if issue['dropped']})
+
+    def log(self):
+        """Log every issue as a warning and a summary"""
+
+        name = os.path.basename(self.csv_path)
+        for issue in self.issues:
+            action = 'row skipped' if issue['dropped'] else 'default used'
+            logger.warning(f"{name} line {issue['line']}, {issue['column']} '{issue['value']}': {issue['message']} ({action})")
+        logger.info(f'{name}: {self.rows} rows read, {len(self.dropped_lines)} skipped, {len(self.issues)} issues')
+
+    def write(self, path):
+        """Write the report as json"""
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        report = {'csv': self.csv_path, 'rows': self.rows, 'dropped_lines': self.dropped_lines, 'issues': self.issues}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def read_csv(path, schema):
+    """Read a spreadsheet csv export with a schema
+
+    All cells are read as text (pyarrow engine if installed), then every column is converted
+    and validated as a whole. Rows with a missing or invalid required cell are dropped, invalid
+    optional cells are replaced by the column default; both are listed in the report.
+
+    Args:
+        path (string): csv file
+        schema (dict): column name -> (kind, required, default), see RUN_EVENTS
+
+    Return:
+        (tuple): pandas DataFrame of the valid rows (original date and time strings, floats for
+                 the float columns) and the ValidationReport
+
+    Raises:
+        ValueError: a required column is missing from the file
+    """
+
+    engine = 'pyarrow' if pyarrow else 'c'
+    data = pd.read_csv(path, dtype=str, keep_default_na=False, engine=engine)
+    data.columns = [str(column).strip() for column in data.columns]
+
+    report = ValidationReport(path)
+    report.rows = len(data)
+    lines = pd.Series(data.index + 2, index=data.index)
+    valid = pd.Series(True, index=data.index)
+
+    for column, (kind, required, default) in schema.items():
+        if column not in data.columns:
+            if required:
+                raise ValueError(f'Column {column} missing from {path}')
+            logger.warning(f'Column {column} missing from {os.path.basename(path)}, using {default!r}')
+            data[column] = default
+            continue
+
+        text = data[column].str.strip()
+        empty = text == ''
+
+        if kind == 'float':
+            values = pd.to_numeric(text.str.replace(',', '.', regex=False), errors='coerce')
+            invalid = values.isna() & ~empty
+            data[column] = values.astype(object).where(~values.isna(), default)
+        elif kind == 'date':
+            invalid = pd.to_datetime(text, format=DATE_FORMAT, errors='coerce').isna() & ~empty
+            data[column] = text
+        elif kind == 'time':
+            invalid = ~text.str.fullmatch(TIME_PATTERN) & ~empty
+            data[column] = text.where(~invalid, default)
+        else:
+            invalid = pd.Series(False, index=data.index)
+            data[column] = text
+
+        if invalid.any():
+            report.add(lines[invalid], column, text[invalid], f'not a valid {kind}', required)
+        if required:
+            if empty.any():
+                report.add(lines[empty], column, text[empty], 'missing value', True)
+            valid &= ~invalid & ~empty
+
+    return data[valid].reset_index(drop=True), report
+
+
+def report_path(folder, csv_path):
+    """Validation report file of a csv file in the reports folder"""
+
+    return os.path.join(folder, os.path.splitext(os.path.basename(csv_path))[0] + '_report.json')
+
+
+def format_dates(dates):
+    """'Day FullMonthName Year' of valid dd.mm.yyyy dates"""
+
+    parsed = pd.to_datetime(pd.Series(dates, dtype=str), format=DATE_FORMAT)
+    return list(parsed.dt.day.astype(str) + ' ' + parsed.dt.month_name() + ' ' + parsed.dt.year.astype(str))
+
+
+def format_times(times):
+    """'Xh Ymin Zsec' of h:mm:ss times, other values unchanged"""
+
+    return list(pd.Series(times, dtype=str).str.replace(r'^(\d+):(\d+):(\d+)$', r'\1h \2min \3sec', regex=True))
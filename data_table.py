@@ -0,0 +1,122 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# marker of the static rows in the table templates
+TABLE_MARKER = '<!--InsertNewEvent-->'
+
+# id of the filter bar inserted above the table
+FILTERS_ID = 'tg-filters'
+
+
+def iso_date(date):
+    """Sortable 'yyyy-mm-dd' date from a 'dd.mm.yyyy' spreadsheet date"""
+
+    day, month, year = (int(d) for d in date.split('.'))
+    return f'{year:04d}-{month:02d}-{day:02d}'
+
+
+def duration_seconds(time):
+    """Seconds of a 'h:mm:ss' or 'mm:ss' duration, None if the cell is not a duration"""
+
+    try:
+        seconds = 0
+        for part in str(time).split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except ValueError:
+        return None
+
+
+def date_cell(date, post):
+    """Date cell of a table row, with the link to the blog post if any"""
+
+    if post:
+        return f'{date}<br /><a href="{post}" target="_blank"><i><u>Review</u></i></a>'
+    return date
+
+
+def write_rows(path, rows, keys):
+    """Write the table rows as compact json
+
+    Args:
+        path (string): json file
+        rows (list): inner html of the cells of every row
+        keys (dict): field -> value of every row, used to sort and filter the rows
+
+    Return:
+        (int): size of the json file in bytes
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'rows': rows, 'keys': keys}, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def render_page(template, data_url, script_url, options):
+    """Table page drawing the rows of a json file instead of static rows
+
+    The header row of the template is kept, the filter bar is inserted above the table and the
+    renderer script at the end of the body.
+
+    Args:
+        template (string): html contents of the table template
+        data_url (string): url of the rows json, relative to the page
+        script_url (string): url of data_table.js, relative to the page
+        options (dict): renderer options: cell classes, sort field of every column, filters and
+                        year separator class
+
+    Return:
+        (string): html contents, None if the template has no table marker, table or body
+    """
+
+    if TABLE_MARKER not in template or '<table' not in template or '</body>' not in template:
+        return None
+
+    options = dict(options, url=data_url, filtersElement=FILTERS_ID)
+    # a '</' in the options would close the script element
+    options_json = json.dumps(options, ensure_ascii=False).replace('</', '<\\/')
+    script = (f'<script src="{script_url}"></script>\n'
+              f"<script>DataTable.render(document.querySelector('table'), {options_json});</script>\n")
+
+    html = template.replace(TABLE_MARKER, '')
+    table_start = html.index('<table')
+    html = html[:table_start] + f'<div id="{FILTERS_ID}" class="{FILTERS_ID}"></div>\n    ' + html[table_start:]
+    body_end = html.rindex('</body>')
+    return html[:body_end] + script + html[body_end:]
+
+
+def write_table(template, html_path, json_path, script_path, rows, keys, options):
+    """Write the rows json and the table page of the virtualized table
+
+    The json and the script are published in the folder of the page.
+
+    Args:
+        template (string): html contents of the table template
+        html_path (string): table page
+        json_path (string): rows json file
+        script_path (string): data_table.js file
+        rows (list): see write_rows
+        keys (dict): see write_rows, with at least 'year' (year separators)
+        options (dict): see render_page
+
+    Return:
+        (bool): True if the table was written
+    """
+
+    html = render_page(template, os.path.basename(json_path), os.path.basename(script_path), options)
+    if html is None:
+        logger.warning('html marker, table or body not found in template file. Skipping this step.')
+        return False
+
+    size = write_rows(json_path, rows, keys)
+    with open(html_path, 'w', encoding='utf-8') as output_file:
+        output_file.write(html)
+
+    logger.debug(f'Table rows: {len(rows)} rows, {size} bytes')
+    return True
@@ -0,0 +1,254 @@
+import os
+import math
+import json
+import logging
+import numpy as np
+from xml.sax.saxutils import escape
+
+try:
+    import fiona
+except ImportError:
+    fiona = None
+
+logger = logging.getLogger(__name__)
+
+# export format -> file extension
+FORMATS = {'geojsonseq': '.geojsonl', 'kml': '.kml', 'flatgeobuf': '.fgb'}
+
+# properties of every exported feature with their FlatGeobuf attribute type
+PROPERTIES = {
+    'kind': 'str',
+    'date': 'str',
+    'name': 'str',
+    'detail': 'str',
+    'category': 'str',
+    'dist': 'float',
+    'dplus': 'float',
+    'time': 'str',
+    'link': 'str',
+}
+
+METERS_PER_DEGREE = 111320.0
+
+
+def simplify(lat, lon, tolerance_m):
+    """Douglas-Peucker simplification of a trace
+
+    Points are projected on a local equirectangular plane (meters). The segments of a recursion
+    level are all split in one numpy pass: the distance of every remaining point to the chord of
+    its segment, the farthest point of each segment being kept if out of tolerance.
+
+    Args:
+        lat (np.ndarray): latitudes
+        lon (np.ndarray): longitudes
+        tolerance_m (float): maximum distance in meters between the trace and its simplification
+
+    Return:
+        (np.ndarray): sorted indices of the points kept, first and last included
+    """
+
+    count = len(lat)
+    if count < 3 or tolerance_m <= 0:
+        return np.arange(count)
+
+    lat = np.asarray(lat, dtype=np.float64)
+    y = lat * METERS_PER_DEGREE
+    x = np.asarray(lon, dtype=np.float64) * METERS_PER_DEGREE * math.cos(math.radians(float(lat.mean())))
+
+    keep = np.zeros(count, dtype=bool)
+    keep[[0, -1]] = True
+    # points of the segments still to split
+    pending = np.ones(count, dtype=bool)
+
+    while True:
+        kept = np.flatnonzero(keep)
+        candidates = np.flatnonzero(pending & ~keep)
+        if not len(candidates):
+            break
+
+        # segment of every candidate, between two kept points
+        segment = np.searchsorted(kept, candidates) - 1
+        first, last = kept[segment], kept[segment + 1]
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[candidates] - x[first], y[candidates] - y[first]
+        length = np.hypot(dx, dy)
+        # closed segment (loop course): distance to the start point
+        distances = np.where(length > 0, np.abs(px * dy - py * dx) / np.where(length > 0, length, 1), np.hypot(px, py))
+
+        # farthest candidate of every segment
+        order = np.lexsort((-distances, segment))
+        segments, firsts = np.unique(segment[order], return_index=True)
+        farthest = order[firsts]
+        split = distances[farthest] > tolerance_m
+
+        keep[candidates[farthest[split]]] = True
+        pending[candidates[np.isin(segment, segments[~split])]] = False
+
+    return np.flatnonzero(keep)
+
+
+def feature_properties(kind, date, name, detail='', category='', dist=None, dplus=None, time='', link=''):
+    """Properties of an exported feature, see PROPERTIES"""
+
+    return {
+        'kind': kind,
+        'date': date,
+        'name': str(name),
+        'detail': str(detail),
+        'category': str(category),
+        'dist': float(dist) if dist not in (None, '') else None,
+        'dplus': float(dplus) if dplus not in (None, '') else None,
+        'time': str(time),
+        'link': str(link),
+    }
+
+
+def point_feature(lat, lon, properties):
+    """GeoJSON point feature, None without valid coordinates"""
+
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lon)):
+        return None
+    return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]},
+            'properties': properties}
+
+
+def trace_feature(track, tolerance_m, properties):
+    """GeoJSON line feature of a simplified trace
+
+    Args:
+        track (dict): trace arrays lat and lon, see trace_store.TraceStore.track
+        tolerance_m (float): simplification tolerance in meters, see simplify
+        properties (dict): feature properties
+
+    Return:
+        (dict): feature, None if the trace has less than two points
+    """
+
+    kept = simplify(track['lat'], track['lon'], tolerance_m)
+    if len(kept) < 2:
+        return None
+
+    lat = track['lat'][kept].astype(np.float64).round(6)
+    lon = track['lon'][kept].astype(np.float64).round(6)
+    return {'type': 'Feature', 'geometry': {'type': 'LineString', 'coordinates': np.column_stack((lon, lat)).tolist()},
+            'properties': properties}
+
+
+class GeoJSONSeqWriter:
+    """Line-delimited GeoJSON: one feature per line"""
+
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, feature):
+        self.file.write(json.dumps(feature, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class KMLWriter:
+    """KML document with one placemark per feature, written as the features come"""
+
+    def __init__(self, path, name):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                        '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                        f'<Document><name>{escape(name)}</name>\n')
+
+    def write(self, feature):
+        properties = feature['properties']
+        geometry = feature['geometry']
+        coordinates = geometry['coordinates']
+
+        if geometry['type'] == 'Point':
+            shape = f'<Point><coordinates>{coordinates[0]},{coordinates[1]}</coordinates></Point>'
+        else:
+            shape = f"<LineString><coordinates>{' '.join(f'{lon},{lat}' for lon, lat in coordinates)}</coordinates></LineString>"
+
+        data = ''.join(f'<Data name="{key}"><value>{escape(str(value))}</value></Data>'
+                       for key, value in properties.items() if value not in (None, ''))
+        self.file.write(f"<Placemark><name>{escape(properties['name'])}</name>"
+                        f"<description>{escape(properties['detail'])}</description>"
+                        f'<ExtendedData>{data}</ExtendedData>{shape}</Placemark>\n')
+
+    def close(self):
+        self.file.write('</Document>\n</kml>\n')
+        self.file.close()
+
+
+class FlatGeobufWriter:
+    """FlatGeobuf file with a packed Hilbert R-tree, written by GDAL through fiona
+
+    The features are passed to GDAL one by one, which builds the spatial index when the file is
+    closed.
+    """
+
+    def __init__(self, path):
+        schema = {'geometry': 'Unknown', 'properties': PROPERTIES}
+        self.collection = fiona.open(path, 'w', driver='FlatGeobuf', schema=schema, crs='EPSG:4326', SPATIAL_INDEX='YES')
+
+    def write(self, feature):
+        self.collection.write(feature)
+
+    def close(self):
+        self.collection.close()
+
+
+def export_features(features, paths, name='export'):
+    """Write features to several formats in a single pass
+
+    The features are written as they are generated, nothing is kept in memory. Each file is
+    written next to its final path and moved in place once complete.
+
+    Args:
+        features (iterable): GeoJSON features (a generator), None items are skipped
+        paths (dict): format (see FORMATS) -> output file
+        name (string): document name (KML)
+
+    Return:
+        (int): number of features written
+    """
+
+    if 'flatgeobuf' in paths and fiona is None:
+        logger.warning('fiona is not installed, skipping the FlatGeobuf export')
+        paths = {fmt: path for fmt, path in paths.items() if fmt != 'flatgeobuf'}
+    if not paths:
+        return 0
+
+    writers = {}
+    for fmt, path in paths.items():
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # the extension is kept on the temporary file, GDAL picks the driver from it
+        tmp_path = '.tmp'.join(os.path.splitext(path)) if fmt == 'flatgeobuf' else path + '.tmp'
+        if fmt == 'geojsonseq':
+            writers[fmt] = (GeoJSONSeqWriter(tmp_path), tmp_path)
+        elif fmt == 'kml':
+            writers[fmt] = (KMLWriter(tmp_path, name), tmp_path)
+        elif fmt == 'flatgeobuf':
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            writers[fmt] = (FlatGeobufWriter(tmp_path), tmp_path)
+        else:
+            raise ValueError(f'Unknown export format {fmt}, expected one of {list(FORMATS)}')
+
+    count = 0
+    try:
+        for feature in features:
+            if feature is None:
+                continue
+            for writer, _ in writers.values():
+                writer.write(feature)
+            count += 1
+    finally:
+        for writer, _ in writers.values():
+            writer.close()
+
+    for fmt, (_, tmp_path) in writers.items():
+        os.replace(tmp_path, paths[fmt])
+        logger.debug(f'Exported {count} features to {paths[fmt]} ({os.path.getsize(paths[fmt])} bytes)')
+    return count
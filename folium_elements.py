@@ -0,0 +1,556 @@
+"""
+Custom folium elements rendering several map features with a single Leaflet layer and their
+data as json, instead of one folium object (and its javascript) per feature.
+"""
+
+import re
+import json
+from string import Formatter
+from branca.element import MacroElement
+from jinja2 import Template
+
+# javascript helper creating the popup iframe of a feature from its raw html
+IFRAME_JS = """
+    function {{ this.get_name() }}_iframe(html) {
+        var iframe = document.createElement('iframe');
+        iframe.srcdoc = html;
+        iframe.width = {{ this.popup_width }};
+        iframe.height = {{ this.popup_height }};
+        iframe.style.border = 'none';
+        return iframe;
+    }
+"""
+
+
+class StitchedRoute(MacroElement):
+    """Stages of a route drawn as one multi-part polyline, with per-stage popups and tooltips
+
+    A click or hover on the line looks up the closest vertex, then the stage it belongs to in the
+    stage index returned by routes.stitch_route, and shows the popup or tooltip of that stage.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            """ + IFRAME_JS + """
+            var {{ this.get_name() }} = L.polyline(
+                {{ this.script_json(this.parts) }},
+                {{ this.script_json(this.options) }}
+            ).addTo({{ this._parent.get_name() }});
+
+            {{ this.get_name() }}.stages = {{ this.script_json(this.stage_index) }};
+            {{ this.get_name() }}.popups = {{ this.script_json(this.popups) }};
+            {{ this.get_name() }}.tooltips = {{ this.script_json(this.tooltips) }};
+
+            {{ this.get_name() }}.stageAt = function(latlng) {
+                var parts = this.getLatLngs(), scale = Math.cos(latlng.lat * Math.PI / 180);
+                var best = Infinity, bestPart = 0, bestVertex = 0;
+                for (var p = 0; p < parts.length; p++) {
+                    for (var v = 0; v < parts[p].length; v++) {
+                        var dlat = parts[p][v].lat - latlng.lat, dlng = (parts[p][v].lng - latlng.lng) * scale;
+                        var d = dlat * dlat + dlng * dlng;
+                        if (d < best) { best = d; bestPart = p; bestVertex = v; }
+                    }
+                }
+                var stages = this.stages[bestPart], stage = stages[0][1];
+                for (var i = 0; i < stages.length && stages[i][0] <= bestVertex; i++) { stage = stages[i][1]; }
+                return stage;
+            };
+
+            {{ this.get_name() }}.bindTooltip('', {sticky: true});
+            {{ this.get_name() }}.on('mousemove', function(e) {
+                this.setTooltipContent(this.tooltips[this.stageAt(e.latlng)]);
+            });
+            {{ this.get_name() }}.on('click', function(e) {
+                var html = this.popups[this.stageAt(e.latlng)];
+                L.popup({maxWidth: {{ this.popup_width + 20 }}})
+                    .setLatLng(e.latlng)
+                    .setContent({{ this.get_name() }}_iframe(html))
+                    .openOn(this._map);
+            });
+        {% endmacro %}
+    """)
+
+    def __init__(self, parts, stage_index, popups, tooltips, popup_width, popup_height,
+                 color='blue', weight=5, opacity=0.85):
+        """Initialise the route
+
+        Args:
+            parts (list): lists of [lat, lon] of every continuous part of the route
+            stage_index (list): for every part, list of [first vertex, stage number] pairs
+            popups (list): popup html of every stage, shown in an iframe
+            tooltips (list): tooltip text of every stage
+            popup_width (int): popup iframe width in pixels
+            popup_height (int): popup iframe height in pixels
+            color (string): line color
+            weight (float): line weight in pixels
+            opacity (float): line opacity
+        """
+
+        super().__init__()
+        self._name = 'StitchedRoute'
+        self.parts = parts
+        self.stage_index = stage_index
+        self.popups = popups
+        self.tooltips = tooltips
+        self.popup_width = int(popup_width)
+        self.popup_height = int(popup_height)
+        self.options = {'color': color, 'weight': weight, 'opacity': opacity}
+        self.script_json = script_json
+
+
+# jinja delimiters, branca compiles the rendered scripts as templates again
+JINJA_DELIMITERS = re.compile(r'\{(?=[{%#])')
+
+
+def script_json(value):
+    """Json of a value embedded in a script, escaping '</' and the jinja delimiters in strings"""
+
+    return JINJA_DELIMITERS.sub(r'\\u007b', json.dumps(value, ensure_ascii=False)).replace('</', '<\\/')
+
+
+def awesome_icon(color, icon='info-sign', icon_color='white', prefix='glyphicon'):
+    """Icon options of a BulkMarkers marker, same as folium.Icon"""
+
+    return {'type': 'awesome', 'options': {'extraClasses': 'fa-rotate-0', 'icon': icon, 'iconColor': icon_color,
+                                           'markerColor': color, 'prefix': prefix}}
+
+
+def custom_icon(url, size=(32, 32), anchor=(16, 16), popup_anchor=(0, -16)):
+    """Icon options of a BulkMarkers marker, same as folium.CustomIcon"""
+
+    return {'type': 'custom', 'options': {'iconUrl': url, 'iconSize': list(size), 'iconAnchor': list(anchor),
+                                          'popupAnchor': list(popup_anchor)}}
+
+
+class BulkMarkers(MacroElement):
+    """Markers of a feature group (or of the map) created by one javascript loop over a json array
+
+    Every distinct icon is created once and shared by its markers. Popups are stored as the index
+    of their html template and the values of its fields, the popup iframe is formatted when the
+    popup opens. Replaces a folium Marker, Icon, Popup and IFrame (and their javascript) per marker.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function() {
+                """ + IFRAME_JS + """
+                var group = {{ this._parent.get_name() }};
+                var icons = {{ this.script_json(this.icons) }}.map(function(icon) {
+                    return icon.type === 'custom' ? L.icon(icon.options) : L.AwesomeMarkers.icon(icon.options);
+                });
+                var templates = {{ this.script_json(this.templates) }};
+
+                // str.format of the python templates: braces escaped by doubling and named fields
+                function format(template, values) {
+                    return template.html.replace(/\\{\\{|\\}\\}|\\{(\\w+)\\}/g, function(match, name) {
+                        return name ? values[template.fields.indexOf(name)] : match.charAt(0);
+                    });
+                }
+
+                {{ this.script_json(this.markers) }}.forEach(function(m) {
+                    var marker = L.marker([m[0], m[1]], m[2] === null ? {} : {icon: icons[m[2]]});
+                    if (m[3]) { marker.bindTooltip(m[3], {sticky: true}); }
+                    if (m[4] !== null) {
+                        marker.bindPopup(function() {
+                            return {{ this.get_name() }}_iframe(format(templates[m[4]], m[5]));
+                        }, {maxWidth: {{ this.popup_width + 20 }}});
+                    }
+                    group.addLayer(marker);
+                });
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, popup_width, popup_height):
+        """Initialise the marker layer
+
+        Args:
+            popup_width (int): popup iframe width in pixels
+            popup_height (int): popup iframe height in pixels
+        """
+
+        super().__init__()
+        self._name = 'BulkMarkers'
+        self.script_json = script_json
+        self.popup_width = int(popup_width)
+        self.popup_height = int(popup_height)
+        self.icons = []
+        self.templates = []
+        self.markers = []
+        self.icon_index = {}
+        self.template_index = {}
+
+    def add_marker(self, location, icon=None, tooltip=None, template=None, fields=None):
+        """Add a marker
+
+        Args:
+            location (list): [lat, lon] of the marker
+            icon (dict): icon options, see awesome_icon and custom_icon, leaflet default icon if None
+            tooltip (string): tooltip html
+            template (string): popup html template with str.format fields, no popup if None
+            fields (dict): values of the template fields
+        """
+
+        icon_id = None
+        if icon is not None:
+            key = repr(icon)
+            if key not in self.icon_index:
+                self.icon_index[key] = len(self.icons)
+                self.icons.append(icon)
+            icon_id = self.icon_index[key]
+
+        template_id, values = None, []
+        if template is not None:
+            if template not in self.template_index:
+                self.template_index[template] = len(self.templates)
+                self.templates.append(self.parse_template(template))
+            template_id = self.template_index[template]
+            entry = self.templates[template_id]
+            if entry['fields'] is None:
+                # template using format specs, formatted here as a template of its own
+                self.add_marker(location, icon, tooltip, template.format(**fields), {})
+                return
+            values = [str(fields[name]) for name in entry['fields']]
+
+        self.markers.append([float(location[0]), float(location[1]), icon_id, tooltip, template_id, values])
+
+    @staticmethod
+    def parse_template(template):
+        """Template entry with the names of its fields, None if it uses more than plain named fields"""
+
+        names = []
+        for _, name, spec, conversion in Formatter().parse(template):
+            if name is None:
+                continue
+            if not name.isidentifier() or spec or conversion:
+                return {'html': template, 'fields': None}
+            if name not in names:
+                names.append(name)
+        return {'html': template, 'fields': names}
+
+
+class ZoomBand(MacroElement):
+    """Shows a layer of a feature group (or of the map) only between two zoom levels
+
+    Added to the feature group holding the layer: the layer is added to the group when the map
+    zoom enters the band and removed when it leaves it, so only one band is drawn at a time.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function() {
+                var group = {{ this._parent.get_name() }}, layer = {{ this.layer.get_name() }};
+                function update() {
+                    var zoom = (group instanceof L.Map ? group : group._map).getZoom();
+                    if (zoom >= {{ this.min_zoom }}{% if this.max_zoom is not none %} && zoom <= {{ this.max_zoom }}{% endif %}) {
+                        if (!group.hasLayer(layer)) { group.addLayer(layer); }
+                    } else if (group.hasLayer(layer)) {
+                        group.removeLayer(layer);
+                    }
+                }
+                // events of the layers in the group bubble up with propagatedFrom set
+                function attach(e) {
+                    if (e && e.propagatedFrom) { return; }
+                    group._map.off('zoomend', update).on('zoomend', update);
+                    update();
+                }
+                if (group instanceof L.Map) {
+                    group.on('zoomend', update);
+                    update();
+                    return;
+                }
+                group.on('add', attach);
+                group.on('remove', function(e) {
+                    if (!e.propagatedFrom) { group._map.off('zoomend', update); }
+                });
+                if (group._map) { attach(); }
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, layer, min_zoom, max_zoom=None):
+        """Initialise the zoom band
+
+        Args:
+            layer (folium.map.Layer): layer of the parent feature group, created with show=False
+            min_zoom (int): lowest zoom showing the layer
+            max_zoom (int): highest zoom showing the layer, no limit if None
+        """
+
+        super().__init__()
+        self._name = 'ZoomBand'
+        self.layer = layer
+        self.min_zoom = int(min_zoom)
+        self.max_zoom = None if max_zoom is None else int(max_zoom)
+
+
+class SearchControl(MacroElement):
+    """Search box over the features of the map, using the index written by search_index.py
+
+    The index is fetched on the first focus of the search box. Query words are matched as
+    prefixes of the indexed words through the gram postings, then checked on the candidates.
+    Clicking a result (or pressing enter) zooms to the feature and opens its marker popup.
+    """
+
+    _template = Template("""
+        {% macro header(this, kwargs) %}
+            <style>
+                .map-search { background: white; padding: 4px; border-radius: 4px; box-shadow: 0 1px 5px rgba(0,0,0,0.4); }
+                .map-search input { width: 220px; padding: 4px; border: 1px solid #ccc; border-radius: 3px; }
+                .map-search ul { list-style: none; margin: 4px 0 0; padding: 0; max-height: 300px; overflow-y: auto; }
+                .map-search li { padding: 3px 4px; cursor: pointer; }
+                .map-search li:hover, .map-search li.active { background: #eee; }
+                .map-search small { color: #777; }
+            </style>
+        {% endmacro %}
+
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }}, index = null, loading = null, texts = {};
+
+                function normalize(text) {
+                    return String(text).normalize('NFKD').replace(/[\\u0300-\\u036f]/g, '').toLowerCase()
+                        .replace(/[^a-z0-9]+/g, ' ').trim();
+                }
+
+                function load() {
+                    if (!loading) {
+                        loading = fetch({{ this.index_url|tojson }}).then(function(response) {
+                            return response.json();
+                        }).then(function(data) { index = data; });
+                    }
+                    return loading;
+                }
+
+                // postings are delta-encoded, decoded once on first use
+                function postings(gram) {
+                    var list = index.grams[gram];
+                    if (!list) { return []; }
+                    if (!list.decoded) {
+                        for (var i = 1; i < list.length; i++) { list[i] += list[i - 1]; }
+                        list.decoded = true;
+                    }
+                    return list;
+                }
+
+                function intersect(a, b) {
+                    var result = [], i = 0, j = 0;
+                    while (i < a.length && j < b.length) {
+                        if (a[i] === b[j]) { result.push(a[i]); i++; j++; }
+                        else if (a[i] < b[j]) { i++; } else { j++; }
+                    }
+                    return result;
+                }
+
+                function grams(word) {
+                    var padded = ' ' + word, result = [padded.substr(0, 2)];
+                    for (var i = 0; i + 3 <= padded.length; i++) { result.push(padded.substr(i, 3)); }
+                    return result;
+                }
+
+                // normalized name and full text of a document, preceded by a space to match word starts
+                function docText(id) {
+                    if (!texts[id]) {
+                        texts[id] = [' ' + normalize(index.docs.name[id]), ' ' + normalize(index.docs.name[id] + ' ' + index.docs.detail[id])];
+                    }
+                    return texts[id];
+                }
+
+                function search(query) {
+                    var queryWords = normalize(query).split(' ').filter(Boolean), candidates = null;
+                    if (!queryWords.length) { return []; }
+                    queryWords.forEach(function(word) {
+                        grams(word).forEach(function(gram) {
+                            candidates = candidates === null ? postings(gram).slice() : intersect(candidates, postings(gram));
+                        });
+                    });
+                    // the grams of a word can come from different indexed words, check the prefixes
+                    var scored = [];
+                    candidates.forEach(function(id) {
+                        var text = docText(id);
+                        if (queryWords.every(function(word) { return text[1].indexOf(' ' + word) >= 0; })) {
+                            var inName = queryWords.every(function(word) { return text[0].indexOf(' ' + word) >= 0; });
+                            scored.push([inName ? 0 : 1, id]);
+                        }
+                    });
+                    scored.sort(function(a, b) { return a[0] - b[0] || a[1] - b[1]; });
+                    return scored.slice(0, {{ this.max_results }}).map(function(s) { return s[1]; });
+                }
+
+                function open(id) {
+                    var target = L.latLng(index.docs.lat[id], index.docs.lon[id]);
+                    map.setView(target, Math.max(map.getZoom(), {{ this.zoom }}));
+                    map.eachLayer(function(layer) {
+                        if (layer instanceof L.Marker && layer.getLatLng().equals(target, 1e-5) && layer.getPopup()) {
+                            layer.openPopup();
+                        }
+                    });
+                }
+
+                var control = L.control({position: {{ this.position|tojson }}});
+                control.onAdd = function() {
+                    var container = L.DomUtil.create('div', 'map-search');
+                    var input = L.DomUtil.create('input', '', container);
+                    var list = L.DomUtil.create('ul', '', container);
+                    var results = [];
+                    input.type = 'search';
+                    input.placeholder = {{ this.placeholder|tojson }};
+                    L.DomEvent.disableClickPropagation(container);
+                    L.DomEvent.disableScrollPropagation(container);
+
+                    function render() {
+                        list.innerHTML = '';
+                        results.forEach(function(id) {
+                            var item = L.DomUtil.create('li', '', list);
+                            item.textContent = index.docs.name[id] + ' ';
+                            L.DomUtil.create('small', '', item).textContent = index.docs.detail[id];
+                            item.onclick = function() { open(id); };
+                        });
+                    }
+
+                    input.addEventListener('focus', load);
+                    input.addEventListener('input', function() {
+                        load().then(function() { results = search(input.value); render(); });
+                    });
+                    input.addEventListener('keydown', function(e) {
+                        if (e.key === 'Enter' && results.length) { open(results[0]); }
+                        if (e.key === 'Escape') { input.value = ''; results = []; render(); }
+                    });
+                    return container;
+                };
+                control.addTo(map);
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, index_url, position='topleft', zoom=13, max_results=20, placeholder='Search...'):
+        """Initialise the search control
+
+        Args:
+            index_url (string): url of the search index json, relative to the map html file
+            position (string): leaflet control position
+            zoom (int): minimum zoom when opening a result
+            max_results (int): number of results listed
+            placeholder (string): placeholder text of the search box
+        """
+
+        super().__init__()
+        self._name = 'SearchControl'
+        self.index_url = index_url
+        self.position = position
+        self.zoom = int(zoom)
+        self.max_results = int(max_results)
+        self.placeholder = placeholder
+
+
+class YearSlider(MacroElement):
+    """Year range slider showing the year layers of the feature groups, loading older years on demand
+
+    Every feature group has one layer per year (see year_layers.YearLayers). The layers of a year
+    are added to their groups when the year enters the selected range and removed when it leaves
+    it. The features of the years not in the document are in a javascript file per year, inserted
+    as a script tag the first time the year is selected.
+    """
+
+    _template = Template("""
+        {% macro header(this, kwargs) %}
+            <style>
+                .year-slider { background: white; padding: 4px 8px; border-radius: 4px; box-shadow: 0 1px 5px rgba(0,0,0,0.4); }
+                .year-slider div { text-align: center; font-weight: bold; }
+                .year-slider input { display: block; width: 180px; }
+            </style>
+        {% endmacro %}
+
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var years = {{ this.script_json(this.years) }}, chunks = {{ this.script_json(this.chunks) }};
+                var layers = {}, loaded = {}, loading = {};
+                {%- for year, layer in this.layers %}
+                (layers[{{ year }}] = layers[{{ year }}] || []).push([{{ layer._parent.get_name() }}, {{ layer.get_name() }}]);
+                {%- endfor %}
+
+                var control = L.control({position: {{ this.position|tojson }}});
+                control.onAdd = function() {
+                    var div = L.DomUtil.create('div', 'year-slider');
+                    var label = L.DomUtil.create('div', '', div);
+                    var inputs = [L.DomUtil.create('input', '', div), L.DomUtil.create('input', '', div)];
+                    var initial = {{ this.script_json(this.initial) }};
+
+                    function range() {
+                        var a = +inputs[0].value, b = +inputs[1].value;
+                        return [Math.min(a, b), Math.max(a, b)];
+                    }
+
+                    function showLabel() {
+                        var r = range();
+                        label.textContent = r[0] === r[1] ? r[0] : r[0] + ' - ' + r[1];
+                    }
+
+                    // chunk of a year loaded once, the range is applied again when it ran
+                    function load(year) {
+                        if (loading[year]) { return; }
+                        loading[year] = true;
+                        var script = document.createElement('script');
+                        script.src = chunks[year];
+                        script.onload = function() { loaded[year] = true; apply(); };
+                        script.onerror = function() { loading[year] = false; };
+                        document.head.appendChild(script);
+                    }
+
+                    function apply() {
+                        var r = range();
+                        years.forEach(function(year) {
+                            var selected = year >= r[0] && year <= r[1];
+                            if (selected && chunks[year] && !loaded[year]) {
+                                load(year);
+                                return;
+                            }
+                            (layers[year] || []).forEach(function(pair) {
+                                if (selected && !pair[0].hasLayer(pair[1])) {
+                                    pair[0].addLayer(pair[1]);
+                                } else if (!selected && pair[0].hasLayer(pair[1])) {
+                                    pair[0].removeLayer(pair[1]);
+                                }
+                            });
+                        });
+                    }
+
+                    inputs.forEach(function(input, i) {
+                        input.type = 'range';
+                        input.min = years[0];
+                        input.max = years[years.length - 1];
+                        input.step = 1;
+                        input.value = initial[i];
+                        input.addEventListener('input', showLabel);
+                        input.addEventListener('change', apply);
+                    });
+                    showLabel();
+                    L.DomEvent.disableClickPropagation(div);
+                    L.DomEvent.disableScrollPropagation(div);
+                    return div;
+                };
+                control.addTo(map);
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, years, layers, chunks, initial, position='bottomleft'):
+        """Initialise the year slider
+
+        Args:
+            years (list): sorted years of the events
+            layers (list): (year, layer) of every year layer, the layer being a child of its feature group (or of the map)
+            chunks (dict): year -> url of the javascript file of its features, relative to the map html file
+            initial (list): first and last year selected on opening, their layers shown by the document
+            position (string): leaflet control position
+        """
+
+        super().__init__()
+        self._name = 'YearSlider'
+        self.script_json = script_json
+        self.years = [int(year) for year in years]
+        self.layers = [(int(year), layer) for year, layer in layers]
+        self.chunks = {str(year): url for year, url in chunks.items()}
+        self.initial = [int(year) for year in initial]
+        self.position = position
@@ -0,0 +1,190 @@
+import os
+import json
+import logging
+import numpy as np
+import traces
+
+logger = logging.getLogger(__name__)
+
+# zoom bands [min zoom, max zoom] of the heatmap layers, the vector traces are shown above the last one
+HEATMAP_BANDS = [[0, 6], [7, 10], [11, 13]]
+
+# size of a grid cell in screen pixels at the max zoom of its band
+CELL_PIXELS = 16
+
+# web mercator latitude limit
+MAX_LATITUDE = 85.05112878
+
+
+def grid_level(max_zoom, cell_pixels=CELL_PIXELS):
+    """Grid level of a band: the world is divided into 2**level x 2**level web mercator cells"""
+
+    return max_zoom + 8 - int(np.log2(cell_pixels))
+
+
+def mercator(lat, lon):
+    """Web mercator coordinates of points, x and y in [0, 1] from the top left corner of the world"""
+
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return x, y
+
+
+def trace_cells(lat, lon, level):
+    """Web mercator grid cells crossed by a trace
+
+    Args:
+        lat (np.ndarray): latitudes in degrees
+        lon (np.ndarray): longitudes in degrees
+        level (int): grid level, see grid_level
+
+    Return:
+        (np.ndarray): sorted unique int64 cell keys (row * 2**level + column)
+    """
+
+    size = 2 ** level
+    x, y = mercator(lat, lon)
+    column = np.clip((x * size).astype(np.int64), 0, size - 1)
+    row = np.clip((y * size).astype(np.int64), 0, size - 1)
+    # a trace counts once per cell, however long it stays in it
+    return np.unique(row * size + column)
+
+
+def cell_centers(keys, level):
+    """Latitude and longitude of the center of grid cells, see trace_cells"""
+
+    size = 2 ** level
+    row, column = np.divmod(keys, size)
+    lon = (column + 0.5) / size * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (row + 0.5) / size))))
+    return lat, lon
+
+
+class HeatmapGrid:
+    """Number of traces crossing every cell of a multi-resolution web mercator grid
+
+    The sorted cells of every trace are cached per zoom band in a npz file with the gpx file
+    key they were computed from, so that an update only bins the new or modified traces. The
+    heat of a band is the histogram of the cached cells of all traces (one np.unique call).
+    """
+
+    def __init__(self, path, bands=HEATMAP_BANDS, cell_pixels=CELL_PIXELS):
+        """Load the cached grid
+
+        Args:
+            path (string): npz cache file
+            bands (list): [min zoom, max zoom] of every band
+            cell_pixels (int): cell size in pixels at the max zoom of a band, power of 2
+        """
+
+        self.path = path
+        self.bands = [list(band) for band in bands]
+        self.cell_pixels = cell_pixels
+        self.levels = [grid_level(max_zoom, cell_pixels) for _, max_zoom in self.bands]
+        self.traces = {}
+        self.load()
+
+    def load(self):
+        """Read the cached trace cells, dropped if computed with other bands or cell size"""
+
+        if not os.path.isfile(self.path):
+            return
+
+        with np.load(self.path) as cache:
+            meta = json.loads(str(cache['meta']))
+            if meta['bands'] != self.bands or meta['cell_pixels'] != self.cell_pixels:
+                logger.info('Heatmap bands changed, binning all traces again')
+                return
+
+            offsets = [0] * len(self.bands)
+            cells = [cache[f'cells_{band}'] for band in range(len(self.bands))]
+            for path, entry in meta['traces'].items():
+                trace = []
+                for band, count in enumerate(entry['counts']):
+                    trace.append(cells[band][offsets[band]:offsets[band] + count])
+                    offsets[band] += count
+                self.traces[path] = (tuple(entry['key']), trace)
+
+    def save(self):
+        """Write the trace cells atomically"""
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        meta = {'bands': self.bands, 'cell_pixels': self.cell_pixels, 'traces': {}}
+        cells = [[] for _ in self.bands]
+        for path, (key, trace) in self.traces.items():
+            meta['traces'][path] = {'key': list(key), 'counts': [len(band_cells) for band_cells in trace]}
+            for band, band_cells in enumerate(trace):
+                cells[band].append(band_cells)
+
+        arrays = {f'cells_{band}': np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+                  for band, chunks in enumerate(cells)}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, self.path)
+
+    def update(self, paths, store, profiler=None):
+        """Bin the new or modified traces and forget the traces not in paths
+
+        Args:
+            paths (list): gpx file paths
+            store (trace_store.TraceStore): packed traces, up to date with the gpx files
+            profiler (instrumentation.Profiler): records cache hits and misses
+
+        Return:
+            (int): number of traces binned
+        """
+
+        current = {}
+        for path in paths:
+            if not path:
+                continue
+            try:
+                current[os.path.abspath(path)] = traces.file_key(path)
+            except OSError:
+                logger.warning(f'Trace file {path} not found')
+
+        removed = set(self.traces) - set(current)
+        for path in removed:
+            del self.traces[path]
+
+        binned = 0
+        for path, key in current.items():
+            cached = self.traces.get(path)
+            if cached and cached[0] == key:
+                if profiler:
+                    profiler.hit('heatmap')
+                continue
+
+            if profiler:
+                profiler.miss('heatmap')
+            track = store.track(path)
+            if track is None:
+                continue
+            self.traces[path] = (key, [trace_cells(track['lat'], track['lon'], level) for level in self.levels])
+            binned += 1
+
+        if binned or removed:
+            self.save()
+        return binned
+
+    def band_heat(self, band):
+        """Heat points of a band
+
+        Args:
+            band (int): band number
+
+        Return:
+            (np.ndarray): (n, 3) array of cell center lat, lon and weight in ]0, 1], the log
+                          of the number of traces crossing the cell relative to the busiest one
+        """
+
+        chunks = [trace[band] for _, trace in self.traces.values()]
+        if not chunks:
+            return np.empty((0, 3))
+
+        keys, counts = np.unique(np.concatenate(chunks), return_counts=True)
+        lat, lon = cell_centers(keys, self.levels[band])
+        weight = np.log1p(counts) / np.log1p(counts.max())
+        return np.column_stack((lat.round(5), lon.round(5), weight.round(3)))
@@ -0,0 +1,193 @@
+/*
+ * Virtualized data table used by the events and camino tables (table_mode "virtual").
+ *
+ * The rows are fetched from the json file written by data_table.py and only the rows in the
+ * viewport (plus an overscan margin) are in the DOM, two spacer rows standing for the others.
+ * The header cells sort the rows, the filter bar filters them by year, type and distance.
+ */
+var DataTable = (function() {
+    'use strict';
+
+    // rows drawn above and below the viewport
+    var OVERSCAN = 20;
+
+    function create(tag, className, parent) {
+        var element = document.createElement(tag);
+        if (className) { element.className = className; }
+        if (parent) { parent.appendChild(element); }
+        return element;
+    }
+
+    function spacer(columns) {
+        var row = create('tr'), cell = create('td', '', row);
+        cell.colSpan = columns;
+        cell.style.cssText = 'padding:0;border:0;height:0';
+        return row;
+    }
+
+    function render(table, options) {
+        var tbody = table.tBodies[0], header = tbody.rows[0], columns = options.classes.length;
+        var top = spacer(columns), bottom = spacer(columns);
+        var data = null, view = [], drawn = [-1, -1], rowHeight = 0, pending = false;
+        var sortField = null, descending = false, filters = {};
+
+        tbody.appendChild(top);
+        tbody.appendChild(bottom);
+
+        function value(field, i) {
+            return data.keys[field][i];
+        }
+
+        function matches(i) {
+            return options.filters.every(function(filter) {
+                var selected = filters[filter.field], v = value(filter.field, i);
+                if (filter.kind === 'range') {
+                    return (selected.min === '' || v >= +selected.min) && (selected.max === '' || v <= +selected.max);
+                }
+                return selected === '' || String(v) === selected;
+            });
+        }
+
+        // empty values last in both directions, spreadsheet order between equal values
+        function compare(a, b) {
+            var x = value(sortField, a), y = value(sortField, b);
+            var xEmpty = x === null || x === '', yEmpty = y === null || y === '';
+            if (xEmpty !== yEmpty) { return xEmpty ? 1 : -1; }
+            if (xEmpty || x === y) { return a - b; }
+            return (x < y ? -1 : 1) * (descending ? -1 : 1);
+        }
+
+        // view items are row numbers, -1 being a year separator
+        function update() {
+            var rows = [], year = null, separators = !sortField || sortField === 'date';
+            for (var i = 0; i < data.rows.length; i++) {
+                if (matches(i)) { rows.push(i); }
+            }
+            if (sortField) { rows.sort(compare); }
+
+            view = [];
+            rows.forEach(function(i) {
+                if (separators && year !== null && value('year', i) !== year) { view.push(-1); }
+                year = value('year', i);
+                view.push(i);
+            });
+            drawn = [-1, -1];
+            draw();
+        }
+
+        function row(item) {
+            var tr = create('tr');
+            if (item < 0) {
+                create('td', options.separator, tr).colSpan = columns;
+                return tr;
+            }
+            data.rows[item].forEach(function(html, c) {
+                create('td', options.classes[c], tr).innerHTML = html;
+            });
+            return tr;
+        }
+
+        function draw() {
+            pending = false;
+            var height = rowHeight || 30;
+            var offset = Math.max(0, -tbody.getBoundingClientRect().top - header.offsetHeight);
+            var first = Math.max(0, Math.floor(offset / height) - OVERSCAN);
+            var last = Math.min(view.length, Math.ceil((offset + window.innerHeight) / height) + OVERSCAN);
+            first = Math.min(first, last);
+            if (first === drawn[0] && last === drawn[1]) { return; }
+            drawn = [first, last];
+
+            while (top.nextSibling !== bottom) { tbody.removeChild(top.nextSibling); }
+            var fragment = document.createDocumentFragment();
+            for (var k = first; k < last; k++) { fragment.appendChild(row(view[k])); }
+            tbody.insertBefore(fragment, bottom);
+
+            // the spacers use the average height of the first rows drawn (rows wrap differently)
+            if (!rowHeight && last > first) {
+                rowHeight = (bottom.getBoundingClientRect().top - top.getBoundingClientRect().bottom) / (last - first) || height;
+                drawn = [-1, -1];
+                draw();
+                return;
+            }
+            top.firstChild.style.height = first * height + 'px';
+            bottom.firstChild.style.height = (view.length - last) * height + 'px';
+        }
+
+        function schedule() {
+            if (!pending && data) {
+                pending = true;
+                window.requestAnimationFrame(draw);
+            }
+        }
+
+        function addSorting() {
+            var titles = [];
+            Array.prototype.forEach.call(header.cells, function(th, c) {
+                var field = options.sort[c];
+                titles.push(th.textContent);
+                if (!field) { return; }
+                th.style.cursor = 'pointer';
+                th.addEventListener('click', function() {
+                    // a new column sorts ascending, except the dates (newest first as in the spreadsheet)
+                    descending = sortField === field ? !descending : field === 'date';
+                    sortField = field;
+                    Array.prototype.forEach.call(header.cells, function(cell, i) { cell.textContent = titles[i]; });
+                    th.textContent = titles[c] + (descending ? ' ▼' : ' ▲');
+                    update();
+                });
+            });
+        }
+
+        function addFilters(container) {
+            options.filters.forEach(function(filter) {
+                var label = create('label', '', container);
+                label.appendChild(document.createTextNode(filter.label + ' '));
+
+                if (filter.kind === 'range') {
+                    filters[filter.field] = {min: '', max: ''};
+                    ['min', 'max'].forEach(function(bound) {
+                        var input = create('input', '', label);
+                        input.type = 'number';
+                        input.min = 0;
+                        input.placeholder = bound;
+                        input.addEventListener('input', function() {
+                            filters[filter.field][bound] = input.value;
+                            update();
+                        });
+                    });
+                    return;
+                }
+
+                filters[filter.field] = '';
+                var select = create('select', '', label), seen = {};
+                create('option', '', select).textContent = 'All';
+                select.firstChild.value = '';
+                data.keys[filter.field].forEach(function(v) {
+                    if (v === '' || v === null || seen[v]) { return; }
+                    seen[v] = true;
+                    var option = create('option', '', select);
+                    option.value = String(v);
+                    option.textContent = String(v);
+                });
+                select.addEventListener('change', function() {
+                    filters[filter.field] = select.value;
+                    update();
+                });
+            });
+        }
+
+        fetch(options.url).then(function(response) {
+            return response.json();
+        }).then(function(json) {
+            data = json;
+            addSorting();
+            if (options.filtersElement) { addFilters(document.getElementById(options.filtersElement)); }
+            update();
+        });
+
+        window.addEventListener('scroll', schedule, {passive: true});
+        window.addEventListener('resize', schedule);
+    }
+
+    return {render: render};
+})();
@@ -0,0 +1,124 @@
+import os
+import logging
+import multiprocessing
+import numpy as np
+import xml.etree.ElementTree as ET
+from datetime import timezone
+from concurrent.futures import ProcessPoolExecutor
+import traces
+
+try:
+    import fitparse
+except ImportError:
+    fitparse = None
+
+logger = logging.getLogger(__name__)
+
+# degrees of one fit position unit (semicircle)
+SEMICIRCLE_DEGREES = 180 / 2 ** 31
+
+# files read by each worker task, fewer files are read in the calling process
+FILES_PER_TASK = 16
+
+
+def local_name(tag):
+    """Xml tag without its namespace"""
+
+    return tag.rsplit('}', 1)[-1]
+
+
+def read_tcx(path):
+    """Read all track points of a tcx file (Garmin Training Center) by streaming the xml
+
+    Trackpoints without a position (heart rate only, gps signal lost) are skipped.
+
+    Args:
+        path (string): path to tcx file
+
+    Return:
+        (dict): numpy arrays lat, lon, ele (m, nan if missing) and time (s since epoch, nan if missing)
+    """
+
+    lat, lon, ele, time = [], [], [], []
+
+    for _, element in ET.iterparse(path, events=('end',)):
+        if local_name(element.tag) != 'Trackpoint':
+            continue
+
+        values = {local_name(child.tag): child.text for child in element.iter()}
+        if values.get('LatitudeDegrees') and values.get('LongitudeDegrees'):
+            lat.append(values['LatitudeDegrees'])
+            lon.append(values['LongitudeDegrees'])
+            altitude = values.get('AltitudeMeters')
+            ele.append(altitude.strip() if altitude and altitude.strip() else 'nan')
+            time.append((values.get('Time') or '').strip())
+        element.clear()
+
+    return {
+        'lat': np.array(lat, dtype=np.float64),
+        'lon': np.array(lon, dtype=np.float64),
+        'ele': np.array(ele, dtype=np.float64),
+        'time': traces.parse_times(time),
+    }
+
+
+def read_fit(path):
+    """Read all records with a position of a fit file (Garmin and most watches), needs fitparse
+
+    Args:
+        path (string): path to fit file
+
+    Return:
+        (dict): numpy arrays lat, lon, ele and time as read_tcx, None if fitparse is not installed
+    """
+
+    if fitparse is None:
+        logger.warning(f'fitparse is not installed, cannot read {path}')
+        return None
+
+    lat, lon, ele, time = [], [], [], []
+
+    for record in fitparse.FitFile(path).get_messages('record'):
+        values = record.get_values()
+        if values.get('position_lat') is None or values.get('position_long') is None:
+            continue
+
+        altitude = values.get('enhanced_altitude', values.get('altitude'))
+        timestamp = values.get('timestamp')
+        lat.append(values['position_lat'])
+        lon.append(values['position_long'])
+        ele.append(np.nan if altitude is None else altitude)
+        # fit timestamps are utc
+        time.append(np.nan if timestamp is None else timestamp.replace(tzinfo=timezone.utc).timestamp())
+
+    return {
+        'lat': np.array(lat, dtype=np.float64) * SEMICIRCLE_DEGREES,
+        'lon': np.array(lon, dtype=np.float64) * SEMICIRCLE_DEGREES,
+        'ele': np.array(ele, dtype=np.float64),
+        'time': np.array(time, dtype=np.float64),
+    }
+
+
+def read_tracks(paths, workers=None):
+    """Read trace files (gpx, tcx or fit), in worker processes when there are many of them
+
+    Args:
+        paths (list): trace file paths
+        workers (int): worker processes, the number of cpus if None
+
+    Return:
+        (dict): path -> trace arrays (see traces.read_track), invalid files left out
+    """
+
+    paths = list(paths)
+    workers = workers or os.cpu_count() or 1
+
+    if len(paths) <= FILES_PER_TASK or workers < 2:
+        tracks = map(traces.read_track, paths)
+    else:
+        # spawned workers: the pipeline stages run in threads, forking them is unsafe
+        with ProcessPoolExecutor(max_workers=min(workers, -(-len(paths) // FILES_PER_TASK)),
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            tracks = list(executor.map(traces.read_track, paths, chunksize=FILES_PER_TASK))
+
+    return {path: track for path, track in zip(paths, tracks) if track is not None}
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+def process_peak_rss_mb():
+    """Peak resident set size of the whole process since it started, in MB
+
+    This is a cumulative high-water mark, not the memory used by one stage: a stage only raises it
+    when it allocates more than all the stages before it (see rss_growth_mb in Profiler.stage).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+class Profiler:
+    """Records wall time, cpu time, peak memory, item counts and cache hit rates of pipeline stages"""
+
+    def __init__(self, name, trace_memory=False):
+        """Initialise an empty profile
+
+        Args:
+            name (string): name of the profiled pipeline
+            trace_memory (bool): measure the python heap peak of each stage with tracemalloc (slower)
+        """
+
+        self.name = name
+        self.trace_memory = trace_memory
+        self.start = time.perf_counter()
+        self.stages = []
+        self.spans = []
+        self.counts = defaultdict(int)
+        self.caches = defaultdict(lambda: {'hits': 0, 'misses': 0})
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name):
+        """Measure a pipeline stage
+
+        Args:
+            name (string): stage name
+        """
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+
+        record = {'name': name, 'counts': defaultdict(int), 'thread': threading.get_ident()}
+        self._stack().append(record)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        rss_start = process_peak_rss_mb()
+
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.thread_time() - cpu_start
+            record['start_s'] = wall_start - self.start
+            # growth of the process peak during the stage (shared by the stages running concurrently)
+            record['process_peak_rss_mb'] = process_peak_rss_mb()
+            record['rss_growth_mb'] = record['process_peak_rss_mb'] - rss_start
+            if self.trace_memory:
+                record['peak_heap_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            record['counts'] = dict(record['counts'])
+            self._stack().pop()
+
+            with self._lock:
+                self.stages.append(record)
+
+            logger.debug(f"{name} done in {record['wall_s']:.3f}s")
+
+    @contextmanager
+    def span(self, name, category='item'):
+        """Measure a single item (event, gpx file...) inside the current stage
+
+        Args:
+            name (string): item name
+            category (string): item category, used to group items in the report
+        """
+
+        wall_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            span = {'name': name, 'category': category, 'start_s': wall_start - self.start,
+                    'wall_s': time.perf_counter() - wall_start, 'thread': threading.get_ident()}
+            with self._lock:
+                self.spans.append(span)
+
+    def count(self, name, n=1):
+        """Increment an item counter for the current stage and the whole run"""
+
+        stack = self._stack()
+        if stack:
+            stack[-1]['counts'][name] += n
+        with self._lock:
+            self.counts[name] += n
+
+    def hit(self, cache, n=1):
+        """Record cache hits"""
+        with self._lock:
+            self.caches[cache]['hits'] += n
+
+    def miss(self, cache, n=1):
+        """Record cache misses"""
+        with self._lock:
+            self.caches[cache]['misses'] += n
+
+    def report(self, top=10):
+        """Build the run report as a json serialisable dict
+
+        Args:
+            top (int): number of slowest items listed per category
+        """
+
+        caches = {}
+        for cache, stats in self.caches.items():
+            total = stats['hits'] + stats['misses']
+            caches[cache] = dict(stats, hit_rate=round(stats['hits'] / total, 3) if total else None)
+
+        slowest = defaultdict(list)
+        for span in sorted(self.spans, key=lambda s: s['wall_s'], reverse=True):
+            if len(slowest[span['category']]) < top:
+                slowest[span['category']].append({'name': span['name'], 'wall_s': round(span['wall_s'], 4)})
+
+        stages = []
+        for record in self.stages:
+            stage = {k: round(v, 4) if isinstance(v, float) else v for k, v in record.items() if k != 'thread'}
+            stages.append(stage)
+
+        return {
+            'pipeline': self.name,
+            'wall_s': round(time.perf_counter() - self.start, 4),
+            'process_peak_rss_mb': round(process_peak_rss_mb(), 1),
+            'stages': stages,
+            'counts': dict(self.counts),
+            'caches': caches,
+            'slowest_items': dict(slowest),
+        }
+
+    def chrome_trace(self):
+        """Build the run report in the chrome trace event format (chrome://tracing, perfetto)"""
+
+        events = []
+        for record in self.stages:
+            events.append({'name': record['name'], 'cat': 'stage', 'ph': 'X', 'pid': os.getpid(), 'tid': record['thread'],
+                           'ts': record['start_s'] * 1e6, 'dur': record['wall_s'] * 1e6,
+                           'args': dict(record['counts'], cpu_s=record['cpu_s'])})
+        for span in self.spans:
+            events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': os.getpid(), 'tid': span['thread'],
+                           'ts': span['start_s'] * 1e6, 'dur': span['wall_s'] * 1e6})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_report(self, path):
+        """Write the run report, in chrome trace format if the file name ends with .trace.json
+
+        Args:
+            path (string): report file path
+        """
+
+        report = self.chrome_trace() if path.endswith('.trace.json') else self.report()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4)
+
+        logger.info(f'Profile report written at location {path}')
+
+    def print_summary(self):
+        """Log a summary table of the stages"""
+
+        logger.info('\n' + ' PROFILE '.center(100, '#'))
+        for record in self.stages:
+            counts = ', '.join(f'{k}: {v}' for k, v in record['counts'].items())
+            logger.info(f"{record['name']:<30}{record['wall_s']:>9.3f}s wall {record['cpu_s']:>9.3f}s cpu "
+                        f"{record['rss_growth_mb']:>+8.1f} MB peak rss ({record['process_peak_rss_mb']:.1f} MB process)  {counts}")
+        for cache, stats in self.report()['caches'].items():
+            logger.info(f"cache {cache}: {stats['hits']} hits, {stats['misses']} misses")
+
+
+def stage(name=None):
+    """Decorator measuring a method of a class holding a profiler in self.profiler
+
+    Args:
+        name (string): stage name, defaults to the method name
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.stage(name or func.__name__):
+                return func(self, *args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,202 @@
+import os
+import shutil
+import logging
+import tempfile
+from functools import partial
+from branca.element import Element
+from folium.map import Layer
+
+logger = logging.getLogger(__name__)
+
+# stands for the spooled scripts in the rendered document
+SCRIPTS_MARKER = '/*map_writer_scripts*/'
+
+
+class MapWriter:
+    """Writes a folium map to its html file while the map is built
+
+    Flushed elements are rendered right away: their scripts go to a temporary spool file and the
+    rendered features are dropped from the element tree, so that the traces and their points do
+    not stay in memory until the map is saved. The header and html parts of the document (css/js
+    links, map div) are small and stay in the figure until close() writes the document.
+
+    Layers stay in the tree once rendered (the layer control lists the layers of the map and new
+    features can still be added to them), with their render replaced so that only the children
+    added after the flush are rendered. Deferred elements (e.g. BulkMarkers still receiving
+    markers) are skipped by the flushes and rendered by close().
+    """
+
+    def __init__(self, folium_map):
+        """Start the document of a map
+
+        Args:
+            folium_map (folium.Map): map being built
+        """
+
+        self.map = folium_map
+        self.figure = folium_map.get_root()
+        self.spool = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self.deferred = []
+        self.size = 0
+
+    @staticmethod
+    def render_children(element, **kwargs):
+        """Render of an element already written: only its children are rendered"""
+
+        for child in list(element._children.values()):
+            child.render(**kwargs)
+
+    @staticmethod
+    def written(element):
+        """True if the element was rendered by a flush (or is deferred)"""
+
+        return 'render' in vars(element)
+
+    def is_root(self, element):
+        """True if the element is above the elements written by this writer (the figure)"""
+
+        return element is self.figure
+
+    def defer(self, element):
+        """Render an element only when the document is written, not with the flushes of its parents"""
+
+        self.deferred.append(element)
+        element.render = lambda **kwargs: None
+
+    def flush(self, element):
+        """Write the scripts of an element and of its children, then drop the rendered features
+
+        Args:
+            element (branca.element.Element): element of the map, its parents are flushed first
+                                              (their scripts declare the variables it refers to)
+        """
+
+        parent = element._parent
+        if parent is not None and not self.is_root(parent) and not self.written(parent):
+            self.flush(parent)
+
+        element.render()
+        self.write_scripts()
+        self.release(element)
+
+        if parent is not None and not isinstance(element, Layer) and element is not self.map:
+            parent._children.pop(element.get_name(), None)
+
+    def write_scripts(self):
+        """Move the scripts rendered into the figure to the spool file"""
+
+        scripts = self.figure.script._children
+        for script in scripts.values():
+            self.size += self.spool.write(script.render())
+        scripts.clear()
+
+    def release(self, element):
+        """Mark an element and its children as written and drop its children other than layers"""
+
+        for name, child in list(element._children.items()):
+            if child in self.deferred:
+                continue
+            self.release(child)
+            if not isinstance(child, Layer):
+                del element._children[name]
+
+        if not self.written(element):
+            element.render = partial(self.render_children, element)
+
+    def close(self, path):
+        """Render the elements left in the tree and write the document
+
+        Args:
+            path (string): html file, replaced once complete
+
+        Return:
+            (int): number of characters of spooled scripts
+        """
+
+        for element in self.deferred:
+            del element.render
+        self.deferred = []
+
+        for child in list(self.figure._children.values()):
+            child.render()
+        self.write_scripts()
+
+        # the figure template with a marker instead of the scripts, replaced by the spool contents
+        self.figure.script.add_child(Element(SCRIPTS_MARKER), name='map_writer_scripts')
+        head, tail = self.figure._template.render(this=self.figure, kwargs={}).split(SCRIPTS_MARKER)
+        self.figure.script._children.clear()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(head)
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, f)
+            f.write(tail)
+        os.replace(tmp_path, path)
+        self.spool.close()
+
+        logger.debug(f'Map written at location {path}: {self.size} characters of scripts')
+        return self.size
+
+
+class ChunkWriter(MapWriter):
+    """Writes the features of some layers of a map to a javascript file, loaded by the page on demand
+
+    The layers themselves (roots) are rendered in the html document, which declares their
+    variables, and their children in the chunk: its scripts run after the document scripts and
+    add the features to the layers. Elements flushed or deferred here are written to the chunk
+    even when the roots are rendered by the document, the children left in the roots are written
+    by close(), which must be called before the map is saved.
+    """
+
+    def __init__(self, folium_map, path):
+        """Start the chunk of some layers of a map
+
+        Args:
+            folium_map (folium.Map): map being built
+            path (string): javascript file of the chunk
+        """
+
+        super().__init__(folium_map)
+        self.path = path
+        self.roots = []
+
+    def add_root(self, layer):
+        """Write the children of a layer to the chunk"""
+
+        self.roots.append(layer)
+
+    def is_root(self, element):
+        return element is self.figure or any(element is root for root in self.roots)
+
+    def close(self, path=None):
+        """Render the deferred elements and the children left in the roots, then write the chunk
+
+        Args:
+            path (string): javascript file, the path given to the constructor if None
+
+        Return:
+            (int): number of characters of the chunk
+        """
+
+        path = path or self.path
+        deferred, self.deferred = self.deferred, []
+        for element in deferred:
+            del element.render
+            self.flush(element)
+
+        for root in self.roots:
+            for child in list(root._children.values()):
+                self.flush(child)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, f)
+        os.replace(tmp_path, path)
+        self.spool.close()
+
+        logger.debug(f'Map chunk written at location {path}: {self.size} characters')
+        return self.size
@@ -0,0 +1,203 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = '.manifest.json'
+
+# tags whose contents must be left untouched by the html whitespace collapsing
+RAW_TAGS_RE = re.compile(r'(<(script|style|pre|textarea)\b[^>]*>)(.*?)(</\2\s*>)', re.IGNORECASE | re.DOTALL)
+HTML_COMMENT_RE = re.compile(r'<!--(?!\[if|<!).*?-->', re.DOTALL)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+
+
+def minify_css(css):
+    """Remove comments and redundant whitespace from a css stylesheet
+
+    Args:
+        css (string): css contents
+
+    Return:
+        (string): minified css
+    """
+
+    css = CSS_COMMENT_RE.sub('', css)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+def minify_js(js):
+    """Conservative javascript minification
+
+    Only indentation, blank lines and full-line // comments are removed. Line breaks are kept so that
+    automatic semicolon insertion keeps working on the code generated by folium.
+
+    Args:
+        js (string): javascript contents
+
+    Return:
+        (string): minified javascript
+    """
+
+    lines = []
+    for line in js.splitlines():
+        line = line.strip()
+        if not line or line.startswith('//'):
+            continue
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def minify_html(html):
+    """Minify html contents, including inline style and script blocks
+
+    Args:
+        html (string): html contents
+
+    Return:
+        (string): minified html
+    """
+
+    # put raw blocks aside so that whitespace collapsing does not alter them
+    raw_blocks = []
+
+    def stash(match):
+        open_tag, tag, contents, close_tag = match.groups()
+        if tag.lower() == 'style':
+            contents = minify_css(contents)
+        elif tag.lower() == 'script':
+            contents = minify_js(contents)
+        raw_blocks.append(open_tag + contents + close_tag)
+        return f'\x00{len(raw_blocks) - 1}\x00'
+
+    html = RAW_TAGS_RE.sub(stash, html)
+    html = HTML_COMMENT_RE.sub('', html)
+    html = re.sub(r'\s*\n\s*', '\n', html)
+    html = re.sub(r'[ \t]+', ' ', html)
+    # whitespace between inline elements is rendered as a space, only its length can go
+    html = re.sub(r'>\n<', '> <', html)
+
+    return re.sub(r'\x00(\d+)\x00', lambda m: raw_blocks[int(m.group(1))], html).strip()
+
+
+def minify_file_contents(path, contents):
+    """Minify contents based on the file extension"""
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.html', '.htm'):
+        return minify_html(contents)
+    if extension == '.css':
+        return minify_css(contents)
+    if extension == '.js':
+        return minify_js(contents)
+    return contents
+
+
+def compressed_copies(path):
+    """List of precompressed files written next to a minified file"""
+
+    copies = [path + '.gz']
+    if brotli:
+        copies.append(path + '.br')
+    return copies
+
+
+def process_outputs(files, dist_folder):
+    """Minify files into the dist folder and write precompressed .gz/.br copies next to them
+
+    Files whose source did not change since the last run are skipped.
+
+    Args:
+        files (list): paths of the html/css/js files to process
+        dist_folder (string): folder receiving the minified and compressed files
+
+    Return:
+        (tuple): number of processed files, number of skipped files
+    """
+
+    os.makedirs(dist_folder, exist_ok=True)
+    manifest_path = os.path.join(dist_folder, MANIFEST_NAME)
+
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as mf:
+            manifest = json.load(mf)
+
+    processed_count = 0
+    skipped_count = 0
+
+    for path in files:
+        if not os.path.isfile(path):
+            logger.warning(f'{path} is not a valid filepath. Skipping minification.')
+            continue
+
+        with open(path, 'rb') as f:
+            source = f.read()
+
+        name = os.path.basename(path)
+        dist_path = os.path.join(dist_folder, name)
+        source_hash = hashlib.sha1(source).hexdigest()
+
+        # source unchanged and outputs available -> nothing to do
+        outputs = [dist_path] + compressed_copies(dist_path)
+        if manifest.get(name) == source_hash and all(os.path.isfile(output) for output in outputs):
+            skipped_count += 1
+            continue
+
+        contents = minify_file_contents(path, source.decode('utf-8')).encode('utf-8')
+
+        with open(dist_path, 'wb') as f:
+            f.write(contents)
+
+        # mtime=0 keeps gzip output reproducible between runs
+        with open(dist_path + '.gz', 'wb') as f:
+            f.write(gzip.compress(contents, compresslevel=9, mtime=0))
+
+        if brotli:
+            with open(dist_path + '.br', 'wb') as f:
+                f.write(brotli.compress(contents, quality=11))
+
+        manifest[name] = source_hash
+        processed_count += 1
+        logger.debug(f'{name} minified: {len(source)} -> {len(contents)} bytes')
+
+    with open(manifest_path, 'w') as mf:
+        json.dump(manifest, mf, indent=4)
+
+    return processed_count, skipped_count
+
+
+def publish_files(path, dist_folder):
+    """List the local files to upload for a given output file
+
+    Args:
+        path (string): path of the generated or source file
+        dist_folder (string): folder containing the minified and compressed files, None to disable
+
+    Return:
+        (list): list of tuples (local path, remote file name)
+    """
+
+    name = os.path.basename(path)
+    if dist_folder:
+        dist_path = os.path.join(dist_folder, name)
+        if os.path.isfile(dist_path):
+            files = [(dist_path, name)]
+            for copy in compressed_copies(dist_path):
+                if os.path.isfile(copy):
+                    files.append((copy, os.path.basename(copy)))
+            return files
+
+    return [(path, name)]
@@ -0,0 +1,254 @@
+import logging
+from datetime import datetime
+import numpy as np
+import heatmap
+
+logger = logging.getLogger(__name__)
+
+# web mercator grid level of the overlap cells: about 76 m at the equator, 49 m at 50° latitude (gps noise stays in the cells)
+GRID_LEVEL = 19
+
+# share of common cells (jaccard index) above which two traces are the same course
+REPEAT_SIMILARITY = 0.8
+
+# minhash signature of a trace: MINHASH_BANDS bands of MINHASH_ROWS hashes of its cells. Two traces with a jaccard
+# index s share at least one band with a probability of 1 - (1 - s ** rows) ** bands: 0.9998 at 0.8, 0.12 at 0.3
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+
+
+def create_table(conn):
+    """Create the trace_overlap table: one row per trace with its course and overlap statistics
+
+    gpx and course are gpx paths as in the map tables, course being the trace drawn for all the
+    repeats of a course (the one of the newest event), shared the share of the cells of the trace
+    crossed by any other trace and best_match / similarity the most similar trace among the traces
+    sharing a minhash band with it (None if there is none, see candidate_pairs).
+    """
+
+    conn.execute("""CREATE TABLE IF NOT EXISTS trace_overlap(
+                 gpx TEXT PRIMARY KEY,
+                 date TEXT,
+                 course TEXT,
+                 cells INTEGER,
+                 shared REAL,
+                 best_match TEXT,
+                 similarity REAL
+                 )""")
+
+
+def mix(values):
+    """64 bit hash of every value of a uint64 array (splitmix64 finalizer)"""
+
+    with np.errstate(over='ignore'):
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def minhash_signatures(cells, hashes=MINHASH_BANDS * MINHASH_ROWS):
+    """Minhash signature of every trace: the minimum of several hashes of its cells
+
+    Two traces get the same minimum for a hash with a probability equal to the jaccard index of
+    their cells. The cost is linear in the total number of cells.
+
+    Args:
+        cells (list): sorted unique cell keys of every trace, not empty
+        hashes (int): length of the signatures
+
+    Return:
+        (np.ndarray): (number of traces, hashes) uint64 signatures
+    """
+
+    if not cells:
+        return np.empty((0, hashes), dtype=np.uint64)
+
+    # the cells are hashed once, every hash of the signature is a cheap xor-multiply of that hash
+    keys = mix(np.concatenate(cells).astype(np.uint64))
+    starts = np.concatenate(([0], np.cumsum([len(c) for c in cells])[:-1]))
+    seeds = mix(np.arange(1, hashes + 1, dtype=np.uint64))
+    multipliers = mix(seeds) | np.uint64(1)
+    signatures = np.empty((len(cells), hashes), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for i, (seed, multiplier) in enumerate(zip(seeds, multipliers)):
+            signatures[:, i] = np.minimum.reduceat((keys ^ seed) * multiplier, starts)
+    return signatures
+
+
+def candidate_pairs(signatures, bands=MINHASH_BANDS):
+    """Pairs of traces sharing at least one band of their minhash signatures (locality sensitive hashing)
+
+    The traces of a band bucket are only paired with the first trace of the bucket, so the number
+    of pairs grows with the number of traces and bands, however many traces cross the same streets.
+    The repeats of a course fall in the same buckets and are joined through their first trace.
+
+    Args:
+        signatures (np.ndarray): minhash signatures, see minhash_signatures
+        bands (int): number of bands, dividing the signature length
+
+    Return:
+        (np.ndarray): (n, 2) unique trace index pairs (i < j)
+    """
+
+    count = len(signatures)
+    if count < 2:
+        return np.empty((0, 2), dtype=np.int64)
+
+    pairs = []
+    for band in np.split(signatures, bands, axis=1):
+        keys = np.zeros(count, dtype=np.uint64)
+        for column in band.T:
+            keys = mix(keys ^ column)
+
+        # first trace of the bucket of every trace, the other traces of the bucket are paired with it
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        first = np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))
+        bucket_first = order[np.flatnonzero(first)][np.cumsum(first) - 1]
+        low = np.minimum(bucket_first[~first], order[~first])
+        high = np.maximum(bucket_first[~first], order[~first])
+        pairs.append(low * count + high)
+
+    pairs = np.unique(np.concatenate(pairs))
+    return np.column_stack(np.divmod(pairs, count))
+
+
+def find_overlaps(cells, rank=None, similarity=REPEAT_SIMILARITY):
+    """Overlap statistics and repeated courses of traces
+
+    Only the candidate pairs of the minhash bands are compared (see candidate_pairs), which keeps
+    the cost near-linear when the same streets appear in many traces.
+
+    Args:
+        cells (list): sorted unique cell keys of every trace
+        rank (list): sortable value of every trace (e.g. its event date), the trace of highest rank
+                     represents its course (the first one for equal ranks or if None)
+        similarity (float): jaccard index above which two traces are the same course
+
+    Return:
+        (list): dict per trace: course (index of the trace representing its course), shared (share
+                of its cells crossed by other traces), best_match (index, None if no candidate pair)
+                and similarity (jaccard index with best_match)
+    """
+
+    count = len(cells)
+    sizes = np.array([len(c) for c in cells], dtype=np.int64)
+    filled = np.flatnonzero(sizes)
+    pairs = filled[candidate_pairs(minhash_signatures([cells[i] for i in filled]))]
+
+    # exact jaccard index of the candidate pairs
+    common = np.array([np.isin(cells[i], cells[j], assume_unique=True).sum() for i, j in pairs.tolist()], dtype=np.int64)
+    jaccard = common / np.maximum(sizes[pairs[:, 0]] + sizes[pairs[:, 1]] - common, 1)
+
+    # most similar other trace of every trace: pairs in both directions sorted by decreasing similarity
+    source = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    target = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    values = np.concatenate((jaccard, jaccard))
+    order = np.lexsort((-values, source))
+    traces, firsts = np.unique(source[order], return_index=True)
+    best = np.full(count, -1)
+    best_similarity = np.zeros(count)
+    best[traces] = target[order[firsts]]
+    best_similarity[traces] = values[order[firsts]]
+
+    # shared cells: cells crossed by more than one trace
+    if count:
+        keys, occurrences = np.unique(np.concatenate(cells), return_counts=True)
+        busy = keys[occurrences > 1]
+        shared = [float(np.isin(c, busy, assume_unique=True).mean()) if len(c) else 0.0 for c in cells]
+    else:
+        shared = []
+
+    # courses: connected groups of repeats (union-find)
+    parent = list(range(count))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (i, j), value in zip(pairs.tolist(), jaccard.tolist()):
+        if value >= similarity:
+            a, b = root(i), root(j)
+            parent[max(a, b)] = min(a, b)
+
+    # every course is represented by its trace of highest rank, the sort being stable for equal ranks
+    course = {}
+    for i in sorted(range(count), key=lambda i: rank[i], reverse=True) if rank is not None else range(count):
+        course.setdefault(root(i), i)
+
+    return [{'course': course[root(i)], 'shared': round(shared[i], 3),
+             'best_match': int(best[i]) if best[i] >= 0 else None, 'similarity': round(float(best_similarity[i]), 3)}
+            for i in range(count)]
+
+
+def update_overlaps(conn, entries, store, profiler=None):
+    """Detect the repeated courses and shared streets of all traces and store them in trace_overlap
+
+    Args:
+        conn (sqlite3.Connection): database connection
+        entries (iterable): (date 'dd.mm.yyyy', gpx path) of every event, in any order
+        store (trace_store.TraceStore): packed traces, up to date with the gpx files
+        profiler (instrumentation.Profiler): records the number of traces compared
+
+    Return:
+        (dict): gpx path -> course gpx path (the trace of the newest event of its course)
+    """
+
+    # a gpx file used by several events is compared once, with the date of its newest event,
+    # otherwise it would be its own best match
+    newest = {}
+    for date, gpx in entries:
+        if gpx:
+            day = datetime.strptime(date, '%d.%m.%Y')
+            if gpx not in newest or day > newest[gpx][0]:
+                newest[gpx] = (day, date)
+
+    days, dates, paths, cells = [], [], [], []
+    for gpx, (day, date) in newest.items():
+        track = store.track(gpx)
+        if track is None or not len(track['lat']):
+            continue
+        days.append(day)
+        dates.append(date)
+        paths.append(gpx)
+        cells.append(heatmap.trace_cells(track['lat'], track['lon'], GRID_LEVEL))
+
+    results = find_overlaps(cells, rank=days)
+    if profiler:
+        profiler.count('overlap_traces', len(paths))
+
+    create_table(conn)
+    conn.execute("DELETE FROM trace_overlap")
+    conn.executemany("""INSERT INTO trace_overlap (gpx, date, course, cells, shared, best_match, similarity)
+                     VALUES (?,?,?,?,?,?,?)""",
+                     [(gpx, date, paths[result['course']], len(trace_cells), result['shared'],
+                       paths[result['best_match']] if result['best_match'] is not None else None, result['similarity'])
+                      for gpx, date, trace_cells, result in zip(paths, dates, cells, results)])
+    conn.commit()
+
+    return {gpx: paths[result['course']] for gpx, result in zip(paths, results)}
+
+
+def course_traces(entries, courses):
+    """Trace drawn for every course in every layer of a map: the trace of the newest event of the course in the layer
+
+    Args:
+        entries (iterable): (layer key, date 'dd.mm.yyyy', gpx path) of every event, the layer key being
+                            any hashable value (e.g. feature group and year)
+        courses (dict): gpx path -> course gpx path, see update_overlaps
+
+    Return:
+        (dict): (layer key, course gpx path) -> gpx path of the trace drawn
+    """
+
+    newest = {}
+    for layer, date, gpx in entries:
+        if not gpx:
+            continue
+        day = datetime.strptime(date, '%d.%m.%Y')
+        key = (layer, courses.get(gpx, gpx))
+        if key not in newest or day > newest[key][0]:
+            newest[key] = (day, gpx)
+    return {key: gpx for key, (day, gpx) in newest.items()}
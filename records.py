@@ -0,0 +1,165 @@
+import logging
+import numpy as np
+import traces
+import trace_metrics
+
+logger = logging.getLogger(__name__)
+
+# record distances in meters, in the order of the PB/PR table
+RECORD_DISTANCES = {
+    '1 km': 1000,
+    '5 km': 5000,
+    '10 km': 10000,
+    'Half 21,1 km': 21097.5,
+    'Marathon 42,2 km': 42195,
+}
+
+# a record set on an event of about the record distance is a race record (PR), otherwise a personal best (PB)
+RACE_DISTANCE_TOLERANCE = 0.03
+
+
+def fastest_windows(cum_dist, time, distances=RECORD_DISTANCES):
+    """Fastest time over each distance inside a trace
+
+    Sliding window over the cumulative distance: for every trace point taken as the end of the
+    window, the start is the point lying exactly `distance` meters before it, interpolated on the
+    cumulative distance. As both ends only move forward this is the vectorized equivalent of a
+    two-pointer sweep, linear in the number of points.
+
+    Args:
+        cum_dist (np.ndarray): cumulative distance in meters at each point
+        time (np.ndarray): timestamp in seconds at each point
+        distances (dict): label -> window length in meters
+
+    Return:
+        (dict): label -> (seconds, start km) of the fastest window, missing if the trace is too short
+    """
+
+    valid = ~np.isnan(time)
+    cum_dist, time = cum_dist[valid], time[valid]
+    # np.interp needs increasing timestamps along an increasing distance
+    if len(time) < 2 or np.any(np.diff(time) < 0):
+        return {}
+
+    results = {}
+    for label, distance in distances.items():
+        ends = cum_dist >= distance
+        if not ends.any():
+            continue
+        start_dist = cum_dist[ends] - distance
+        durations = time[ends] - np.interp(start_dist, cum_dist, time)
+        best = int(np.argmin(durations))
+        results[label] = (round(float(durations[best]), 1), round(float(start_dist[best]) / 1000, 3))
+    return results
+
+
+def create_table(conn):
+    """Create the table storing the fastest windows of every trace"""
+
+    conn.execute("""CREATE TABLE IF NOT EXISTS records(
+                 date TEXT,
+                 distance TEXT,
+                 gpx TEXT,
+                 file_mtime INT,
+                 file_size INT,
+                 seconds REAL,
+                 start_km REAL,
+                 PRIMARY KEY(date, distance)
+                 )
+    """)
+
+
+def update_records(conn, entries, store, profiler=None):
+    """Search the fastest windows of the traces that changed and store them in the database
+
+    Args:
+        conn (sqlite3.Connection): database connection
+        entries (iterable): tuples (date, gpx path)
+        store (trace_store.TraceStore): packed traces, up to date with the gpx files
+        profiler (instrumentation.Profiler): records cache hits and misses
+
+    Return:
+        (int): number of traces processed
+    """
+
+    create_table(conn)
+    cached = {row[0]: row[1:] for row in conn.execute("SELECT DISTINCT date, gpx, file_mtime, file_size FROM records")}
+    dates = set()
+    processed = 0
+
+    for date, gpx in entries:
+        if not gpx:
+            continue
+        dates.add(date)
+
+        try:
+            mtime, size = traces.file_key(gpx)
+        except OSError:
+            logger.warning(f'Trace file {gpx} not found')
+            continue
+
+        if cached.get(date) == (gpx, mtime, size):
+            if profiler:
+                profiler.hit('records')
+            continue
+
+        if profiler:
+            profiler.miss('records')
+        track = store.track(gpx)
+        if track is None:
+            continue
+
+        cum_dist = trace_metrics.cumulative_distance(track['lat'], track['lon'])
+        windows = fastest_windows(cum_dist, track['time'])
+        processed += 1
+
+        conn.execute("DELETE FROM records WHERE date=?", (date,))
+        # traces without timestamps keep a row so that they are not read again
+        rows = [(date, label, gpx, mtime, size, seconds, start_km) for label, (seconds, start_km) in windows.items()]
+        conn.executemany("INSERT INTO records VALUES (?,?,?,?,?,?,?)", rows or [(date, '', gpx, mtime, size, None, None)])
+
+    # remove the records of traces deleted from the spreadsheet
+    for date in set(cached) - dates:
+        conn.execute("DELETE FROM records WHERE date=?", (date,))
+
+    conn.commit()
+    return processed
+
+
+def best_records(conn, table):
+    """Fastest window over each record distance across all traces
+
+    Args:
+        conn (sqlite3.Connection): database connection
+        table (string): events table joined on the date to get the event name and distance
+
+    Return:
+        (list): dicts with label, seconds, date, race, dist (event distance in km) and start_km
+    """
+
+    create_table(conn)
+    best = []
+    for label in RECORD_DISTANCES:
+        row = conn.execute(f"""SELECT r.seconds, r.date, e.race, e.dist, r.start_km FROM records r
+                           LEFT JOIN {table} e ON e.date = r.date
+                           WHERE r.distance = ? AND r.seconds > 0 ORDER BY r.seconds LIMIT 1""", (label,)).fetchone()
+        if row:
+            seconds, date, race, dist, start_km = row
+            best.append({'label': label, 'seconds': seconds, 'date': date, 'race': race or '', 'dist': dist, 'start_km': start_km})
+    return best
+
+
+def record_kind(label, event_dist):
+    """PR if the record was set on an event of the record distance, PB otherwise"""
+
+    distance_km = RECORD_DISTANCES[label] / 1000
+    if event_dist and abs(event_dist - distance_km) <= RACE_DISTANCE_TOLERANCE * distance_km:
+        return 'PR'
+    return 'PB'
+
+
+def format_duration(seconds):
+    """Format seconds as h:mm:ss"""
+
+    seconds = int(round(seconds))
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
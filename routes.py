@@ -0,0 +1,58 @@
+import logging
+import numpy as np
+import trace_metrics
+
+logger = logging.getLogger(__name__)
+
+# consecutive stages whose end and start are closer than this are joined into one continuous line (m)
+SNAP_DISTANCE = 250
+
+
+def dedupe_points(points):
+    """Remove consecutive duplicate points of a (n, 2) array"""
+
+    if len(points) < 2:
+        return points
+    moved = np.any(np.diff(points, axis=0) != 0, axis=1)
+    return points[np.concatenate(([True], moved))]
+
+
+def stitch_route(stages, snap_distance=SNAP_DISTANCE):
+    """Assemble the traces of consecutive stages into as few continuous lines as possible
+
+    The start of a stage closer than snap_distance to the end of the previous one is snapped on it,
+    the shared endpoint being stored once. Stages separated by a larger gap start a new part.
+
+    Args:
+        stages (list): (lat, lon) points of every stage, in route order
+        snap_distance (float): maximum gap in meters between two stages joined together
+
+    Return:
+        (tuple): parts (list of lists of [lat, lon]), stage index (for every part, list of
+                 [first vertex, stage number] pairs, used to find the stage of a clicked vertex)
+    """
+
+    parts, index = [], []
+    previous_end = None
+
+    for number, points in enumerate(stages):
+        points = dedupe_points(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+        if not len(points):
+            continue
+
+        gap = None
+        if previous_end is not None:
+            gap = trace_metrics.step_distances(np.array([previous_end[0], points[0][0]]),
+                                               np.array([previous_end[1], points[0][1]]))[0]
+
+        if gap is not None and gap <= snap_distance:
+            # snap: the stage starts on the last vertex of the current part
+            index[-1].append([sum(len(p) for p in parts[-1]) - 1, number])
+            parts[-1].append(points[1:])
+        else:
+            index.append([[0, number]])
+            parts.append([points])
+        previous_end = points[-1]
+
+    parts = [np.concatenate(chunks).round(6).tolist() for chunks in parts]
+    return parts, index
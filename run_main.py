@@ -1,18 +1,18 @@
+import logging
 from run_map import RunMap
+from scheduler import Scheduler
 
 if __name__ == '__main__':
 
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # stages run concurrently when independent and are skipped when their inputs did not change
     run_map = RunMap()
-    run_map.load_csv_file()
-    run_map.update_database()
-    run_map.generate_map()
-    run_map.generate_events_table()
-    run_map.generate_eventometer()
-    run_map.save_map()
-    ftp_success = run_map.upload_to_ftp(html=True, jpg=True, gpx=True, force=False)
-    
-    if ftp_success:
+    scheduler = Scheduler(run_map.pipeline_stages(), state_file=run_map.pipeline_state)
+    status = scheduler.run(force=False)
+    run_map.write_profile_report()
+
+    if 'failed' not in status.values():
         run_map.open_blog_page()
     else:
-        print("Skipping blog page opening due to FTP upload failure.")
-
+        print("Skipping blog page opening due to failed stages: " + ', '.join(k for k, v in status.items() if v == 'failed'))
@@ -1,19 +1,27 @@
 import os
+import re
 import json
+import logging
 import sqlite3
-import folium
-import calendar
-import gpxpy
-import pandas as pd
 import webbrowser
+import minify
+import spatial_index
+from instrumentation import Profiler, stage
+from scheduler import Stage
 from statistics import mean
 from ftplib import FTP
 from dotenv import load_dotenv
 from collections import OrderedDict
 load_dotenv()
 
+# folium, numpy and pandas are imported in the methods using them, so that commands only
+# querying the database or uploading files start without their import cost
+
+logger = logging.getLogger(__name__)
+
 CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
 DATABASE_PATH = os.path.join(CURRENT_FOLDER, "run_map.db")
+SPATIAL_INDEX_TABLE = "run_map_rtree"
 
 
 class RunMap:
@@ -25,6 +33,8 @@ class RunMap:
             json_file (string): path to json file containing all map settings
         """
 
+        self.settings_path = os.path.abspath(settings)
+
         with open(settings, 'r') as jf:
             spreadsheet_json = json.loads(jf.read())
 
@@ -49,41 +59,131 @@ class RunMap:
             self.gpx_opacity = spreadsheet_json['gpx_opacity']
             self.gpx_smoothness = spreadsheet_json['gpx_smoothness']
             self.blog_event_page = spreadsheet_json['blog_event_page']
+            self.database_path = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('database', DATABASE_PATH))
+            self.pipeline_state = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('pipeline_state', 'reports/run_map_state.json'))
+            self.profile_report = spreadsheet_json.get('profile_report', '')
+            self.profile_memory = spreadsheet_json.get('profile_memory', False)
+            self.minify_outputs = spreadsheet_json.get('minify_outputs', False)
+            self.dist_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('dist_folder', 'dist/run_map'))
+            self.trace_store_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('trace_store', 'cache/run_map_traces'))
+            self.heatmap = spreadsheet_json.get('heatmap', False)
+            self.stream_map = spreadsheet_json.get('stream_map', False)
+            self.draw_repeats_once = spreadsheet_json.get('draw_repeats_once', False)
+            self.year_chunks = spreadsheet_json.get('year_chunks', False)
+            self.year_chunks_recent = spreadsheet_json.get('year_chunks_recent', 2)
+            self.heatmap_cache = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('heatmap_cache', 'cache/run_map_heatmap.npz'))
+            self.sparkline_cache = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('sparkline_cache', 'cache/run_map_sparklines.json'))
+            self.tiles = spreadsheet_json.get('tiles', False)
+            self.tiles_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('tiles_folder', 'html/tiles/run_map'))
+            self.tile_max_zoom = spreadsheet_json.get('tile_max_zoom', 10)
+            self.search_index_json = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('search_index', 'html/run_map_search.json'))
+            self.csv_report_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('csv_report_folder', 'reports'))
+            self.export_folder = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('export_folder', 'export/run_map'))
+            self.export_formats = spreadsheet_json.get('export_formats', [])
+            self.export_tolerance = spreadsheet_json.get('export_tolerance', 5)
+            self.table_mode = spreadsheet_json.get('table_mode', 'static')
+            self.events_table_json = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('events_table_json', 'html/events_table.json'))
+            self.data_table_js = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('data_table_js', 'html/data_table.js'))
+            self.pb_pr_template = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('pb_pr_template', 'html/pb_pr_template.html'))
+            self.pb_pr_html = os.path.join(CURRENT_FOLDER, spreadsheet_json.get('pb_pr_html', 'html/pb_pr.html'))
+
+            logger.info('Json settings loaded successfully')
+
+        # instrumentation of the pipeline stages
+        self.profiler = Profiler('run_map', trace_memory=self.profile_memory)
+
+        # packed gpx traces, heatmap grid, tile renderer and database connection, opened on first use and kept for the lifetime of the object
+        self.trace_store = None
+        self.heatmap_grid = None
+        self.sparklines = None
+        self.tile_renderer = None
+        self.db_connection = None
+        # results of the stages read by generate_map, which computes them only when their stage did not run
+        self.trace_store_updated = False
+        self.courses = None
+        # writer of the map being built when streaming it to its html file
+        self.map_writer = None
+        # year layers of the map being built, the older years written to javascript chunks
+        self.year_layers = None
+
+        # connections shared between sites by batch_main.py, curl and a new ftp session per upload when None
+        self.http = None
+        self.ftp_pool = None
+        # stored traces of gpx files not in the spreadsheet are removed, unless the store is shared
+        self.prune_trace_store = True
+
+        self.load_templates()
+        self.reset_counters()
+
+    def load_templates(self):
+        """Load html popup contents"""
 
-            print('Json settings loaded successfully')
-
-        # load html popup contents
         with open(self.popup_contents_html) as f:
             self.html_popup = f.read()
 
-        # define counters for the eventometer
+    def reset_counters(self):
+        """Define counters for the eventometer"""
+
         self.dist_count = 0
         self.dplus_count = 0
         self.halfs_count = 0
         self.marathons_count = 0
         self.ultras_count = 0
 
+    def compute_counters(self):
+        """Compute the eventometer counters from the spreadsheet data"""
+
+        self.reset_counters()
+
+        for dist, dplus in zip(self.distF_list, self.dplus_list):
+            # add distance and dplus to counter
+            self.dist_count += dist
+            if dplus:
+                self.dplus_count += dplus
+
+            # count race categories based on distance
+            if 21 <= dist <= 22:
+                self.halfs_count += 1
+            elif 42 <= dist < 45:
+                self.marathons_count += 1
+            elif dist >= 45:
+                self.ultras_count += 1
+
     def download_spreadsheet_as_csv(self):
         """Download google spreadsheet as csv file"""
 
         os.makedirs(os.path.dirname(self.events_csv), exist_ok=True)
 
-        command = f'curl -L "https://docs.google.com/spreadsheets/d/{self.sheet_id}/export?exportFormat=csv" -o {self.events_csv}'
-        os.system(command)
+        url = f'https://docs.google.com/spreadsheets/d/{self.sheet_id}/export?exportFormat=csv'
+        if self.http:
+            self.http.download(url, self.events_csv)
+        else:
+            os.system(f'curl -L "{url}" -o {self.events_csv}')
 
         if not os.path.isfile(self.events_csv):
-            print(f'Error downloading the spreadsheet at location {self.events_csv}')
+            logger.warning(f'Error downloading the spreadsheet at location {self.events_csv}')
+
+    @stage()
+    def load_csv_file(self, download=True):
+        """Extracts and formats data from the csv file
+
+        Args:
+            download (bool): download the spreadsheet first, otherwise read the local csv file
+        """
 
-    def load_csv_file(self):
-        """Extracts and formats data from the csv file"""
+        import csv_schema
 
-        print('\n' + ' DOWNLOAD AND READ SPREADSHEET '.center(100, '#'))
+        logger.info('\n' + ' DOWNLOAD AND READ SPREADSHEET '.center(100, '#'))
 
         # download and update csv file
-        self.download_spreadsheet_as_csv()
+        if download:
+            self.download_spreadsheet_as_csv()
 
-        # extract race infos into a panda dataframe
-        data = pd.read_csv(self.events_csv).fillna('')
+        # typed race infos, rows with a missing or invalid date, name or position are skipped and reported
+        data, report = csv_schema.read_csv(self.events_csv, csv_schema.RUN_EVENTS)
+        report.log()
+        report.write(csv_schema.report_path(self.csv_report_folder, self.events_csv))
+        self.profiler.count('csv_rows_skipped', len(report.dropped_lines))
 
         # store information into lists
         self.date_list = list(data['Date'])
@@ -100,23 +200,12 @@ class RunMap:
         self.post_list = list(data['Post'])
         self.color_list = list(data['Color'])
 
-        # format date as 'Day FullMonthName Year'
-        self.dateF_list = []
-        for date in self.date_list:
-            date = [int(d) for d in date.split('.')]
-            date = f'{date[0]} {calendar.month_name[date[1]]} {date[2]}'
-            self.dateF_list.append(date)
-
-        # format time entries as 'Xh Ymin Zsec'
-        self.timeF_list = []
-        for time in self.time_list:
-            if len(time.split(':')) == 3:
-                time = time.split(':')
-                time = f'{time[0]}h {time[1]}min {time[2]}sec'
-            self.timeF_list.append(time)
+        # format date as 'Day FullMonthName Year' and time entries as 'Xh Ymin Zsec'
+        self.dateF_list = csv_schema.format_dates(self.date_list)
+        self.timeF_list = csv_schema.format_times(self.time_list)
 
-        # get distance list as floats
-        self.distF_list = [float(dist) for dist in self.dist_list]
+        # distances are parsed as floats by the schema
+        self.distF_list = self.dist_list
 
         # list of jpg web links
         self.jpg_links = []
@@ -131,13 +220,29 @@ class RunMap:
         for gpx_file in data['Gpx']:
             path = os.path.join(CURRENT_FOLDER, self.gpx_folder, gpx_file) if gpx_file else ''
             self.gpx_files.append(path)
+        self.forget_stage_results()
 
+    def connect_database(self):
+        """Open the database connection, or reuse the one already opened by this object"""
+
+        if self.db_connection is None:
+            self.db_connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        return self.db_connection
+
+    def close_database(self):
+        """Close the database connection"""
+
+        if self.db_connection is not None:
+            self.db_connection.close()
+            self.db_connection = None
+
+    @stage()
     def update_database(self, rebuild=False):
         """Update database with new data"""
 
-        print('\n' + ' UPDATE DATABASE '.center(100, '#'))
+        logger.info('\n' + ' UPDATE DATABASE '.center(100, '#'))
 
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = self.connect_database()
         cursor = conn.cursor()
 
         # drop table to rebuild a brand new one
@@ -173,7 +278,8 @@ class RunMap:
             if date not in self.date_list:
                 # entry has been deleted from csv file, remove it from db too
                 cursor.execute("DELETE FROM run_map WHERE date=?", (date,))
-                print(f"Deleting from database entry with date {date}: Not in CSV file.")
+                self.profiler.count('db_deleted')
+                logger.debug(f"Deleting from database entry with date {date}: Not in CSV file.")
 
         # iterate through database, add or update entries
         data_iter = zip(self.date_list, self.race_list, self.loc_list, self.lat_list, self.lon_list,
@@ -200,7 +306,8 @@ class RunMap:
                                    WHERE date=?
                                    """, (race, loc, lt, ln, typ, dist, dplus, time, notes, link, post, jpg, gpx, date))
 
-                    print(f"Updating to database entry with date {date}: different values in CSV file.")
+                    self.profiler.count('db_updated')
+                    logger.debug(f"Updating to database entry with date {date}: different values in CSV file.")
 
             # new entry -> add it
             else:
@@ -208,20 +315,20 @@ class RunMap:
                                (date, race, loc, lt, ln, type, dist, dplus, time, notes, link, post, jpg, gpx) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)
                                """, (date, race, loc, lt, ln, typ, dist, dplus, time, notes, link, post, jpg, gpx))
 
-                print(f"Adding to database entry with date {date}: New entry.")
+                self.profiler.count('db_added')
+                logger.debug(f"Adding to database entry with date {date}: New entry.")
 
         # commit and close
         conn.commit()
         cursor.close()
-        conn.close()
 
-        print("Database updated successfully.")
+        logger.info("Database updated successfully.")
         self.check_dabase()
 
     def check_dabase(self):
         """Check the database properties"""
 
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = self.connect_database()
         cursor = conn.cursor()
 
         # database rows
@@ -232,17 +339,16 @@ class RunMap:
         cursor.execute("PRAGMA table_info(run_map)")
         columns = cursor.fetchall()
 
-        print(f"Path: {DATABASE_PATH}")
-        print(f"Rows: {rows}")
-        print(f"Columns: {len(columns)}")
+        logger.info(f"Path: {self.database_path}")
+        logger.info(f"Rows: {rows}")
+        logger.info(f"Columns: {len(columns)}")
 
         cursor.close()
-        conn.close()
 
     def search_database(self, sql_query):
         """Search the database"""
 
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = self.connect_database()
         cursor = conn.cursor()
 
         # print sql query results
@@ -257,12 +363,126 @@ class RunMap:
             print('SQL request returned no result.')
 
         cursor.close()
-        conn.close()
 
+    @stage()
+    def update_spatial_index(self):
+        """Index the event locations and the gpx trace bounding boxes in a database R*Tree"""
+
+        logger.info('\n' + ' UPDATE SPATIAL INDEX '.center(100, '#'))
+
+        store = self.current_trace_store()
+        features = []
+        for date, race, lt, ln, gpx in zip(self.date_list, self.race_list, self.lat_list, self.lon_list, self.gpx_files):
+            if lt != '' and ln != '':
+                features.append(('event', date, race, (lt, ln, lt, ln)))
+            if gpx and store.bbox(gpx):
+                features.append(('trace', date, race, store.bbox(gpx)))
+
+        count = spatial_index.rebuild_index(self.connect_database(), SPATIAL_INDEX_TABLE, features)
+        self.profiler.count('indexed_features', count)
+        logger.info(f'Spatial index updated: {count} features')
+
+    def features_within(self, lat, lon, radius_km, kinds=None):
+        """Indexed features within a distance of a point, sorted by distance
+
+        Args:
+            lat (float): latitude of the point
+            lon (float): longitude of the point
+            radius_km (float): search radius in km
+            kinds (list): restrict the results to these feature kinds (event, trace)
+
+        Return:
+            (list): dicts with kind, date, label, bbox and distance_km
+        """
+        return spatial_index.query_radius(self.connect_database(), SPATIAL_INDEX_TABLE, lat, lon, radius_km, kinds)
+
+    def features_in_bbox(self, min_lat, min_lon, max_lat, max_lon, kinds=None):
+        """Indexed features intersecting a bounding box (cli.py query --bbox)
+
+        Args:
+            kinds (list): restrict the results to these feature kinds (event, trace)
+
+        Return:
+            (list): dicts with kind, date, label and bbox
+        """
+        return spatial_index.query_bbox(self.connect_database(), SPATIAL_INDEX_TABLE, min_lat, min_lon, max_lat, max_lon, kinds)
+
+    @stage()
+    def update_trace_metrics(self):
+        """Compute distance, D+, moving time and km splits from the full resolution gpx files
+
+        Results are stored in the trace_metrics table next to the spreadsheet values, traces whose
+        metrics differ from the spreadsheet are flagged and logged.
+        """
+
+        import trace_metrics
+
+        logger.info('\n' + ' UPDATE TRACE METRICS '.center(100, '#'))
+
+        store = self.current_trace_store()
+        entries = zip(self.date_list, self.gpx_files, self.distF_list, self.dplus_list)
+        mismatches = trace_metrics.update_metrics(self.connect_database(), entries, store, profiler=self.profiler)
+
+        for date, gpx, mismatch in mismatches:
+            logger.warning(f'Trace metrics of {date} ({os.path.basename(gpx)}) differ from the spreadsheet: {mismatch}')
+        self.profiler.count('metrics_mismatches', len(mismatches))
+        logger.info(f'Trace metrics updated: {len(mismatches)} mismatches')
+
+    @stage()
+    def update_overlaps(self):
+        """Find the repeated courses and the streets shared by the gpx traces, stored in the trace_overlap table
+
+        Return:
+            (dict): gpx path -> gpx path of the newest event of its course
+        """
+
+        import overlap
+
+        logger.info('\n' + ' UPDATE TRACE OVERLAPS '.center(100, '#'))
+
+        store = self.current_trace_store()
+        courses = overlap.update_overlaps(self.connect_database(), zip(self.date_list, self.gpx_files), store, profiler=self.profiler)
+
+        repeats = sum(gpx != course for gpx, course in courses.items())
+        self.profiler.count('repeated_courses', repeats)
+        logger.info(f'Trace overlaps updated: {len(courses)} traces, {repeats} repeats of {len(set(courses.values()))} courses')
+        self.courses = courses
+        return courses
+
+    def database_stats(self):
+        """Compute the eventometer statistics from the database
+
+        Return:
+            (dict): number of events, total distance and D+, number of halfs, marathons and ultras
+        """
+
+        conn = self.connect_database()
+        cursor = conn.cursor()
+
+        cursor.execute("""SELECT COUNT(*), TOTAL(dist), TOTAL(dplus),
+                          TOTAL(dist >= 21 AND dist <= 22), TOTAL(dist >= 42 AND dist < 45), TOTAL(dist >= 45)
+                          FROM run_map""")
+        events, dist, dplus, halfs, marathons, ultras = cursor.fetchone()
+        cursor.close()
+
+        return {'events': events, 'distance_km': round(dist, 1), 'dplus_m': int(dplus),
+                'halfs': int(halfs), 'marathons': int(marathons), 'ultras': int(ultras)}
+
+    @stage()
     def generate_map(self):
         """Generates the map as a html file"""
 
-        print('\n' + ' GENERATING HTML MAP '.center(100, '#'))
+        import folium
+        import folium_elements
+        import map_writer
+        import year_layers
+        import overlap
+
+        logger.info('\n' + ' GENERATING HTML MAP '.center(100, '#'))
+
+        # results of the stages run before the map by the pipeline, computed here when missing (watch and cli builds)
+        self.current_trace_store()
+        sparklines = self.sparklines if self.sparklines is not None else self.update_sparklines()
 
         # center map based on race locations
         start_lat = mean([min(self.lat_list), max(self.lat_list)])
@@ -270,6 +490,13 @@ class RunMap:
 
         # create map object
         self.run_map = folium.Map(location=[start_lat, start_lon], tiles=None, zoom_start=self.zoom_start)
+        self.vector_layers = {}
+        self.marker_layers = {}
+        # traces written to the html file as they are added instead of being kept until save_map
+        self.map_writer = map_writer.MapWriter(self.run_map) if self.stream_map else None
+        # markers and traces of every year in a layer of their feature group, older years loaded on demand
+        self.year_layers = year_layers.YearLayers(self.run_map, self.run_map_html, map(year_layers.event_year, self.date_list),
+                                                  self.year_chunks_recent) if self.year_chunks else None
 
         folium.TileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/NatGeo_World_Map/MapServer/tile/{z}/{y}/{x}',
                          attr='Tiles &copy; Esri &mdash; National Geographic, Esri, DeLorme, NAVTEQ, UNEP-WCMC, USGS, NASA,'
@@ -306,31 +533,32 @@ class RunMap:
                         feature_groups[color] = folium.FeatureGroup(name=legend_txt.format(txt=group_name, col=color)).add_to(self.run_map)
         
         # add markers based on csv file data
-        data_iter = zip(self.dateF_list, self.race_list, self.loc_list, self.lat_list, self.lon_list,
+        data_iter = zip(self.date_list, self.dateF_list, self.race_list, self.loc_list, self.lat_list, self.lon_list,
                         self.type_list, self.distF_list, self.dplus_list, self.timeF_list, self.notes_list,
                         self.link_list, self.post_list, self.jpg_links, self.gpx_files, self.color_list)
 
-        for date, race, loc, lt, ln, typ, dist, dplus, time, notes, link, post, jpg, gpx, color in data_iter:
+        # traces also drawn as raster tiles at low zooms
+        tile_entries = []
+        # repeated courses drawn once per layer (feature group and year): gpx -> course gpx
+        courses = (self.courses if self.courses is not None else self.update_overlaps()) if self.draw_repeats_once else {}
+        drawn_courses = set()
 
-            print(f'Loading {race}')
+        def layer_key(group, raw_date):
+            return (group if group in feature_groups else None, year_layers.event_year(raw_date) if self.year_layers else None)
 
-            # add distance and dplus to counter
-            self.dist_count += dist
-            if dplus:
-                self.dplus_count += dplus
+        # trace drawn for every course of every layer, the one of its newest event by date: (layer key, course gpx) -> gpx
+        course_traces = overlap.course_traces(((layer_key(color, raw_date), raw_date, gpx) for raw_date, color, gpx
+                                               in zip(self.date_list, self.color_list, self.gpx_files)), courses)
+
+        for raw_date, date, race, loc, lt, ln, typ, dist, dplus, time, notes, link, post, jpg, gpx, color in data_iter:
+
+            logger.debug(f'Loading {race}')
+            self.profiler.count('events')
 
             # use color directly from spreadsheet
             str_dist = str(dist)
             race_color = color if color else 'blue'  # default color if none specified
 
-            # count race categories based on distance
-            if 21 <= dist <= 22:
-                self.halfs_count += 1
-            elif 42 <= dist < 45:
-                self.marathons_count += 1
-            elif dist >= 45:
-                self.ultras_count += 1
-
             # delete the blog post line if link not in csv file
             if not str(post).lower().startswith('http'):
                 html_contents = self.html_popup.replace(' | <a href="{post}" target="_blank">Blog Post</a>', '')
@@ -344,46 +572,179 @@ class RunMap:
             if dplus:
                 str_dist += f' | {int(dplus)} D+'
 
-            # create the iFrame popup
-            iframe = folium.IFrame(
-                width=self.popup_width, height=self.popup_height, html=html_contents.format(
-                    race=race, date=date, loc=loc, typ=typ, dist=str_dist, time=time,
-                    notes=notes, link=link, post=post, pic=jpg, race_clr=race_color
-                )
-            )
+            # marker with its popup template and fields, formatted in the browser
+            popup_fields = dict(race=race, date=date, loc=loc, typ=typ, dist=str_dist, time=time,
+                                notes=notes, link=link, post=post, pic=jpg, race_clr=race_color,
+                                profile=sparklines.svg(gpx))
+            marker = ([lt, ln], folium_elements.awesome_icon(race_color), race, html_contents, popup_fields)
 
-            # add marker to feature groups
-            folium_marker = folium.Marker(location=[lt, ln], tooltip=race, popup=folium.Popup(iframe),
-                                          icon=folium.Icon(color=race_color))
+            # add markers and gpx traces to Feature Groups based on color
+            # (to map directly if no color or color not in feature groups), in the layer of their year
+            layer = feature_groups[color] if color and color in feature_groups else self.run_map
+            if self.year_layers:
+                layer = self.year_layers.layer(layer, year_layers.event_year(raw_date))
 
-            # process gpx data
+            # process gpx data, unless the course is drawn in the layer with the trace of another event
             folium_gpx = None
-            if gpx:
-                points = self.process_gpx_to_df(gpx)
-                folium_gpx = folium.PolyLine(points, color=race_color, weight=self.gpx_weight,
-                                             opacity=self.gpx_opacity).add_to(self.run_map)
-
-            # add markers and gpx traces to Feature Groups based on color
-            if color and color in feature_groups:
-                folium_marker.add_to(feature_groups[color])
-                if folium_gpx:
-                    folium_gpx.add_to(feature_groups[color])
-            else:
-                # Add to map directly if no color or color not in feature groups
-                folium_marker.add_to(self.run_map)
-                if folium_gpx:
-                    folium_gpx.add_to(self.run_map)
+            course = (layer_key(color, raw_date), courses.get(gpx, gpx))
+            if gpx and (course in drawn_courses or course_traces[course] != gpx):
+                self.profiler.count('repeat_traces')
+            elif gpx:
+                with self.profiler.span(os.path.basename(gpx), category='gpx'):
+                    points = self.process_gpx_to_df(gpx)
+                if points:
+                    folium_gpx = folium.PolyLine(points, color=race_color, weight=self.gpx_weight,
+                                                 opacity=self.gpx_opacity)
+                    tile_entries.append((gpx, race_color))
+                    drawn_courses.add(course)
+
+            # add the marker and the trace to their layer
+            self.marker_layer(layer).add_marker(*marker)
+            if folium_gpx:
+                folium_gpx.add_to(self.vector_layer(layer))
+
+            # write the trace right away instead of keeping its points until the map is saved
+            writer = self.layer_writer(layer)
+            if folium_gpx and writer:
+                writer.flush(folium_gpx)
+
+        if self.year_layers:
+            self.year_layers.close()
+        if self.tiles:
+            self.add_trace_tiles(self.run_map, tile_entries)
+        if self.heatmap:
+            self.add_heatmap(self.run_map)
+
+        # search box over the index written next to the map (published in the same folder)
+        folium_elements.SearchControl(os.path.basename(self.search_index_json)).add_to(self.run_map)
 
         # add layer control (legend), each feature group will be a different category
         self.run_map.add_child(folium.LayerControl(position='topright', collapsed=True, autoZIndex=True))
 
+    def layer_writer(self, layer):
+        """Writer of the features of a layer: the chunk of its year, the map writer or None"""
+
+        if self.year_layers:
+            return self.year_layers.writer(layer, self.map_writer)
+        return self.map_writer
+
+    def marker_layer(self, parent):
+        """Bulk marker layer of a feature group or of the map, created on first use
+
+        Args:
+            parent (folium.FeatureGroup or folium.Map): layer showing the markers
+        """
+
+        import folium_elements
+
+        name = parent.get_name()
+        if name not in self.marker_layers:
+            self.marker_layers[name] = folium_elements.BulkMarkers(self.popup_width, self.popup_height).add_to(parent)
+            writer = self.layer_writer(parent)
+            if writer:
+                # still receiving markers, written with the rest of the map by save_map (or with its year chunk)
+                writer.defer(self.marker_layers[name])
+        return self.marker_layers[name]
+
+    def vector_layer(self, parent):
+        """Layer receiving the vector traces of a feature group or of the map
+
+        With raster tiles the traces go to a sub group of the parent only shown above the zooms
+        of the tiles, see add_trace_tiles.
+
+        Args:
+            parent (folium.FeatureGroup or folium.Map): layer showing the traces without tiles
+        """
+
+        if not self.tiles:
+            return parent
+
+        import folium
+        import folium_elements
+
+        name = parent.get_name()
+        if name not in self.vector_layers:
+            layer = folium.FeatureGroup(control=False, show=False).add_to(parent)
+            band = folium_elements.ZoomBand(layer, self.tile_max_zoom + 1).add_to(parent)
+            writer = self.layer_writer(parent)
+            if writer:
+                # rendered after the layer, which may be written to a year chunk
+                writer.defer(band)
+            self.vector_layers[name] = layer
+        return self.vector_layers[name]
+
+    def add_trace_tiles(self, folium_map, entries):
+        """Render the raster tiles of the traces and add them to the map up to the tile max zoom
+
+        Args:
+            folium_map (folium.Map): map receiving the tile layer
+            entries (list): (gpx path, color) of every trace drawn on the map
+        """
+
+        import folium
+
+        renderer = self.load_tile_renderer()
+        rendered = renderer.update(entries, self.load_trace_store(), profiler=self.profiler)
+        if rendered:
+            self.profiler.count('tiles_rendered', rendered)
+            logger.info(f'Trace tiles updated: {rendered} tiles rendered')
+
+        folium.TileLayer(renderer.tile_url(self.run_map_html), attr='Traces', name='Traces', overlay=True, control=False,
+                         min_zoom=0, max_zoom=self.tile_max_zoom).add_to(folium_map)
+
+    @stage()
+    def update_sparklines(self):
+        """Compute the elevation profiles of the new or modified traces, drawn in the popups ({profile} field)
+
+        Return:
+            (sparkline.ProfileCache): profiles of all traces
+        """
+
+        import sparkline
+
+        if self.sparklines is None:
+            self.sparklines = sparkline.ProfileCache(self.sparkline_cache)
+        computed = self.sparklines.update(self.gpx_files, self.load_trace_store(), profiler=self.profiler)
+        if computed:
+            self.profiler.count('profiles', computed)
+            logger.info(f'Elevation profiles updated: {computed} traces')
+        return self.sparklines
+
+    def add_heatmap(self, folium_map):
+        """Add the heatmap of all traces as a hidden feature group, with one heat layer per zoom band
+
+        Args:
+            folium_map (folium.Map): map receiving the feature group
+        """
+
+        import folium
+        import heatmap
+        import folium_elements
+        from folium.plugins import HeatMap
+
+        if self.heatmap_grid is None:
+            self.heatmap_grid = heatmap.HeatmapGrid(self.heatmap_cache)
+        binned = self.heatmap_grid.update(self.gpx_files, self.load_trace_store(), profiler=self.profiler)
+        if binned:
+            logger.info(f'Heatmap updated: {binned} traces binned')
+
+        feature_group = folium.FeatureGroup(name='Heatmap', show=False).add_to(folium_map)
+        for band, (min_zoom, max_zoom) in enumerate(self.heatmap_grid.bands):
+            heat = self.heatmap_grid.band_heat(band)
+            # full intensity from the lowest zoom of the band, the layer is hidden outside of it
+            layer = HeatMap(heat, min_opacity=0.3, max_zoom=min_zoom, radius=heatmap.CELL_PIXELS + 2,
+                            blur=heatmap.CELL_PIXELS, control=False, show=False).add_to(feature_group)
+            folium_elements.ZoomBand(layer, min_zoom, max_zoom).add_to(feature_group)
+            self.profiler.count('heat_cells', len(heat))
+
+    @stage()
     def generate_events_table(self):
         """Generate the html events table embebbed on the website"""
 
-        print('\n' + ' GENERATING EVENTS TABLE HTML FILE '.center(100, '#'))
+        logger.info('\n' + ' GENERATING EVENTS TABLE HTML FILE '.center(100, '#'))
 
         if not os.path.isfile(self.events_table_template):
-            print(f'{self.events_table_template} is not a valid filepath. Skipping this step.')
+            logger.warning(f'{self.events_table_template} is not a valid filepath. Skipping this step.')
             return
 
         with open(self.events_table_template, 'r', encoding='utf-8') as input_file:
@@ -394,7 +755,11 @@ class RunMap:
         current_year = ''
 
         if html_marker not in html_contents:
-            print('html marker not found in template file. Skipping this step.')
+            logger.warning('html marker not found in template file. Skipping this step.')
+            return
+
+        if self.table_mode == 'virtual':
+            self.write_events_table_data(html_contents)
             return
 
         # create data iterator from spreadsheet
@@ -439,11 +804,99 @@ class RunMap:
         with open(self.events_table_html, 'w', encoding='utf-8') as output_file:
             output_file.write(html_contents)
 
-        print(f'Events table html file created successfully at location {self.events_table_html}')
+        logger.info(f'Events table html file created successfully at location {self.events_table_html}')
+
+    def write_events_table_data(self, template):
+        """Write the events as json rows drawn by the virtualized table page (table_mode 'virtual')
 
+        Args:
+            template (string): html contents of the events table template
+        """
+
+        import data_table
+
+        rows = []
+        data_iter = zip(self.date_list, self.race_list, self.loc_list, self.type_list, self.dist_list,
+                        self.dplus_list, self.time_list, self.link_list, self.post_list)
+        for date, race, loc, typ, dist, dplus, time, link, post in data_iter:
+            race_cell = f'<a href="{link}" target="_blank">{race}</a>' if link else race
+            dist_cell = f'{dist} km<br />{int(dplus)} m' if dplus else f'{dist} km'
+            rows.append([data_table.date_cell(date, post), race_cell, loc, typ, dist_cell, time])
+
+        # sort and filter keys of every row
+        keys = {
+            'date': [data_table.iso_date(date) for date in self.date_list],
+            'year': [int(date.split('.')[-1]) for date in self.date_list],
+            'race': self.race_list,
+            'loc': self.loc_list,
+            'type': self.type_list,
+            'dist': self.distF_list,
+            'time': [data_table.duration_seconds(time) for time in self.time_list],
+        }
+
+        options = {
+            'classes': ['tg-yw4l', 'tg-9hbo', 'tg-yw4l', 'tg-yw4l', 'tg-yw4l', 'tg-yw4l'],
+            'sort': ['date', 'race', 'loc', 'type', 'dist', 'time'],
+            'filters': [{'field': 'year', 'label': 'Year', 'kind': 'select'},
+                        {'field': 'type', 'label': 'Type', 'kind': 'select'},
+                        {'field': 'dist', 'label': 'Distance (km)', 'kind': 'range'}],
+            'separator': 'tg-d1kj',
+        }
+
+        if data_table.write_table(template, self.events_table_html, self.events_table_json, self.data_table_js, rows, keys, options):
+            self.profiler.count('table_rows', len(rows))
+            logger.info(f'Events table html and json files created successfully at location {self.events_table_html}')
+
+    def export_features(self):
+        """Events of the database and their simplified traces as GeoJSON features (generator)"""
+
+        import export
+        import data_table
+
+        store = self.current_trace_store()
+        cursor = self.connect_database().execute("SELECT date, race, loc, lt, ln, type, dist, dplus, time, link, gpx FROM run_map ORDER BY id")
+        for date, race, loc, lt, ln, typ, dist, dplus, time, link, gpx in cursor:
+            properties = export.feature_properties('event', data_table.iso_date(date), race, loc, typ, dist, dplus, time, link)
+            yield export.point_feature(lt, ln, properties)
+            track = store.track(gpx) if gpx else None
+            if track is not None:
+                yield export.trace_feature(track, self.export_tolerance, dict(properties, kind='trace'))
+
+    @stage()
+    def export_data(self, formats=None):
+        """Stream the events and traces to GeoJSONSeq, KML and FlatGeobuf files in the export folder
+
+        Args:
+            formats (list): export formats, see export.FORMATS, defaults to the export_formats setting
+        """
+
+        import export
+
+        logger.info('\n' + ' EXPORT DATA '.center(100, '#'))
+
+        paths = {fmt: os.path.join(self.export_folder, 'run_map' + export.FORMATS[fmt]) for fmt in formats or self.export_formats}
+        count = export.export_features(self.export_features(), paths, name='Run map')
+        self.profiler.count('exported_features', count)
+        logger.info(f'Data exported: {count} features to {self.export_folder}')
+
+    @stage()
+    def generate_search_index(self):
+        """Write the search index of the events, loaded by the search box of the map"""
+
+        import search_index
+
+        docs = [(race, f'{loc} | {date}', 'event', lt, ln)
+                for race, loc, date, lt, ln in zip(self.race_list, self.loc_list, self.dateF_list, self.lat_list, self.lon_list)]
+        size = search_index.write_index(self.search_index_json, docs)
+        self.profiler.count('search_docs', len(docs))
+        logger.info(f'Search index written: {len(docs)} entries, {size} bytes')
+
+    @stage()
     def generate_eventometer(self):
         """Generates the html event-o-meter embebbed as iframe on the main page"""
 
+        self.compute_counters()
+
         with open(self.eventometer_template, 'r') as input_file:
             html_contents = input_file.read()
             html_contents = html_contents.replace('<!--dist-->', str(int(self.dist_count)))
@@ -455,42 +908,219 @@ class RunMap:
         # write html file
         with open(self.eventometer_html, 'w', encoding='utf-8') as output_file:
             output_file.write(html_contents)
-            print(f'Eventometer html file created successfully at location {self.eventometer_template}')
+            logger.info(f'Eventometer html file created successfully at location {self.eventometer_template}')
+
+    @stage()
+    def update_records(self):
+        """Search the fastest 1 km, 5 km, 10 km, half and marathon windows of every timestamped gpx trace
+
+        Results are cached per gpx file in the records table, only new or modified traces are read.
+        """
+
+        import records
+
+        logger.info('\n' + ' UPDATE RECORDS '.center(100, '#'))
+
+        store = self.current_trace_store()
+        processed = records.update_records(self.connect_database(), zip(self.date_list, self.gpx_files), store, profiler=self.profiler)
+        self.profiler.count('records_traces', processed)
+        logger.info(f'Records updated: {processed} traces processed')
+
+    @stage()
+    def generate_records_table(self):
+        """Generate the PB/PR html table from the records and events stored in the database"""
+
+        import records
+
+        logger.info('\n' + ' GENERATING PB/PR TABLE HTML FILE '.center(100, '#'))
+
+        if not os.path.isfile(self.pb_pr_template):
+            logger.warning(f'{self.pb_pr_template} is not a valid filepath. Skipping this step.')
+            return
+
+        with open(self.pb_pr_template, 'r', encoding='utf-8') as input_file:
+            html_contents = input_file.read()
+
+        html_marker = '<!--InsertRecords-->'
+        indent = 2 * ' '
+
+        if html_marker not in html_contents:
+            logger.warning('html marker not found in template file. Skipping this step.')
+            return
+
+        def record_row(label, result, date, event):
+            row = indent + '<tr>\n'
+            row += 3 * indent + f'<td class="tg-j4kc" style="font-weight: bold;">{label}</td>\n'
+            row += 3 * indent + f'<td class="tg-s6z2">{result}</td>\n'
+            row += 3 * indent + f'<td class="tg-s6z2">{date}</td>\n'
+            row += 3 * indent + f'<td class="tg-s6z2">{event}</td>\n'
+            row += 2 * indent + '</tr>\n'
+            return row
+
+        # hand-maintained rows of the template (e.g. records of training runs without a gpx file), kept as they are:
+        # they replace the generated record of the same label, the others follow the distance records
+        manual_rows = OrderedDict()
+        manual_section = re.search(r'<!--ManualRecords-->\n?(.*?)<!--/ManualRecords-->\n?', html_contents, re.DOTALL)
+        if manual_section:
+            for row in re.findall(r'[ \t]*<tr>.*?</tr>\n?', manual_section.group(1), re.DOTALL):
+                label = re.search(r'<t[dh][^>]*>(.*?)</t[dh]>', row, re.DOTALL)
+                manual_rows[label.group(1).strip() if label else row] = row.rstrip('\n') + '\n'
+            html_contents = html_contents.replace(manual_section.group(0), '')
+
+        conn = self.connect_database()
+        rows = ''
+
+        # fastest windows found in the gpx traces, in the order of the record distances
+        best = {record['label']: record for record in records.best_records(conn, 'run_map')}
+        for label in records.RECORD_DISTANCES:
+            if label in manual_rows:
+                rows += manual_rows.pop(label)
+            elif label in best:
+                record = best[label]
+                kind = records.record_kind(label, record['dist'])
+                rows += record_row(label, records.format_duration(record['seconds']), record['date'], f"{record['race']} ({kind})")
+        rows += ''.join(manual_rows.values())
+
+        # longest events from the spreadsheet values
+        events = conn.execute("SELECT date, race, dist, dplus, time FROM run_map").fetchall()
+        if events:
+            date, race, dist, *_ = max(events, key=lambda e: e[2] or 0)
+            rows += record_row('Longest distance', f'{dist:g} km', date, f'{race} (PR)')
+
+            def seconds(time):
+                parts = str(time).split(':')
+                return sum(int(p) * 60 ** i for i, p in enumerate(reversed(parts))) if all(p.isdigit() for p in parts) else 0
+
+            date, race, *_, time = max(events, key=lambda e: seconds(e[4]))
+            if seconds(time):
+                rows += record_row('Longest time', time, date, f'{race} (PR)')
+
+            date, race, _, dplus, _ = max(events, key=lambda e: e[3] or 0)
+            if dplus:
+                rows += record_row('Max D+', f'{int(dplus)} m', date, f'{race} (PR)')
+
+        html_contents = html_contents.replace(html_marker, rows.rstrip('\n'))
+
+        # write html file
+        with open(self.pb_pr_html, 'w', encoding='utf-8') as output_file:
+            output_file.write(html_contents)
 
+        logger.info(f'PB/PR table html file created successfully at location {self.pb_pr_html}')
+
+    @stage()
     def save_map(self):
         """Saves the map as html file"""
-        print('\n' + ' SAVING HTML MAP '.center(100, '#'))
-        self.run_map.save(self.run_map_html)
-        print(f'Map saved at location {self.run_map_html}')
+        logger.info('\n' + ' SAVING HTML MAP '.center(100, '#'))
+        if self.map_writer:
+            # the traces were written while the map was built, see generate_map
+            self.map_writer.close(self.run_map_html)
+            self.map_writer = None
+        else:
+            self.run_map.save(self.run_map_html)
+        logger.info(f'Map saved at location {self.run_map_html}')
+
+    def html_outputs(self):
+        """List of html/css/json files published on the web server"""
+        outputs = [self.run_map_html, self.events_table_html, self.events_table_css, self.eventometer_html, self.pb_pr_html,
+                   self.search_index_json]
+        if self.table_mode == 'virtual':
+            outputs += [self.events_table_json, self.data_table_js]
+        if self.year_chunks:
+            import year_layers
+            outputs += year_layers.chunk_files(self.run_map_html)
+        return outputs
+
+    @stage()
+    def post_process_outputs(self):
+        """Minify html/css outputs and write precompressed .gz/.br copies in the dist folder"""
+
+        if not self.minify_outputs:
+            return
+
+        logger.info('\n' + ' MINIFYING AND COMPRESSING OUTPUTS '.center(100, '#'))
+        processed, skipped = minify.process_outputs(self.html_outputs(), self.dist_folder)
+        self.profiler.miss('minify', processed)
+        self.profiler.hit('minify', skipped)
+        logger.info(f'Outputs processed: {processed} minified, {skipped} unchanged')
+
+    def load_tile_renderer(self):
+        """Open the raster tiles renderer, or reuse the one already opened by this object"""
+
+        import tile_renderer
+
+        if self.tile_renderer is None:
+            # thinner lines than the vector traces, the tiles are only shown zoomed out
+            self.tile_renderer = tile_renderer.TileRenderer(self.tiles_folder, max_zoom=self.tile_max_zoom,
+                                                            width=max(1, self.gpx_weight // 2), opacity=self.gpx_opacity)
+        return self.tile_renderer
+
+    def load_trace_store(self):
+        """Open the packed trace store, or reuse the one already opened by this object"""
+
+        import trace_store
+
+        if self.trace_store is None:
+            self.trace_store = trace_store.TraceStore(self.trace_store_folder)
+        return self.trace_store
+
+    @stage()
+    def update_trace_store(self):
+        """Pack the gpx traces of the spreadsheet into the trace store, reading only new or modified files
+
+        Return:
+            (TraceStore): the updated store
+        """
+
+        store = self.load_trace_store()
+        read = store.update(self.gpx_files, prune=self.prune_trace_store, profiler=self.profiler)
+        if read:
+            self.profiler.count('gpx_files', read)
+            logger.info(f'Trace store updated: {read} gpx files read, {len(store)} traces stored')
+        self.trace_store_updated = True
+        return store
+
+    def current_trace_store(self):
+        """Trace store up to date with the gpx files of the spreadsheet, updated only if not done since the spreadsheet was read"""
+
+        return self.load_trace_store() if self.trace_store_updated else self.update_trace_store()
+
+    def forget_stage_results(self):
+        """Forget the trace store state and the results of the trace stages, computed again on next use (new spreadsheet or gpx files)"""
+
+        self.trace_store_updated = False
+        self.sparklines = None
+        self.courses = None
 
     def process_gpx_to_df(self, gpx_file):
-        """Parse the gpx data into a dataframe
+        """Get the points of a trace (gpx, tcx or fit file) from the trace store
 
         Args:
-            gpx_file (string): path to gpx file
-            step (int): slicing step for storing gpx points to avoid using too much data
+            gpx_file (string): path to the trace file
 
         Return:
-            (list): list of tuples (lat, long) for each data point
+            (list): list of [lat, long] for every gpx_smoothness point
         """
 
-        if not os.path.isfile(gpx_file) and not gpx_file.lower().endswith('.gpx'):
-            print(f'Invalid gpx file {gpx_file}')
-            return
+        import traces
+
+        if not os.path.isfile(gpx_file) or not gpx_file.lower().endswith(traces.TRACK_EXTENSIONS):
+            logger.warning(f'Invalid trace file {gpx_file}')
+            return None
 
-        gpx = gpxpy.parse(open(gpx_file))
-        track = gpx.tracks[0]
-        segment = track.segments[0]
+        store = self.load_trace_store()
+        if not store.is_current(gpx_file):
+            store.update([gpx_file], profiler=self.profiler)
 
-        # Make points tuple for lines
-        points = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points[::self.gpx_smoothness]:
-                    points.append(tuple([point.latitude, point.longitude]))
+        coordinates = store.coordinates(gpx_file)
+        if coordinates is None:
+            return None
 
+        # float32 coordinates rounded back to 6 decimals (~0.1 m) to keep the html small
+        points = coordinates[::self.gpx_smoothness].astype('float64').round(6).tolist()
+        self.profiler.count('gpx_points', len(points))
         return points
 
+    @stage()
     def upload_to_ftp(self, html=True, jpg=True, gpx=True, force=False):
         """Uploads map and files to ftp server
         
@@ -508,25 +1138,27 @@ class RunMap:
 
         # Check if all required environment variables are set
         if not all([ftp_address, ftp_user, ftp_pwd, ftp_start_dir]):
-            print("❌ Error: Missing FTP environment variables in .env file")
-            print("Required variables: FTP_ADDRESS, FTP_USER, FTP_PWD, FTP_START_DIR")
+            logger.error("❌ Error: Missing FTP environment variables in .env file")
+            logger.error("Required variables: FTP_ADDRESS, FTP_USER, FTP_PWD, FTP_START_DIR")
             return False
 
         try:
-            print(f"🔄 Connecting to FTP server: {ftp_address}")
-            ftp = FTP(ftp_address)
-            
-            print("🔄 Logging in...")
-            ftp.login(user=ftp_user, passwd=ftp_pwd, acct='')
+            logger.info(f"🔄 Connecting to FTP server: {ftp_address}")
+            if self.ftp_pool:
+                ftp = self.ftp_pool.acquire(ftp_address, ftp_user, ftp_pwd)
+            else:
+                ftp = FTP(ftp_address)
+                logger.info("🔄 Logging in...")
+                ftp.login(user=ftp_user, passwd=ftp_pwd, acct='')
             
-            print(f"🔄 Changing to directory: {ftp_start_dir}")
+            logger.info(f"🔄 Changing to directory: {ftp_start_dir}")
             ftp.cwd(ftp_start_dir)
-            print("✅ FTP connection successful!")
+            logger.info("✅ FTP connection successful!")
             
         except Exception as e:
-            print(f"❌ FTP connection failed: {str(e)}")
-            print("💡 Please check your .env file and FTP credentials.")
-            print("💡 Make sure the FTP_START_DIR directory exists on the server.")
+            logger.error(f"❌ FTP connection failed: {str(e)}")
+            logger.warning("💡 Please check your .env file and FTP credentials.")
+            logger.warning("💡 Make sure the FTP_START_DIR directory exists on the server.")
             return False
 
         def get_ftp_file_list(directory='.'):
@@ -536,7 +1168,7 @@ class RunMap:
                 ftp.cwd(directory)
                 ftp.retrlines('NLST', files.append)
             except Exception as e:
-                print(f"Warning: Could not list files in {directory}: {e}")
+                logger.warning(f"Warning: Could not list files in {directory}: {e}")
             return files
 
         def file_needs_upload(filename, ftp_files, force_upload=False):
@@ -546,38 +1178,35 @@ class RunMap:
             return filename not in ftp_files
 
         if html:
-            print('\n' + ' TRANSFERING HTML FILES '.center(100, '#'))
+            logger.info('\n' + ' TRANSFERING HTML FILES '.center(100, '#'))
             
             # Get list of files in root directory
             ftp_files = get_ftp_file_list('.')
             
-            # Upload run_map.html (always upload HTML/CSS files)
-            with open(self.run_map_html, 'rb') as file:
-                ftp.storbinary('STOR run_map.html', file)
-            print('run_map.html transfered')
-
-            # Upload events_table.html (always upload HTML/CSS files)
-            with open(self.events_table_html, 'rb') as file:
-                ftp.storbinary('STOR events_table.html', file)
-            print('events_table.html transfered')
-                
-            # Upload events_table.css (always upload HTML/CSS files)
-            with open(self.events_table_css, 'rb') as file:
-                ftp.storbinary('STOR events_table.css', file)
-            print('events_table.css transfered')
-
-            # Upload eventometer.html (always upload HTML/CSS files)
-            with open(self.eventometer_html, 'rb') as file:
-                ftp.storbinary('STOR eventometer.html', file)
-            print('eventometer.html transfered')
+            # Upload html/css files (always upload HTML/CSS files), with their precompressed copies if any
+            dist_folder = self.dist_folder if self.minify_outputs else None
+            for output in self.html_outputs():
+                for local_path, remote_name in minify.publish_files(output, dist_folder):
+                    with open(local_path, 'rb') as file:
+                        ftp.storbinary(f'STOR {remote_name}', file)
+                    logger.debug(f'{remote_name} transfered')
+                    self.profiler.count('uploaded_bytes', os.path.getsize(local_path))
+
+            # raster tiles of the traces rendered or removed since the last upload
+            if self.tiles:
+                import tile_renderer
+                renderer = self.load_tile_renderer()
+                uploaded = tile_renderer.publish_tiles(ftp, renderer, renderer.relative_folder(self.run_map_html), force=force)
+                self.profiler.count('uploaded_tiles', uploaded)
+                logger.info(f'Tiles transfer complete: {uploaded} uploaded')
 
         # transfer jpg files
         if jpg:
-            print('\n' + ' TRANSFERING JPG FILES '.center(100, '#'))
+            logger.info('\n' + ' TRANSFERING JPG FILES '.center(100, '#'))
             try:
                 ftp.cwd('jpg')
                 ftp_jpg_files = get_ftp_file_list('.')
-                jpg_folder = os.path.join(CURRENT_FOLDER, 'jpg')
+                jpg_folder = self.jpg_folder
 
                 if os.path.exists(jpg_folder):
                     local_jpg_files = os.listdir(jpg_folder)
@@ -589,28 +1218,29 @@ class RunMap:
                             pic_path = os.path.join(jpg_folder, jpg_file)
                             with open(pic_path, 'rb') as file:
                                 ftp.storbinary('STOR {}'.format(jpg_file), file)
-                            print('{} transfered'.format(jpg_file))
+                            logger.debug(f'{jpg_file} transfered')
                             uploaded_count += 1
+                            self.profiler.count('uploaded_files')
                         else:
                             skipped_count += 1
                     
-                    print(f'JPG transfer complete: {uploaded_count} uploaded, {skipped_count} skipped')
+                    logger.info(f'JPG transfer complete: {uploaded_count} uploaded, {skipped_count} skipped')
                 else:
-                    print(f'JPG folder {jpg_folder} does not exist')
+                    logger.warning(f'JPG folder {jpg_folder} does not exist')
                     
                 # Return to start directory
                 ftp.cwd(ftp_start_dir)
             except Exception as e:
-                print(f'Error accessing JPG directory: {e}')
+                logger.warning(f'Error accessing JPG directory: {e}')
                 ftp.cwd(ftp_start_dir)
 
         # transfer gpx files
         if gpx:
-            print('\n' + ' TRANSFERING GPX FILES '.center(100, '#'))
+            logger.info('\n' + ' TRANSFERING GPX FILES '.center(100, '#'))
             try:
                 ftp.cwd('gpx')
                 ftp_gpx_files = get_ftp_file_list('.')
-                gpx_folder = os.path.join(CURRENT_FOLDER, 'gpx')
+                gpx_folder = self.gpx_folder
 
                 if os.path.exists(gpx_folder):
                     local_gpx_files = os.listdir(gpx_folder)
@@ -622,29 +1252,138 @@ class RunMap:
                             gpx_path = os.path.join(gpx_folder, gpx_file)
                             with open(gpx_path, 'rb') as file:
                                 ftp.storbinary('STOR {}'.format(gpx_file), file)
-                            print('{} transfered'.format(gpx_file))
+                            logger.debug(f'{gpx_file} transfered')
                             uploaded_count += 1
+                            self.profiler.count('uploaded_files')
                         else:
                             skipped_count += 1
                     
-                    print(f'GPX transfer complete: {uploaded_count} uploaded, {skipped_count} skipped')
+                    logger.info(f'GPX transfer complete: {uploaded_count} uploaded, {skipped_count} skipped')
                 else:
-                    print(f'GPX folder {gpx_folder} does not exist')
+                    logger.warning(f'GPX folder {gpx_folder} does not exist')
                     
                 # Return to start directory
                 ftp.cwd(ftp_start_dir)
             except Exception as e:
-                print(f'Error accessing GPX directory: {e}')
+                logger.warning(f'Error accessing GPX directory: {e}')
                 ftp.cwd(ftp_start_dir)
 
         try:
-            ftp.quit()
-            print("✅ FTP upload completed successfully!")
+            if self.ftp_pool:
+                self.ftp_pool.release(ftp)
+            else:
+                ftp.quit()
+            logger.info("✅ FTP upload completed successfully!")
             return True
         except Exception as e:
-            print(f"Warning: Error closing FTP connection: {e}")
+            logger.warning(f"Warning: Error closing FTP connection: {e}")
             return True
 
+    def pipeline_stages(self):
+        """Stages of the build pipeline with their dependencies, inputs and outputs, see scheduler.py"""
+
+        map_inputs = [self.settings_path, self.events_csv, self.popup_contents_html, self.gpx_folder]
+
+        return [
+            Stage('fetch', self.download_spreadsheet_as_csv, always=True),
+            Stage('load', lambda: self.load_csv_file(download=False), deps=['fetch'], always=True),
+            # stages sharing the database connection run one at a time (resources)
+            Stage('database', self.update_database, deps=['load'], inputs=[self.events_csv],
+                  outputs=[self.database_path], resources=['database']),
+            # always checked (a few stat calls): the store may be shared with other sites, see batch_main.py
+            Stage('trace_store', self.update_trace_store, deps=['load'], always=True),
+            Stage('spatial_index', self.update_spatial_index, deps=['database', 'trace_store'],
+                  inputs=[self.events_csv, self.gpx_folder], outputs=[self.database_path], resources=['database']),
+            Stage('trace_metrics', self.update_trace_metrics, deps=['database', 'trace_store'],
+                  inputs=[self.events_csv, self.gpx_folder], outputs=[self.database_path], resources=['database']),
+            Stage('sparklines', self.update_sparklines, deps=['load', 'trace_store'],
+                  inputs=[self.events_csv, self.gpx_folder], outputs=[self.sparkline_cache]),
+            Stage('overlap', self.update_overlaps, deps=['database', 'trace_store'],
+                  inputs=[self.events_csv, self.gpx_folder], outputs=[self.database_path], resources=['database']),
+            # after every stage writing to the database, whose results the map reads
+            Stage('map', lambda: (self.generate_map(), self.save_map()),
+                  deps=['trace_store', 'sparklines', 'database', 'spatial_index', 'trace_metrics', 'overlap', 'records'],
+                  inputs=map_inputs, outputs=[self.run_map_html], resources=['database']),
+            Stage('table', self.generate_events_table, deps=['load'],
+                  inputs=[self.events_csv, self.events_table_template],
+                  outputs=[self.events_table_html] + ([self.events_table_json] if self.table_mode == 'virtual' else [])),
+            Stage('eventometer', self.generate_eventometer, deps=['load'],
+                  inputs=[self.events_csv, self.eventometer_template], outputs=[self.eventometer_html]),
+            Stage('search', self.generate_search_index, deps=['load'], inputs=[self.events_csv], outputs=[self.search_index_json]),
+            Stage('records', lambda: (self.update_records(), self.generate_records_table()), deps=['database', 'trace_store'],
+                  inputs=[self.events_csv, self.gpx_folder, self.pb_pr_template], outputs=[self.pb_pr_html, self.database_path],
+                  resources=['database']),
+            Stage('minify', self.post_process_outputs, deps=['map', 'table', 'eventometer', 'records', 'search'],
+                  inputs=self.html_outputs(), outputs=[self.dist_folder] if self.minify_outputs else []),
+            Stage('upload_html', lambda: self.upload_to_ftp(html=True, jpg=False, gpx=False), deps=['minify'],
+                  inputs=self.html_outputs() + [self.dist_folder] + ([self.tiles_folder] if self.tiles else [])),
+            Stage('upload_jpg', lambda: self.upload_to_ftp(html=False, jpg=True, gpx=False), inputs=[self.jpg_folder]),
+            Stage('upload_gpx', lambda: self.upload_to_ftp(html=False, jpg=False, gpx=True), inputs=[self.gpx_folder]),
+        ] + ([
+            # on demand (cli.py export) unless export formats are set
+            Stage('export', self.export_data,
+                  deps=['database', 'trace_store'], inputs=[self.events_csv, self.gpx_folder],
+                  outputs=[self.export_folder], resources=['database']),
+        ] if self.export_formats else [])
+
+    def watch_targets(self):
+        """Files and folders monitored in watch mode, with the build steps depending on them"""
+
+        return {
+            self.events_csv: ['csv', 'map', 'table', 'eventometer', 'records', 'search'],
+            self.popup_contents_html: ['templates', 'map'],
+            self.events_table_template: ['table'],
+            self.eventometer_template: ['eventometer'],
+            self.pb_pr_template: ['records'],
+            self.gpx_folder: ['map', 'records'],
+            self.jpg_folder: ['jpg'],
+        }
+
+    def rebuild(self, steps, upload=False):
+        """Rebuild the outputs affected by a set of build steps, reusing the trace store
+
+        Args:
+            steps (set): build steps to run, see watch_targets
+            upload (bool): upload the rebuilt outputs to the ftp server
+        """
+
+        if 'templates' in steps:
+            self.load_templates()
+        if 'csv' in steps:
+            self.load_csv_file(download=False)
+            self.update_database()
+        if 'map' in steps:
+            # the gpx files may have changed
+            self.forget_stage_results()
+            self.generate_map()
+            self.save_map()
+        if 'table' in steps:
+            self.generate_events_table()
+        if 'eventometer' in steps:
+            self.generate_eventometer()
+        if 'search' in steps:
+            self.generate_search_index()
+        if 'records' in steps:
+            self.update_records()
+            self.generate_records_table()
+        self.post_process_outputs()
+
+        if upload:
+            self.upload_to_ftp(html=True, jpg='jpg' in steps, gpx='map' in steps)
+
+    def write_profile_report(self, path=None):
+        """Log the profile summary and write the run report as json or chrome trace (.trace.json)
+
+        Args:
+            path (string): report file path, defaults to the profile_report setting
+        """
+
+        self.profiler.print_summary()
+
+        path = path or self.profile_report
+        if path:
+            self.profiler.write_report(os.path.join(CURRENT_FOLDER, path))
+
     def open_blog_page(self):
         """Opens the map on the blog web page"""
         webbrowser.open(self.blog_event_page)
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """A pipeline stage with its dependencies and the files it reads and writes"""
+
+    def __init__(self, name, func, deps=(), inputs=(), outputs=(), always=False, resources=()):
+        """Initialise the stage
+
+        Args:
+            name (string): unique stage name
+            func (callable): function running the stage, returning False on failure
+            deps (list): names of the stages that must complete first
+            inputs (list): files and folders read by the stage, used to detect changes
+            outputs (list): files and folders written by the stage, the stage reruns if one is missing
+            always (bool): never skip the stage (downloads, in-memory loading)
+            resources (list): shared resources used by the stage (e.g. 'database': the sqlite connection),
+                              stages using a same resource never run at the same time
+        """
+
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.always = always
+        self.resources = set(resources)
+
+
+def fingerprint(paths):
+    """Hash of file contents and of the modification time and size of folder entries
+
+    Args:
+        paths (list): files and folders
+
+    Return:
+        (string): hex digest, changes whenever one of the files changes
+    """
+
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(path.encode('utf-8'))
+        if os.path.isdir(path):
+            for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                if entry.is_file():
+                    stat = entry.stat()
+                    digest.update(f'{entry.name}:{stat.st_mtime_ns}:{stat.st_size}'.encode('utf-8'))
+        elif os.path.isfile(path):
+            # files are hashed by content, downloads rewrite them even when nothing changed
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+        else:
+            digest.update(b'missing')
+    return digest.hexdigest()
+
+
+class Scheduler:
+    """Runs a DAG of stages, independent stages concurrently, skipping stages whose inputs did not change"""
+
+    def __init__(self, stages, state_file=None, max_workers=4, executor=None):
+        """Initialise the scheduler
+
+        Args:
+            stages (list): list of Stage objects
+            state_file (string): json file storing the input fingerprints of the last successful runs
+            max_workers (int): maximum number of stages running at the same time
+            executor (concurrent.futures.Executor): worker pool shared with other schedulers,
+                                                    a pool of max_workers threads is created if None
+        """
+
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_file = state_file
+        self.max_workers = max_workers
+        self.executor = executor
+
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in self.stages:
+                    raise ValueError(f'Stage {stage.name} depends on unknown stage {dep}')
+
+        self.state = {}
+        if state_file and os.path.isfile(state_file):
+            with open(state_file, 'r') as f:
+                self.state = json.load(f)
+
+    def is_up_to_date(self, stage, stage_fingerprint):
+        """Check if a stage can be skipped"""
+
+        if stage.always or not stage.inputs:
+            return False
+        if self.state.get(stage.name) != stage_fingerprint:
+            return False
+        return all(os.path.exists(output) for output in stage.outputs)
+
+    def run_stage(self, stage, force):
+        """Run a single stage, return its status"""
+
+        stage_fingerprint = fingerprint(stage.inputs)
+        if not force and self.is_up_to_date(stage, stage_fingerprint):
+            logger.info(f'Stage {stage.name} skipped: inputs unchanged')
+            return 'skipped'
+
+        start = time.perf_counter()
+        if stage.func() is False:
+            return 'failed'
+
+        # fingerprint taken before running, changes made by concurrent stages are caught next run
+        self.state[stage.name] = stage_fingerprint
+        logger.debug(f'Stage {stage.name} done in {time.perf_counter() - start:.3f}s')
+        return 'done'
+
+    def save_state(self):
+        """Store the fingerprints of the successful stages"""
+
+        if not self.state_file:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_file)), exist_ok=True)
+        with open(self.state_file, 'w') as f:
+            json.dump(self.state, f, indent=4)
+
+    def run(self, force=False, only=None):
+        """Run the stages in dependency order
+
+        Args:
+            force (bool): run all stages, even if their inputs did not change
+            only (list): run only these stages and the stages they depend on
+
+        Return:
+            (dict): stage name -> status (done, skipped, failed, cancelled)
+        """
+
+        stages = self.stages
+        if only:
+            selected = set()
+            pending = list(only)
+            while pending:
+                name = pending.pop()
+                if name not in selected:
+                    selected.add(name)
+                    pending.extend(self.stages[name].deps)
+            stages = {name: stage for name, stage in self.stages.items() if name in selected}
+
+        status = {}
+        running = {}
+
+        executor = self.executor or ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while len(status) < len(stages):
+                # submit every stage whose dependencies are complete and whose resources are free
+                for name, stage in stages.items():
+                    if name in status or name in running.values():
+                        continue
+                    deps_status = [status.get(dep) for dep in stage.deps]
+                    if any(s in ('failed', 'cancelled') for s in deps_status):
+                        logger.warning(f'Stage {name} cancelled: a dependency failed')
+                        status[name] = 'cancelled'
+                    elif all(s in ('done', 'skipped') for s in deps_status):
+                        busy = set().union(*(stages[other].resources for other in running.values()))
+                        if stage.resources & busy:
+                            continue
+                        running[executor.submit(self.run_stage, stage, force)] = name
+
+                if not running:
+                    if len(status) < len(stages):
+                        raise ValueError('Dependency cycle between stages: ' + ', '.join(set(stages) - set(status)))
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except Exception as e:
+                        logger.exception(f'Stage {name} failed: {e}')
+                        status[name] = 'failed'
+        finally:
+            if executor is not self.executor:
+                executor.shutdown()
+
+        self.save_state()
+        return status
@@ -0,0 +1,92 @@
+import os
+import re
+import json
+import math
+import logging
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# kinds of searchable features, stored as their position in the index
+KINDS = ['event', 'stage', 'stamp']
+
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(text):
+    """Lowercase text without accents nor punctuation, words separated by single spaces
+
+    Mirrors the normalize function of folium_elements.SearchControl, queries and indexed texts
+    must be normalized the same way.
+    """
+
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    return NON_ALPHANUMERIC.sub(' ', text).strip()
+
+
+def word_grams(word):
+    """Grams indexing a word: its first letter and the trigrams of the word preceded by a space
+
+    The leading space anchors the grams on the start of the word, a query word matches the
+    words it is a prefix of.
+    """
+
+    padded = ' ' + word
+    return {padded[:2]} | {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def build_index(docs):
+    """Build the prefix/trigram search index
+
+    Args:
+        docs (list): tuples (name, detail, kind, lat, lon), kind being one of KINDS, documents
+                     without valid coordinates are skipped
+
+    Return:
+        (dict): columnar documents and gram -> delta-encoded sorted document ids
+    """
+
+    columns = {'name': [], 'detail': [], 'kind': [], 'lat': [], 'lon': []}
+    postings = {}
+
+    docs = [doc for doc in docs if math.isfinite(float(doc[3])) and math.isfinite(float(doc[4]))]
+    for doc_id, (name, detail, kind, lat, lon) in enumerate(docs):
+        columns['name'].append(str(name))
+        columns['detail'].append(str(detail))
+        columns['kind'].append(KINDS.index(kind))
+        columns['lat'].append(round(float(lat), 5))
+        columns['lon'].append(round(float(lon), 5))
+
+        grams = set()
+        for word in normalize(f'{name} {detail}').split():
+            grams |= word_grams(word)
+        for gram in grams:
+            postings.setdefault(gram, []).append(doc_id)
+
+    # ids are appended in increasing order, the gaps between them are small numbers
+    grams = {gram: [ids[0]] + [b - a for a, b in zip(ids, ids[1:])] for gram, ids in sorted(postings.items())}
+    return {'kinds': KINDS, 'docs': columns, 'grams': grams}
+
+
+def write_index(path, docs):
+    """Build the search index and write it as compact json
+
+    Args:
+        path (string): index json file
+        docs (list): documents, see build_index
+
+    Return:
+        (int): size of the index file in bytes
+    """
+
+    index = build_index(docs)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+    size = os.path.getsize(path)
+    logger.debug(f"Search index: {len(index['docs']['name'])} documents, {len(index['grams'])} grams, {size} bytes")
+    return size
@@ -0,0 +1,37 @@
+import json
+
+# map classes by site name, with their module and default settings file
+SITES = {
+    'run': ('run_map', 'RunMap', 'settings.json'),
+    'camino': ('camino_map', 'CaminoMap', 'camino_settings.json'),
+}
+
+
+def load_site_class(site):
+    """Import the map class of a site
+
+    Args:
+        site (string): site name, key of SITES
+
+    Return:
+        (class): RunMap or CaminoMap
+    """
+
+    module_name, class_name, _ = SITES[site]
+    module = __import__(module_name)
+    return getattr(module, class_name)
+
+
+def detect_site(settings):
+    """Site of a settings file, from the map output it declares
+
+    Args:
+        settings (string): path to json settings file
+
+    Return:
+        (string): site name, key of SITES
+    """
+
+    with open(settings, 'r') as jf:
+        keys = json.load(jf)
+    return 'camino' if 'camino_map_html' in keys else 'run'
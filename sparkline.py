@@ -0,0 +1,154 @@
+import os
+import json
+import logging
+import numpy as np
+import traces
+import trace_metrics
+
+logger = logging.getLogger(__name__)
+
+# elevation samples of a profile and their horizontal spacing in pixels
+SAMPLES = 50
+STEP = 4
+# height of the profile in pixels, elevations are quantized to whole pixels
+HEIGHT = 40
+
+WIDTH = (SAMPLES - 1) * STEP
+
+
+def elevation_profile(track, samples=SAMPLES, height=HEIGHT):
+    """Downsampled elevation profile of a trace
+
+    The points are binned by distance into samples bins of equal length and the elevations of
+    every bin averaged (bincount), empty bins being interpolated. The profile is scaled to the
+    height in pixels.
+
+    Args:
+        track (dict): trace arrays lat, lon and ele, see trace_store.TraceStore.track
+        samples (int): number of profile samples
+        height (int): profile height in pixels
+
+    Return:
+        (dict): levels (ints in [0, height], bottom to top), min and max elevation in m,
+                None if the trace has less than two points with an elevation or no length
+    """
+
+    ele = np.asarray(track['ele'], dtype=np.float64)
+    valid = ~np.isnan(ele)
+    if valid.sum() < 2:
+        return None
+
+    dist = trace_metrics.cumulative_distance(track['lat'], track['lon'])[valid]
+    ele = ele[valid]
+    if dist[-1] <= 0:
+        return None
+
+    bins = np.minimum((dist / dist[-1] * samples).astype(np.int64), samples - 1)
+    counts = np.bincount(bins, minlength=samples)
+    sums = np.bincount(bins, weights=ele, minlength=samples)
+    filled = counts > 0
+    centers = np.arange(samples)
+    profile = np.interp(centers, centers[filled], sums[filled] / counts[filled])
+
+    low, high = float(profile.min()), float(profile.max())
+    levels = np.round((profile - low) / (high - low) * height) if high > low else np.zeros(samples)
+    return {'levels': levels.astype(int).tolist(), 'min': round(low), 'max': round(high)}
+
+
+def render_svg(profile):
+    """Inline svg area chart of an elevation profile (about 400 bytes)
+
+    Args:
+        profile (dict): see elevation_profile
+
+    Return:
+        (string): svg element, the min and max elevations in its title
+    """
+
+    levels = profile['levels']
+    points = ' '.join(f'{i * STEP},{HEIGHT - level}' for i, level in enumerate(levels))
+    return (f'<svg width="{WIDTH}" height="{HEIGHT}" viewBox="0 0 {WIDTH} {HEIGHT}" style="display:block">'
+            f"<title>{profile['min']} - {profile['max']} m</title>"
+            f'<path d="M0,{HEIGHT}L{points}L{WIDTH},{HEIGHT}Z" fill="#999" fill-opacity="0.4" stroke="#555"/></svg>')
+
+
+class ProfileCache:
+    """Elevation profiles of the traces cached in a json file with the trace file key they were computed from"""
+
+    def __init__(self, path):
+        """Load the cached profiles
+
+        Args:
+            path (string): json cache file
+        """
+
+        self.path = path
+        self.traces = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                cache = json.load(f)
+            # profiles of another resolution are computed again
+            if cache.get('samples') == SAMPLES and cache.get('height') == HEIGHT:
+                self.traces = {trace: (tuple(entry['key']), entry['profile']) for trace, entry in cache['traces'].items()}
+
+    def save(self):
+        """Write the profiles atomically"""
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        cache = {'samples': SAMPLES, 'height': HEIGHT,
+                 'traces': {trace: {'key': list(key), 'profile': profile} for trace, (key, profile) in self.traces.items()}}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def update(self, paths, store, profiler=None):
+        """Compute the profiles of the new or modified traces and forget the traces not in paths
+
+        Args:
+            paths (list): trace file paths
+            store (trace_store.TraceStore): packed traces, up to date with the trace files
+            profiler (instrumentation.Profiler): records cache hits and misses
+
+        Return:
+            (int): number of profiles computed
+        """
+
+        current = {}
+        for path in paths:
+            if not path:
+                continue
+            try:
+                current[os.path.abspath(path)] = traces.file_key(path)
+            except OSError:
+                logger.warning(f'Trace file {path} not found')
+
+        removed = set(self.traces) - set(current)
+        for path in removed:
+            del self.traces[path]
+
+        computed = 0
+        for path, key in current.items():
+            cached = self.traces.get(path)
+            if cached and cached[0] == key:
+                if profiler:
+                    profiler.hit('profiles')
+                continue
+
+            if profiler:
+                profiler.miss('profiles')
+            track = store.track(path)
+            if track is None:
+                continue
+            self.traces[path] = (key, elevation_profile(track))
+            computed += 1
+
+        if computed or removed:
+            self.save()
+        return computed
+
+    def svg(self, path):
+        """Svg profile of a trace, empty string if unknown or without elevations"""
+
+        cached = self.traces.get(os.path.abspath(path)) if path else None
+        return render_svg(cached[1]) if cached and cached[1] else ''
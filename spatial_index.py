@@ -0,0 +1,102 @@
+import math
+import logging
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.32
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great circle distance between two points in km"""
+
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def radius_bbox(lat, lon, radius_km):
+    """Bounding box (min_lat, min_lon, max_lat, max_lon) enclosing a circle"""
+
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    dlon = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lon - dlon, lat + dlat, lon + dlon
+
+
+def bbox_distance_km(lat, lon, bbox):
+    """Distance from a point to the closest point of a bounding box, 0 if inside"""
+
+    min_lat, min_lon, max_lat, max_lon = bbox
+    return haversine_km(lat, lon, min(max(lat, min_lat), max_lat), min(max(lon, min_lon), max_lon))
+
+
+def create_index(conn, table):
+    """Create the SQLite R*Tree table indexing the features of a map
+
+    Each feature is a bounding box (a point has an empty one) with its kind (event, stamp, trace),
+    the date of its spreadsheet entry and a label.
+    """
+
+    conn.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING rtree(
+                 id, min_lat, max_lat, min_lon, max_lon, +kind TEXT, +date TEXT, +label TEXT)""")
+
+
+def rebuild_index(conn, table, features):
+    """Replace the indexed features
+
+    Args:
+        conn (sqlite3.Connection): database connection
+        table (string): R*Tree table name
+        features (iterable): tuples (kind, date, label, (min_lat, min_lon, max_lat, max_lon))
+
+    Return:
+        (int): number of indexed features
+    """
+
+    create_index(conn, table)
+    conn.execute(f"DELETE FROM {table}")
+    rows = ((kind, date, label, bbox[0], bbox[2], bbox[1], bbox[3]) for kind, date, label, bbox in features)
+    conn.executemany(f"""INSERT INTO {table} (kind, date, label, min_lat, max_lat, min_lon, max_lon)
+                     VALUES (?,?,?,?,?,?,?)""", rows)
+    conn.commit()
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def query_bbox(conn, table, min_lat, min_lon, max_lat, max_lon, kinds=None):
+    """Features whose bounding box intersects a bounding box
+
+    Args:
+        kinds (list): restrict the results to these feature kinds
+
+    Return:
+        (list): dicts with kind, date, label and bbox
+    """
+
+    sql = f"""SELECT kind, date, label, min_lat, min_lon, max_lat, max_lon FROM {table}
+              WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?"""
+    params = [min_lat, max_lat, min_lon, max_lon]
+    if kinds:
+        sql += f" AND kind IN ({','.join('?' * len(kinds))})"
+        params += list(kinds)
+
+    return [{'kind': kind, 'date': date, 'label': label, 'bbox': tuple(bbox)}
+            for kind, date, label, *bbox in conn.execute(sql, params)]
+
+
+def query_radius(conn, table, lat, lon, radius_km, kinds=None):
+    """Features within a distance of a point, sorted by distance
+
+    The R*Tree returns the candidates of the enclosing bounding box, which are then filtered on
+    the exact distance to the point (or to the trace bounding box).
+
+    Return:
+        (list): dicts with kind, date, label, bbox and distance_km
+    """
+
+    results = []
+    for feature in query_bbox(conn, table, *radius_bbox(lat, lon, radius_km), kinds=kinds):
+        distance = bbox_distance_km(lat, lon, feature['bbox'])
+        if distance <= radius_km:
+            feature['distance_km'] = round(distance, 3)
+            results.append(feature)
+    return sorted(results, key=lambda f: f['distance_km'])
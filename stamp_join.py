@@ -0,0 +1,256 @@
+import logging
+import itertools
+import unicodedata
+from datetime import datetime
+import numpy as np
+import export
+import trace_metrics
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+logger = logging.getLogger(__name__)
+
+# simplification tolerance of the stage traces in meters, see export.simplify
+TOLERANCE_M = 20
+# stamps farther than this from their nearest stage trace are flagged (m)
+MAX_DISTANCE_M = 1000
+# days between the stamp and its stage above which the stamp is flagged
+MAX_DAYS = 1
+# distances computed at once when comparing queries with all points (grid_nearest)
+BLOCK_SIZE = 2 ** 22
+
+
+def create_table(conn):
+    """Create the stamp_stages table: the stage and km marker of every stamp
+
+    date, place, camino, lat and lon are the stamp spreadsheet values, stage_date the date of the
+    nearest stage (the key of the camino_map table), km the distance from the stage start to the
+    nearest point of its trace, distance the distance between the stamp and that point (m) and
+    flags the inconsistencies found ('distance', 'camino', 'date'), comma separated.
+    """
+
+    conn.execute("""CREATE TABLE IF NOT EXISTS stamp_stages(
+                 id INTEGER PRIMARY KEY,
+                 date TEXT,
+                 place TEXT,
+                 camino TEXT,
+                 lat REAL,
+                 lon REAL,
+                 stage_date TEXT,
+                 stage_title TEXT,
+                 stage_camino TEXT,
+                 km REAL,
+                 distance REAL,
+                 flags TEXT
+                 )""")
+
+
+def to_cartesian(lat, lon):
+    """Earth centered coordinates in meters, their euclidean distance grows with the great circle distance"""
+
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    return trace_metrics.EARTH_RADIUS_M * np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def grid_nearest(points, queries, cell=MAX_DISTANCE_M):
+    """Nearest point of every query without scipy: numpy search in a grid of cubic cells
+
+    The points are sorted by cell once. Each of the 27 neighbour cells of the queries is looked
+    up for all queries in one searchsorted pass, the candidates being compared with vectorized
+    index arithmetic. A neighbour found closer than the cell size is the nearest point, the
+    queries farther from all points (flagged stamps) are compared with every point.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates in meters
+        queries (np.ndarray): (m, 3) query coordinates in meters
+        cell (float): cell size in meters
+
+    Return:
+        (tuple): index of the nearest point and its distance for every query
+    """
+
+    index = np.full(len(queries), -1, dtype=np.int64)
+    distance = np.full(len(queries), np.inf)
+    if not len(points) or not len(queries):
+        return index, distance
+
+    cells = np.floor(points / cell).astype(np.int64)
+    low = cells.min(axis=0) - 1
+    shape = tuple(cells.max(axis=0) - low + 2)
+    keys = np.ravel_multi_index((cells - low).T, shape)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+
+    query_cells = np.floor(queries / cell).astype(np.int64) - low
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        neighbours = query_cells + offset
+        valid = np.flatnonzero(((neighbours >= 0) & (neighbours < shape)).all(axis=1))
+        wanted = np.ravel_multi_index(neighbours[valid].T, shape)
+        starts = np.searchsorted(keys, wanted, side='left')
+        counts = np.searchsorted(keys, wanted, side='right') - starts
+        if not counts.sum():
+            continue
+
+        # every candidate point of every query
+        query = np.repeat(valid, counts)
+        candidate = order[np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+        distances = np.linalg.norm(points[candidate] - queries[query], axis=1)
+
+        # closest candidate of every query
+        closest = np.lexsort((distances, query))
+        found, firsts = np.unique(query[closest], return_index=True)
+        best = closest[firsts]
+        better = distances[best] < distance[found]
+        distance[found[better]] = distances[best[better]]
+        index[found[better]] = candidate[best[better]]
+
+    # points beyond the neighbour cells may be closer than the candidates found: the few queries far
+    # from all points are compared with every point, by blocks of a bounded distance matrix
+    far = np.flatnonzero(distance > cell)
+    center = points.mean(axis=0)
+    centered = points - center
+    norms = (centered ** 2).sum(axis=1)
+    block = max(1, BLOCK_SIZE // len(points))
+    for start in range(0, len(far), block):
+        rows = far[start:start + block]
+        # squared distances up to the norms of the queries, enough to compare the points
+        closest = np.argmin(norms - 2 * (queries[rows] - center) @ centered.T, axis=1)
+        index[rows] = closest
+        distance[rows] = np.linalg.norm(points[closest] - queries[rows], axis=1)
+    return index, distance
+
+
+def nearest(points, queries):
+    """Nearest point of every query, with a scipy KD-tree when installed (see grid_nearest)"""
+
+    if cKDTree is None:
+        return grid_nearest(points, queries)
+    if not len(points):
+        return np.full(len(queries), -1, dtype=np.int64), np.full(len(queries), np.inf)
+    distance, index = cKDTree(points).query(queries)
+    return index.astype(np.int64), distance
+
+
+def stage_points(stages, store, tolerance_m=TOLERANCE_M):
+    """Simplified trace points of the stages with their km marker
+
+    Stages without a trace are represented by their start and end positions.
+
+    Args:
+        stages (list): dicts with date, title, camino, gpx, start and end ([lat, lon]) and dist (km)
+        store (trace_store.TraceStore): packed traces, up to date with the gpx files
+        tolerance_m (float): simplification tolerance in meters
+
+    Return:
+        (tuple): arrays lat, lon, stage index and km of the points
+    """
+
+    lat, lon, stage, km = [], [], [], []
+    for i, entry in enumerate(stages):
+        track = store.track(entry['gpx']) if entry['gpx'] else None
+        if track is not None and len(track['lat']) >= 2:
+            kept = export.simplify(track['lat'], track['lon'], tolerance_m)
+            lat.append(track['lat'][kept].astype(np.float64))
+            lon.append(track['lon'][kept].astype(np.float64))
+            km.append(trace_metrics.cumulative_distance(track['lat'], track['lon'])[kept] / 1000)
+        else:
+            ends = [(position, marker) for position, marker in ((entry['start'], 0.0), (entry['end'], entry['dist'] or 0.0))
+                    if all(isinstance(value, float) and np.isfinite(value) for value in position)]
+            if not ends:
+                continue
+            lat.append(np.array([position[0] for position, _ in ends]))
+            lon.append(np.array([position[1] for position, _ in ends]))
+            km.append(np.array([marker for _, marker in ends], dtype=np.float64))
+        stage.append(np.full(len(lat[-1]), i))
+
+    if not lat:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64), np.empty(0)
+    return np.concatenate(lat), np.concatenate(lon), np.concatenate(stage), np.concatenate(km)
+
+
+def normalize_camino(name):
+    """Camino name without accents, case and extra spaces, for comparisons"""
+
+    text = unicodedata.normalize('NFKD', str(name)).encode('ascii', 'ignore').decode()
+    return ' '.join(text.lower().split())
+
+
+def find_flags(stamp, stage, distance, max_distance=MAX_DISTANCE_M, max_days=MAX_DAYS):
+    """Inconsistencies between a stamp and its nearest stage
+
+    Args:
+        stamp (dict): stamp with date ('dd.mm.yyyy') and camino (free text, may be empty)
+        stage (dict): stage with date and camino
+        distance (float): distance between the stamp and the stage trace in meters
+        max_distance (float): distance above which the stamp is flagged
+        max_days (int): days between the stamp and the stage above which the stamp is flagged
+
+    Return:
+        (list): 'distance', 'camino' and 'date' flags
+    """
+
+    flags = []
+    if distance > max_distance:
+        flags.append('distance')
+
+    # free text: 'Frances' is the 'Camino Francés'
+    camino, stage_camino = normalize_camino(stamp['camino']), normalize_camino(stage['camino'])
+    if camino and stage_camino and camino not in stage_camino and stage_camino not in camino:
+        flags.append('camino')
+
+    try:
+        days = (datetime.strptime(stamp['date'], '%d.%m.%Y') - datetime.strptime(stage['date'], '%d.%m.%Y')).days
+        if abs(days) > max_days:
+            flags.append('date')
+    except ValueError:
+        pass
+    return flags
+
+
+def update_stamp_stages(conn, stages, stamps, store, max_distance=MAX_DISTANCE_M, profiler=None):
+    """Assign every stamp to the nearest point of the stage traces and store the result in stamp_stages
+
+    All stamps are joined in one nearest neighbour query over the simplified points of all stage
+    traces (see nearest), the cost growing with the log of the number of points per stamp.
+
+    Args:
+        conn (sqlite3.Connection): database connection
+        stages (list): dicts with date, title, camino, gpx, start, end and dist, see stage_points
+        stamps (list): dicts with date, place, camino, lat and lon
+        store (trace_store.TraceStore): packed traces, up to date with the gpx files
+        max_distance (float): distance in meters above which a stamp is flagged
+        profiler (instrumentation.Profiler): records the number of points and stamps joined
+
+    Return:
+        (list): dict per stamp with its stage (stage dict, None if there are no stages), km, distance and flags
+    """
+
+    lat, lon, stage_index, km = stage_points(stages, store)
+    index, distance = nearest(to_cartesian(lat, lon), to_cartesian([s['lat'] for s in stamps], [s['lon'] for s in stamps]))
+    if profiler:
+        profiler.count('stamp_join_points', len(lat))
+        profiler.count('stamp_join_stamps', len(stamps))
+
+    results = []
+    for stamp, point, dist in zip(stamps, index.tolist(), distance.tolist()):
+        if point < 0:
+            results.append({'stamp': stamp, 'stage': None, 'km': None, 'distance': None, 'flags': ['distance']})
+            continue
+        stage = stages[stage_index[point]]
+        results.append({'stamp': stamp, 'stage': stage, 'km': round(float(km[point]), 1), 'distance': round(dist),
+                        'flags': find_flags(stamp, stage, dist, max_distance)})
+
+    create_table(conn)
+    conn.execute("DELETE FROM stamp_stages")
+    conn.executemany("""INSERT INTO stamp_stages (date, place, camino, lat, lon, stage_date, stage_title, stage_camino, km, distance, flags)
+                     VALUES (?,?,?,?,?,?,?,?,?,?,?)""",
+                     [(r['stamp']['date'], r['stamp']['place'], r['stamp']['camino'], r['stamp']['lat'], r['stamp']['lon'],
+                       r['stage']['date'] if r['stage'] else None, r['stage']['title'] if r['stage'] else None,
+                       r['stage']['camino'] if r['stage'] else None, r['km'], r['distance'], ','.join(r['flags']))
+                      for r in results])
+    conn.commit()
+    return results
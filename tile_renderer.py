@@ -0,0 +1,358 @@
+import os
+import json
+import logging
+import multiprocessing
+import numpy as np
+import traces
+import heatmap
+import routes
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageColor, ImageDraw
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+
+# zooms rendered as raster tiles, the vector traces are shown above the max zoom
+TILE_MIN_ZOOM = 0
+TILE_MAX_ZOOM = 10
+
+# tiles rendered per worker task, and below which they are rendered without starting worker processes
+TILES_PER_TASK = 64
+
+# color of the traces whose color is unknown to pillow
+DEFAULT_COLOR = 'blue'
+
+# trace store opened once by every worker process
+worker_store = None
+
+
+def trace_pixels(x, y, zoom):
+    """Global pixel coordinates of a trace at a zoom level
+
+    Consecutive points falling on the same pixel are merged, at low zooms a trace is reduced
+    to a few dozen pixels. Segments longer than half a tile are split so that the tiles they
+    cross without a point inside them are found.
+
+    Args:
+        x (np.ndarray): web mercator x of the trace points, see heatmap.mercator
+        y (np.ndarray): web mercator y of the trace points
+        zoom (int): zoom level
+
+    Return:
+        (np.ndarray): (n, 2) int64 array of x, y pixels
+    """
+
+    scale = TILE_SIZE * 2 ** zoom
+    pixels = routes.dedupe_points(np.column_stack((x * scale, y * scale)).astype(np.int64))
+
+    lengths = np.abs(np.diff(pixels, axis=0)).max(axis=1) if len(pixels) > 1 else np.empty(0)
+    long_segments = np.flatnonzero(lengths > TILE_SIZE // 2)
+    if not len(long_segments):
+        return pixels
+
+    chunks, start = [], 0
+    for segment in long_segments:
+        steps = int(lengths[segment]) // (TILE_SIZE // 2) + 1
+        chunks.append(pixels[start:segment + 1])
+        fractions = np.linspace(0, 1, steps + 1)[1:-1, None]
+        chunks.append((pixels[segment] + fractions * (pixels[segment + 1] - pixels[segment])).astype(np.int64))
+        start = segment + 1
+    chunks.append(pixels[start:])
+    return np.concatenate(chunks)
+
+
+def pixel_tiles(pixels, zoom, margin):
+    """Tiles drawn on by a trace, including the tiles only reached by the line width
+
+    Return:
+        (set): (zoom, x, y) tiles
+    """
+
+    size = 2 ** zoom
+    keys = []
+    for dx in (-margin, margin):
+        for dy in (-margin, margin):
+            tile_x = (pixels[:, 0] + dx) // TILE_SIZE
+            tile_y = (pixels[:, 1] + dy) // TILE_SIZE
+            inside = (tile_x >= 0) & (tile_x < size) & (tile_y >= 0) & (tile_y < size)
+            keys.append(tile_x[inside] * size + tile_y[inside])
+    return {(zoom, int(key // size), int(key % size)) for key in np.unique(np.concatenate(keys))}
+
+
+def rgba(color, opacity):
+    """Pillow rgba tuple of a css color name or hex value"""
+
+    try:
+        red, green, blue = ImageColor.getrgb(color)[:3]
+    except (ValueError, AttributeError):
+        red, green, blue = ImageColor.getrgb(DEFAULT_COLOR)
+    return red, green, blue, int(round(opacity * 255))
+
+
+def init_worker(store_folder):
+    """Open the trace store in a worker process"""
+
+    global worker_store
+    import trace_store
+    worker_store = trace_store.TraceStore(store_folder)
+
+
+def render_tiles(tasks, folder, width, opacity, store=None):
+    """Render tiles to png files, removing the files of tiles left without traces
+
+    Args:
+        tasks (list): (zoom, x, y, [(gpx path, color), ...]) tuples
+        folder (string): tiles folder, tiles are written to folder/zoom/x/y.png
+        width (int): line width in pixels
+        opacity (float): line opacity
+        store (trace_store.TraceStore): packed traces, the store of the worker process if None
+
+    Return:
+        (int): number of tiles written
+    """
+
+    store = store or worker_store
+    mercator_cache, pixels_cache = {}, {}
+    written = 0
+
+    for zoom, x, y, entries in tasks:
+        path = os.path.join(folder, str(zoom), str(x), f'{y}.png')
+        image = Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        drawn = False
+
+        for gpx, color in entries:
+            if gpx not in mercator_cache:
+                track = store.track(gpx)
+                mercator_cache[gpx] = None if track is None else heatmap.mercator(track['lat'], track['lon'])
+            if (gpx, zoom) not in pixels_cache and mercator_cache[gpx] is not None:
+                pixels_cache[(gpx, zoom)] = trace_pixels(*mercator_cache[gpx], zoom)
+            pixels = pixels_cache.get((gpx, zoom))
+            if pixels is None or not len(pixels):
+                continue
+
+            # points near the tile, with their neighbours so that lines crossing its border are drawn
+            local = pixels - (x * TILE_SIZE, y * TILE_SIZE)
+            near = np.all((local >= -width) & (local < TILE_SIZE + width), axis=1)
+            near[:-1] |= near[1:]
+            near[1:] |= near[:-1]
+            bounds = np.flatnonzero(np.diff(np.concatenate(([False], near, [False])).astype(np.int8)))
+            fill = rgba(color, opacity)
+            for start, end in zip(bounds[::2], bounds[1::2]):
+                run = [tuple(point) for point in local[start:end].tolist()]
+                if len(run) == 1:
+                    run.append(run[0])
+                draw.line(run, fill=fill, width=width, joint='curve')
+                drawn = True
+
+        if drawn:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            image.save(path)
+            written += 1
+        elif os.path.isfile(path):
+            os.remove(path)
+
+    return written
+
+
+class TileRenderer:
+    """Renders the traces into XYZ png tiles for the low zoom levels of a map
+
+    A manifest next to the tiles stores the file key, color and tiles of every trace, so that
+    an update only renders the tiles drawn on by new, modified or removed traces. The rendered
+    and removed tiles are kept as pending in the manifest until uploaded, see publish_tiles.
+    """
+
+    def __init__(self, folder, min_zoom=TILE_MIN_ZOOM, max_zoom=TILE_MAX_ZOOM, width=2, opacity=0.8, workers=None):
+        """Load the manifest of the tiles folder
+
+        Args:
+            folder (string): tiles folder
+            min_zoom (int): lowest zoom rendered
+            max_zoom (int): highest zoom rendered
+            width (int): line width in pixels
+            opacity (float): line opacity
+            workers (int): worker processes rendering the tiles, the number of cpus if None
+        """
+
+        self.folder = folder
+        self.manifest_path = os.path.join(folder, 'manifest.json')
+        self.style = {'min_zoom': min_zoom, 'max_zoom': max_zoom, 'width': int(width), 'opacity': opacity}
+        self.workers = workers or os.cpu_count()
+
+        self.traces = {}
+        self.pending = set()
+        # tiles of a previous style, rendered again or removed on the next update
+        self.stale = set()
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.pending = {tuple(tile) for tile in manifest['pending']}
+            if manifest['style'] == self.style:
+                self.traces = manifest['traces']
+            else:
+                logger.info('Tile style changed, rendering all tiles again')
+                self.stale = self.stored_tiles()
+
+    def stored_tiles(self):
+        """Tiles present in the tiles folder"""
+
+        tiles = set()
+        for zoom in range(self.style['min_zoom'], self.style['max_zoom'] + 1):
+            zoom_folder = os.path.join(self.folder, str(zoom))
+            if not os.path.isdir(zoom_folder):
+                continue
+            for x in os.listdir(zoom_folder):
+                for name in os.listdir(os.path.join(zoom_folder, x)):
+                    tiles.add((zoom, int(x), int(name.split('.')[0])))
+        return tiles
+
+    def save_manifest(self):
+        """Write the manifest atomically"""
+
+        os.makedirs(self.folder, exist_ok=True)
+        manifest = {'style': self.style, 'pending': sorted(self.pending), 'traces': self.traces}
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def update(self, entries, store, profiler=None):
+        """Render the tiles touched by the new, modified or removed traces
+
+        Args:
+            entries (list): (gpx path, color) of every trace
+            store (trace_store.TraceStore): packed traces, up to date with the gpx files
+            profiler (instrumentation.Profiler): records cache hits and misses
+
+        Return:
+            (int): number of tiles rendered
+        """
+
+        current = {}
+        for gpx, color in entries:
+            if not gpx:
+                continue
+            try:
+                current[os.path.abspath(gpx)] = (list(traces.file_key(gpx)), color)
+            except OSError:
+                logger.warning(f'Trace file {gpx} not found')
+
+        dirty, self.stale = self.stale, set()
+        margin = (self.style['width'] + 1) // 2 + 1
+        for gpx in set(self.traces) - set(current):
+            dirty.update(tuple(tile) for tile in self.traces.pop(gpx)['tiles'])
+
+        for gpx, (key, color) in current.items():
+            cached = self.traces.get(gpx)
+            if cached and cached['key'] == key and cached['color'] == color:
+                if profiler:
+                    profiler.hit('tiles')
+                continue
+
+            if profiler:
+                profiler.miss('tiles')
+            if cached:
+                dirty.update(tuple(tile) for tile in cached['tiles'])
+
+            track = store.track(gpx)
+            tiles = set()
+            if track is not None:
+                x, y = heatmap.mercator(track['lat'], track['lon'])
+                for zoom in range(self.style['min_zoom'], self.style['max_zoom'] + 1):
+                    tiles |= pixel_tiles(trace_pixels(x, y, zoom), zoom, margin)
+            self.traces[gpx] = {'key': key, 'color': color, 'tiles': sorted(tiles)}
+            dirty |= tiles
+
+        if not dirty:
+            return 0
+
+        # traces drawn on every dirty tile
+        tile_traces = {tile: [] for tile in dirty}
+        for gpx, entry in self.traces.items():
+            for tile in entry['tiles']:
+                tile = tuple(tile)
+                if tile in tile_traces:
+                    tile_traces[tile].append((gpx, entry['color']))
+
+        tasks = [(zoom, x, y, tile_traces[(zoom, x, y)]) for zoom, x, y in sorted(dirty)]
+        self.render(tasks, store)
+        self.pending |= dirty
+        self.save_manifest()
+        return len(tasks)
+
+    def render(self, tasks, store):
+        """Render tiles, in worker processes when there are many of them"""
+
+        width, opacity = self.style['width'], self.style['opacity']
+        if len(tasks) <= TILES_PER_TASK or self.workers < 2:
+            render_tiles(tasks, self.folder, width, opacity, store=store)
+            return
+
+        chunks = [tasks[i:i + TILES_PER_TASK] for i in range(0, len(tasks), TILES_PER_TASK)]
+        # spawned workers: the pipeline stages run in threads, forking them is unsafe
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_worker, initargs=(store.folder,)) as executor:
+            futures = [executor.submit(render_tiles, chunk, self.folder, width, opacity) for chunk in chunks]
+            for future in futures:
+                future.result()
+
+    def relative_folder(self, html_path):
+        """Path of the tiles folder relative to the map html file, with forward slashes"""
+
+        relative = os.path.relpath(self.folder, os.path.dirname(os.path.abspath(html_path)))
+        return relative.replace(os.sep, '/')
+
+    def tile_url(self, html_path):
+        """Url template of the tiles relative to the map html file"""
+
+        return self.relative_folder(html_path) + '/{z}/{x}/{y}.png'
+
+
+def publish_tiles(ftp, renderer, remote_folder, force=False):
+    """Upload the rendered tiles and delete the removed ones on the ftp server
+
+    Args:
+        ftp (ftplib.FTP): ftp session in the directory of the map html file
+        renderer (TileRenderer): renderer of the tiles, its pending tiles are cleared
+        remote_folder (string): tiles folder relative to the ftp directory, see TileRenderer.relative_folder
+        force (bool): upload all tiles, not only the pending ones
+
+    Return:
+        (int): number of tiles uploaded
+    """
+
+    tiles = renderer.stored_tiles() if force else renderer.pending
+    created = set()
+    uploaded = 0
+
+    for zoom, x, y in sorted(tiles):
+        local_path = os.path.join(renderer.folder, str(zoom), str(x), f'{y}.png')
+        remote_path = f'{remote_folder}/{zoom}/{x}/{y}.png'
+
+        if not os.path.isfile(local_path):
+            try:
+                ftp.delete(remote_path)
+            except Exception:
+                pass
+            continue
+
+        # create the missing remote folders once per run
+        parts = remote_path.split('/')[:-1]
+        for depth in range(1, len(parts) + 1):
+            folder = '/'.join(parts[:depth])
+            if folder not in created:
+                try:
+                    ftp.mkd(folder)
+                except Exception:
+                    pass
+                created.add(folder)
+
+        with open(local_path, 'rb') as file:
+            ftp.storbinary(f'STOR {remote_path}', file)
+        uploaded += 1
+
+    renderer.pending = set()
+    renderer.save_manifest()
+    return uploaded
@@ -0,0 +1,212 @@
+import json
+import logging
+import numpy as np
+import traces
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6371008.8
+
+# moving average window (points) applied to elevations before summing the gain
+ELEVATION_SMOOTHING = 5
+# speed below which a trace point is considered stopped (m/s)
+MOVING_SPEED = 0.5
+# gaps longer than this between two points are not counted as moving time (s)
+MAX_POINT_GAP = 60
+# relative differences with the spreadsheet values flagged as mismatches
+DIST_TOLERANCE = 0.05
+DPLUS_TOLERANCE = 0.25
+
+
+def step_distances(lat, lon):
+    """Haversine distance in meters between consecutive points
+
+    Args:
+        lat (np.ndarray): latitudes in degrees
+        lon (np.ndarray): longitudes in degrees
+
+    Return:
+        (np.ndarray): len(lat) - 1 distances
+    """
+
+    # float64 math, the trace store keeps float32 coordinates
+    lat = np.radians(lat, dtype=np.float64)
+    lon = np.radians(lon, dtype=np.float64)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def cumulative_distance(lat, lon):
+    """Cumulative distance in meters at each point, starting at 0"""
+    return np.concatenate(([0.0], np.cumsum(step_distances(lat, lon))))
+
+
+def elevation_gain(ele, window=ELEVATION_SMOOTHING):
+    """Positive elevation gain in meters after a moving average smoothing, nan elevations ignored"""
+
+    ele = ele[~np.isnan(ele)].astype(np.float64)
+    if len(ele) < 2:
+        return 0.0
+
+    if window > 1 and len(ele) > window:
+        # pad with the edge values so that the smoothed profile keeps its start and end elevations
+        padded = np.pad(ele, (window // 2, window - 1 - window // 2), mode='edge')
+        ele = np.convolve(padded, np.ones(window) / window, mode='valid')
+
+    diffs = np.diff(ele)
+    return float(diffs[diffs > 0].sum())
+
+
+def moving_time(steps, time):
+    """Time in seconds spent moving faster than MOVING_SPEED, long recording gaps excluded"""
+
+    dt = np.diff(time)
+    valid = ~np.isnan(dt) & (dt > 0) & (dt <= MAX_POINT_GAP)
+    speed = np.divide(steps, dt, out=np.zeros_like(steps), where=valid)
+    return float(dt[valid & (speed >= MOVING_SPEED)].sum())
+
+
+def km_splits(cum_dist, time):
+    """Time in seconds of every full km, interpolated between trace points"""
+
+    valid = ~np.isnan(time)
+    if valid.sum() < 2 or cum_dist[-1] < 1000:
+        return []
+
+    marks = np.arange(0, cum_dist[-1] + 1, 1000.0)
+    # cumulative distance is non-decreasing, which np.interp needs
+    times = np.interp(marks, cum_dist[valid], time[valid])
+    return [round(float(t), 1) for t in np.diff(times)]
+
+
+def compute_metrics(track):
+    """Compute the metrics of a full resolution trace
+
+    Args:
+        track (dict): numpy arrays lat, lon, ele and time, see TraceStore.track
+
+    Return:
+        (dict): distance_km, dplus_m, moving_time_s, elapsed_time_s, points and splits (s per km)
+    """
+
+    lat, lon, ele, time = track['lat'], track['lon'], track['ele'], track['time']
+    if len(lat) < 2:
+        return {'distance_km': 0.0, 'dplus_m': 0.0, 'moving_time_s': 0.0, 'elapsed_time_s': 0.0,
+                'points': int(len(lat)), 'splits': []}
+
+    steps = step_distances(lat, lon)
+    cum_dist = np.concatenate(([0.0], np.cumsum(steps)))
+    timed = time[~np.isnan(time)]
+
+    return {
+        'distance_km': round(float(cum_dist[-1]) / 1000, 3),
+        'dplus_m': round(elevation_gain(ele), 1),
+        'moving_time_s': moving_time(steps, time),
+        'elapsed_time_s': float(timed[-1] - timed[0]) if len(timed) > 1 else 0.0,
+        'points': int(len(lat)),
+        'splits': km_splits(cum_dist, time),
+    }
+
+
+def find_mismatches(metrics, sheet_dist, sheet_dplus):
+    """Compare trace metrics with the values typed in the spreadsheet
+
+    Return:
+        (string): comma separated list of mismatching fields, empty if consistent
+    """
+
+    mismatches = []
+    if sheet_dist and abs(metrics['distance_km'] - sheet_dist) > DIST_TOLERANCE * sheet_dist:
+        mismatches.append('distance')
+    if sheet_dplus and abs(metrics['dplus_m'] - sheet_dplus) > DPLUS_TOLERANCE * sheet_dplus:
+        mismatches.append('dplus')
+    return ','.join(mismatches)
+
+
+def create_table(conn):
+    """Create the table storing trace metrics next to the spreadsheet values"""
+
+    conn.execute("""CREATE TABLE IF NOT EXISTS trace_metrics(
+                 date TEXT PRIMARY KEY,
+                 gpx TEXT,
+                 file_mtime INT,
+                 file_size INT,
+                 sheet_dist REAL,
+                 sheet_dplus REAL,
+                 gpx_dist REAL,
+                 gpx_dplus REAL,
+                 moving_time REAL,
+                 elapsed_time REAL,
+                 points INT,
+                 splits TEXT,
+                 mismatch TEXT
+                 )
+    """)
+
+
+def update_metrics(conn, entries, store, profiler=None):
+    """Compute the metrics of the traces that changed and store them in the database
+
+    Args:
+        conn (sqlite3.Connection): database connection
+        entries (iterable): tuples (date, gpx path, spreadsheet distance in km, spreadsheet D+ in m)
+        store (trace_store.TraceStore): packed traces, up to date with the gpx files
+        profiler (instrumentation.Profiler): records cache hits and misses
+
+    Return:
+        (list): tuples (date, gpx, mismatch) of the entries not matching the spreadsheet
+    """
+
+    create_table(conn)
+    cached = {row[0]: row[1:] for row in conn.execute("SELECT date, gpx, file_mtime, file_size FROM trace_metrics")}
+    dates = set()
+    mismatches = []
+
+    for date, gpx, sheet_dist, sheet_dplus in entries:
+        dates.add(date)
+        if not gpx:
+            conn.execute("DELETE FROM trace_metrics WHERE date=?", (date,))
+            continue
+
+        sheet_dist = float(sheet_dist) if sheet_dist not in ('', None) else None
+        sheet_dplus = float(sheet_dplus) if sheet_dplus not in ('', None) else None
+
+        try:
+            mtime, size = traces.file_key(gpx)
+        except OSError:
+            logger.warning(f'Trace file {gpx} not found')
+            continue
+
+        # same file as last time -> only refresh the spreadsheet values and the mismatch flag
+        if cached.get(date) == (gpx, mtime, size):
+            if profiler:
+                profiler.hit('trace_metrics')
+            row = conn.execute("""SELECT gpx_dist, gpx_dplus FROM trace_metrics WHERE date=?""", (date,)).fetchone()
+            metrics = {'distance_km': row[0], 'dplus_m': row[1]}
+            mismatch = find_mismatches(metrics, sheet_dist, sheet_dplus)
+            conn.execute("UPDATE trace_metrics SET sheet_dist=?, sheet_dplus=?, mismatch=? WHERE date=?",
+                         (sheet_dist, sheet_dplus, mismatch, date))
+        else:
+            if profiler:
+                profiler.miss('trace_metrics')
+            track = store.track(gpx)
+            if track is None:
+                continue
+            metrics = compute_metrics(track)
+            mismatch = find_mismatches(metrics, sheet_dist, sheet_dplus)
+            conn.execute("""INSERT OR REPLACE INTO trace_metrics
+                         (date, gpx, file_mtime, file_size, sheet_dist, sheet_dplus, gpx_dist, gpx_dplus,
+                         moving_time, elapsed_time, points, splits, mismatch) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
+                         """, (date, gpx, mtime, size, sheet_dist, sheet_dplus, metrics['distance_km'],
+                               metrics['dplus_m'], metrics['moving_time_s'], metrics['elapsed_time_s'],
+                               metrics['points'], json.dumps(metrics['splits']), mismatch))
+
+        if mismatch:
+            mismatches.append((date, gpx, mismatch))
+
+    # remove the metrics of entries deleted from the spreadsheet
+    for date in set(cached) - dates:
+        conn.execute("DELETE FROM trace_metrics WHERE date=?", (date,))
+
+    conn.commit()
+    return mismatches
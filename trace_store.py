@@ -0,0 +1,256 @@
+import os
+import json
+import logging
+import threading
+import numpy as np
+import traces
+import importer
+from numpy.lib import recfunctions
+
+logger = logging.getLogger(__name__)
+
+# one packed record per trace point: float32 coordinates and elevation, int32 seconds since the trace start
+POINT_DTYPE = np.dtype([('lat', '<f4'), ('lon', '<f4'), ('ele', '<f4'), ('time', '<i4')])
+MISSING_TIME = np.iinfo(np.int32).min
+
+# share of the data file taken by replaced or removed traces above which it is rewritten
+COMPACTION_RATIO = 0.5
+
+
+class TraceStore:
+    """Packed store of the full resolution gpx traces, memory-mapped with numpy
+
+    All points live in one binary file (16 bytes per point). A json index gives the offset and
+    number of points of every trace with the gpx file key it was read from, its start time and
+    bounding box. Modified and new traces are appended, the file is compacted when too much of
+    it is taken by outdated traces. Reading a trace returns views on the memory map, no copy.
+    """
+
+    def __init__(self, folder):
+        """Open the store, creating its folder if needed
+
+        Args:
+            folder (string): folder holding the data file (traces.bin) and its index (index.json)
+        """
+
+        self.folder = folder
+        self.data_path = os.path.join(folder, 'traces.bin')
+        self.index_path = os.path.join(folder, 'index.json')
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """Read the index and map the data file"""
+
+        index = {'points': 0, 'traces': {}}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                index = json.load(f)
+
+        # a data file shorter than the index (interrupted write) invalidates the store
+        size = os.path.getsize(self.data_path) if os.path.isfile(self.data_path) else 0
+        if size < index['points'] * POINT_DTYPE.itemsize:
+            logger.warning(f'Trace store {self.folder} is incomplete, rebuilding it')
+            index = {'points': 0, 'traces': {}}
+
+        if index['points']:
+            data = np.memmap(self.data_path, dtype=POINT_DTYPE, mode='r', shape=(index['points'],))
+        else:
+            data = np.empty(0, dtype=POINT_DTYPE)
+
+        # index and data are swapped together, threads reading the store never see a mix of both
+        self.snapshot = (index, data)
+
+    @property
+    def index(self):
+        return self.snapshot[0]
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.index['traces']
+
+    def __len__(self):
+        return len(self.index['traces'])
+
+    def is_current(self, path):
+        """Whether the stored trace was read from the current version of the gpx file"""
+
+        entry = self.index['traces'].get(os.path.abspath(path))
+        try:
+            return entry is not None and tuple(entry['key']) == traces.file_key(path)
+        except OSError:
+            return False
+
+    def update(self, paths, prune=False, profiler=None, workers=None):
+        """Read the new or modified trace files (gpx, tcx or fit) into the store
+
+        Many files are read in worker processes, see importer.read_tracks.
+
+        Args:
+            paths (list): trace file paths
+            prune (bool): remove the stored traces not in paths
+            profiler (instrumentation.Profiler): records cache hits and misses
+            workers (int): worker processes reading the files, the number of cpus if None
+
+        Return:
+            (int): number of gpx files read
+        """
+
+        with self.lock:
+            paths = {os.path.abspath(path) for path in paths if path}
+            stale = sorted(path for path in paths if not self.is_current(path))
+            removed = set(self.index['traces']) - paths if prune else set()
+
+            if profiler:
+                profiler.hit('trace_store', len(paths) - len(stale))
+                profiler.miss('trace_store', len(stale))
+            if not stale and not removed:
+                return 0
+
+            tracks = importer.read_tracks(stale, workers=workers)
+
+            # work on a copy of the index, the current snapshot stays valid until reloaded
+            index, data = self.snapshot
+            index = {'points': index['points'], 'traces': {path: dict(entry) for path, entry in index['traces'].items()
+                                                           if path not in removed and path not in stale}}
+
+            live_points = sum(entry['count'] for entry in index['traces'].values())
+            if index['points'] and live_points < COMPACTION_RATIO * index['points']:
+                self.compact(index, data)
+
+            self.append(index, tracks)
+            self.save_index(index)
+            self.load()
+            return len(tracks)
+
+    def append(self, index, tracks):
+        """Append packed traces at the end of the data file
+
+        Args:
+            index (dict): index updated with the appended traces
+            tracks (dict): gpx path -> trace arrays
+        """
+
+        offset = index['points']
+        with open(self.data_path, 'ab') as f:
+            # drop the end of an interrupted write
+            f.truncate(offset * POINT_DTYPE.itemsize)
+            for path, track in tracks.items():
+                packed, start_time = pack_track(track)
+                packed.tofile(f)
+                index['traces'][path] = {
+                    'offset': offset,
+                    'count': len(packed),
+                    'key': list(traces.file_key(path)),
+                    'start_time': start_time,
+                    'bbox': track_bbox(track),
+                }
+                offset += len(packed)
+
+        index['points'] = offset
+
+    def compact(self, index, data):
+        """Rewrite the data file with the indexed traces only
+
+        Args:
+            index (dict): index of the traces to keep, updated with their new offsets
+            data (np.ndarray): current packed points
+        """
+
+        tmp_path = self.data_path + '.tmp'
+        offset = 0
+        with open(tmp_path, 'wb') as f:
+            for entry in index['traces'].values():
+                data[entry['offset']:entry['offset'] + entry['count']].tofile(f)
+                entry['offset'] = offset
+                offset += entry['count']
+
+        # readers keep the mapping of the replaced file until they reload
+        os.replace(tmp_path, self.data_path)
+        logger.debug(f"Trace store compacted from {index['points']} to {offset} points")
+        index['points'] = offset
+
+    def save_index(self, index):
+        """Write the index atomically"""
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def points(self, path):
+        """Packed points of a trace
+
+        Return:
+            (np.ndarray): structured view with fields lat, lon, ele and time, None if not stored
+        """
+
+        index, data = self.snapshot
+        entry = index['traces'].get(os.path.abspath(path))
+        if entry is None:
+            return None
+        return data[entry['offset']:entry['offset'] + entry['count']]
+
+    def coordinates(self, path):
+        """(lat, lon) pairs of a trace as a (n, 2) float32 view, None if not stored"""
+
+        points = self.points(path)
+        if points is None:
+            return None
+        return recfunctions.structured_to_unstructured(points[['lat', 'lon']])
+
+    def track(self, path):
+        """Trace arrays in the format of traces.read_track
+
+        Return:
+            (dict): float32 views lat, lon and ele, float64 time (s since epoch, nan if missing), None if not stored
+        """
+
+        index, data = self.snapshot
+        entry = index['traces'].get(os.path.abspath(path))
+        if entry is None:
+            return None
+
+        points = data[entry['offset']:entry['offset'] + entry['count']]
+        start_time = entry['start_time']
+        offsets = points['time']
+        time = np.full(len(points), np.nan)
+        if start_time is not None:
+            timed = offsets != MISSING_TIME
+            time[timed] = start_time + offsets[timed]
+        return {'lat': points['lat'], 'lon': points['lon'], 'ele': points['ele'], 'time': time}
+
+    def bbox(self, path):
+        """Bounding box (min_lat, min_lon, max_lat, max_lon) of a trace, None if not stored or empty"""
+
+        entry = self.index['traces'].get(os.path.abspath(path))
+        return tuple(entry['bbox']) if entry and entry['bbox'] else None
+
+
+def pack_track(track):
+    """Pack trace arrays into point records
+
+    Return:
+        (tuple): packed np.ndarray, start time in seconds since epoch (None without timestamps)
+    """
+
+    packed = np.empty(len(track['lat']), dtype=POINT_DTYPE)
+    packed['lat'] = track['lat']
+    packed['lon'] = track['lon']
+    packed['ele'] = track['ele']
+
+    time = track['time']
+    timed = ~np.isnan(time)
+    start_time = float(time[timed][0]) if timed.any() else None
+    packed['time'] = MISSING_TIME
+    if start_time is not None:
+        packed['time'][timed] = np.round(time[timed] - start_time)
+    return packed, start_time
+
+
+def track_bbox(track):
+    """Bounding box of a trace as a list, None if empty"""
+
+    if not len(track['lat']):
+        return None
+    return [float(track['lat'].min()), float(track['lon'].min()), float(track['lat'].max()), float(track['lon'].max())]
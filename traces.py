@@ -0,0 +1,153 @@
+import os
+import re
+import logging
+import numpy as np
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# trace files read by read_track, tcx and fit files are read by importer.py
+TRACK_EXTENSIONS = ('.gpx', '.tcx', '.fit')
+
+# track point as written by gps devices and most tools (lat before lon, ele before time, no namespace prefix)
+TRKPT_PATTERN = re.compile(rb'<trkpt\s+lat="([^"]*)"\s+lon="([^"]*)"\s*>\s*(?:<ele>([^<]*)</ele>\s*)?(?:<time>([^<]*)</time>)?')
+
+
+def parse_time(text):
+    """Parse an iso 8601 timestamp into seconds since epoch, nan if missing or invalid"""
+
+    if not text:
+        return np.nan
+    try:
+        return datetime.fromisoformat(text.strip().replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return np.nan
+
+
+def parse_times(texts):
+    """Parse iso 8601 timestamps into seconds since epoch
+
+    UTC timestamps (the usual 'Z' suffix) are converted in a single vectorized numpy call,
+    timestamps with an offset or invalid ones fall back to parse_time one by one.
+
+    Args:
+        texts (list): timestamps as strings, empty strings for missing ones
+
+    Return:
+        (np.ndarray): float seconds, nan where missing or invalid
+    """
+
+    texts = np.asarray(texts, dtype=np.str_)
+    if not len(texts):
+        return np.array([], dtype=np.float64)
+
+    missing = texts == ''
+    if np.all(np.char.endswith(texts, 'Z') | missing):
+        stamps = np.char.rstrip(texts, 'Z')
+        stamps[missing] = 'NaT'
+        try:
+            stamps = stamps.astype('datetime64[ms]')
+            times = stamps.astype(np.float64) / 1000
+            times[np.isnat(stamps)] = np.nan
+            return times
+        except ValueError:
+            pass
+
+    return np.array([parse_time(t) for t in texts], dtype=np.float64)
+
+
+def read_gpx(path):
+    """Read all track points of a gpx file at full resolution
+
+    The usual gpx layout is matched by a single regular expression over the raw file and converted
+    with numpy, other files are streamed with iterparse. Both are several times faster than building
+    the gpxpy object tree and keep memory low on long traces.
+
+    Args:
+        path (string): path to gpx file
+
+    Return:
+        (dict): numpy arrays lat, lon, ele (m, nan if missing) and time (s since epoch, nan if missing)
+    """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    matches = TRKPT_PATTERN.findall(data)
+    # every track point must match, otherwise the file has another layout
+    if not matches or len(matches) != data.count(b'<trkpt'):
+        return read_gpx_tree(path)
+
+    # all elevations and timestamps must be matched too (the metadata may have one more timestamp)
+    lat, lon, ele, time = zip(*matches)
+    ele_count = len(ele) - ele.count(b'')
+    time_count = len(time) - time.count(b'')
+    if ele_count != data.count(b'<ele>') or data.count(b'<time>') - time_count not in (0, 1):
+        return read_gpx_tree(path)
+
+    return {
+        'lat': np.array(list(map(float, lat)), dtype=np.float64),
+        'lon': np.array(list(map(float, lon)), dtype=np.float64),
+        'ele': np.array([float(e) if e.strip() else np.nan for e in ele], dtype=np.float64),
+        'time': parse_times(np.char.strip(np.array(time).astype(np.str_))),
+    }
+
+
+def read_gpx_tree(path):
+    """Read all track points of a gpx file with any layout by streaming the xml, see read_gpx"""
+
+    lat, lon, ele, time = [], [], [], []
+
+    for _, element in ET.iterparse(path, events=('end',)):
+        if not element.tag.endswith('trkpt'):
+            continue
+
+        point_ele = point_time = None
+        for child in element:
+            if child.tag.endswith('ele'):
+                point_ele = child.text
+            elif child.tag.endswith('time'):
+                point_time = child.text
+
+        lat.append(element.get('lat'))
+        lon.append(element.get('lon'))
+        ele.append(point_ele.strip() if point_ele and point_ele.strip() else 'nan')
+        time.append(point_time.strip() if point_time else '')
+        element.clear()
+
+    return {
+        'lat': np.array(lat, dtype=np.float64),
+        'lon': np.array(lon, dtype=np.float64),
+        'ele': np.array(ele, dtype=np.float64),
+        'time': parse_times(time),
+    }
+
+
+def read_track(path):
+    """Read a trace file at full resolution: gpx (see read_gpx), tcx or fit (see importer.py)
+
+    Return:
+        (dict): numpy arrays lat, lon, ele and time, None if the file is not a valid trace
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+    if not os.path.isfile(path) or extension not in TRACK_EXTENSIONS:
+        logger.warning(f'Invalid trace file {path}')
+        return None
+
+    try:
+        if extension == '.gpx':
+            return read_gpx(path)
+
+        import importer
+        return importer.read_tcx(path) if extension == '.tcx' else importer.read_fit(path)
+    except (ET.ParseError, ValueError) as e:
+        logger.warning(f'Could not parse trace file {path}: {e}')
+        return None
+
+
+def file_key(path):
+    """Cache key of a file, changes whenever the file is modified"""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Watch mode: monitors the spreadsheets, gpx/jpg folders, html templates and settings file
+and rebuilds the affected outputs in a warm process keeping its caches in memory.
+
+Usage:
+    python watch.py
+    python watch.py --site camino --upload
+"""
+
+import os
+import time
+import logging
+import argparse
+from sites import SITES, load_site_class
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher:
+    """Polls watched files and rebuilds the outputs depending on them"""
+
+    def __init__(self, site_class, settings, interval=0.5, debounce=0.3, upload=False):
+        """Initialise the watcher
+
+        Args:
+            site_class (class): RunMap or CaminoMap
+            settings (string): path to the json settings file
+            interval (float): polling interval in seconds
+            debounce (float): time without further changes before rebuilding, in seconds
+            upload (bool): upload rebuilt outputs to the ftp server
+        """
+
+        self.site_class = site_class
+        self.settings = os.path.abspath(settings)
+        self.interval = interval
+        self.debounce = debounce
+        self.upload = upload
+        self.site = site_class(self.settings)
+
+    def all_steps(self):
+        """All build steps of the site"""
+        return {step for steps in self.site.watch_targets().values() for step in steps}
+
+    def snapshot(self):
+        """Modification time and size of every watched file
+
+        Return:
+            (dict): watched target path -> {file path: (mtime, size)}
+        """
+
+        snapshot = {}
+        for target in list(self.site.watch_targets()) + [self.settings]:
+            files = {}
+            if os.path.isdir(target):
+                for entry in os.scandir(target):
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            elif os.path.isfile(target):
+                stat = os.stat(target)
+                files[target] = (stat.st_mtime_ns, stat.st_size)
+            snapshot[target] = files
+        return snapshot
+
+    def reload_settings(self):
+        """Recreate the site from the settings file, the packed traces are reopened from the trace store"""
+
+        logger.info('Settings changed, reloading them')
+        self.site.close_database()
+        self.site = self.site_class(self.settings)
+
+    def build(self, steps):
+        """Rebuild the outputs depending on the build steps, never stopping the watch loop on errors"""
+
+        start = time.perf_counter()
+        try:
+            self.site.rebuild(steps, upload=self.upload)
+        except Exception as e:
+            logger.exception(f'Rebuild failed: {e}')
+            return
+        logger.info(f"Rebuilt {', '.join(sorted(steps))} in {time.perf_counter() - start:.3f}s")
+
+    def wait_for_changes(self, snapshot):
+        """Poll until the watched files change and stay unchanged for the debounce time
+
+        Return:
+            (tuple): new snapshot, set of changed targets
+        """
+
+        while True:
+            time.sleep(self.interval)
+            current = self.snapshot()
+            if current == snapshot:
+                continue
+
+            # debounce: wait for editors and sync tools to finish writing
+            while True:
+                time.sleep(self.debounce)
+                settled = self.snapshot()
+                if settled == current:
+                    break
+                current = settled
+
+            changed = {target for target in current if current[target] != snapshot.get(target)}
+            return current, changed
+
+    def run(self, download=False):
+        """Initial full build followed by incremental rebuilds until interrupted
+
+        Args:
+            download (bool): download the spreadsheets before the initial build
+        """
+
+        if download:
+            self.site.download_spreadsheet_as_csv()
+            if hasattr(self.site, 'download_stamps_as_csv'):
+                self.site.download_stamps_as_csv()
+
+        self.build(self.all_steps() | {'templates'})
+        snapshot = self.snapshot()
+        logger.info(f'Watching {len(snapshot)} files and folders, press Ctrl+C to stop')
+
+        try:
+            while True:
+                snapshot, changed = self.wait_for_changes(snapshot)
+
+                if self.settings in changed:
+                    self.reload_settings()
+                    self.build(self.all_steps() | {'templates'})
+                    snapshot = self.snapshot()
+                    continue
+
+                targets = self.site.watch_targets()
+                steps = set()
+                for target in changed:
+                    steps.update(targets.get(target, []))
+                    logger.info(f'Change detected: {target}')
+
+                if steps:
+                    self.build(steps)
+        except KeyboardInterrupt:
+            logger.info('Watch mode stopped')
+        finally:
+            self.site.close_database()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the maps incrementally when their sources change')
+    parser.add_argument('--site', choices=list(SITES), default='run', help='map to build')
+    parser.add_argument('--settings', help='json settings file (default depends on the site)')
+    parser.add_argument('--interval', type=float, default=0.5, help='polling interval in seconds')
+    parser.add_argument('--debounce', type=float, default=0.3, help='quiet time before rebuilding in seconds')
+    parser.add_argument('--download', action='store_true', help='download the spreadsheets before the first build')
+    parser.add_argument('--upload', action='store_true', help='upload the outputs after each rebuild')
+    parser.add_argument('--verbose', action='store_true', help='show debug logs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format='%(message)s')
+
+    site_class = load_site_class(args.site)
+    watcher = Watcher(site_class, args.settings or SITES[args.site][2], interval=args.interval,
+                      debounce=args.debounce, upload=args.upload)
+    watcher.run(download=args.download)
+
+
+if __name__ == '__main__':
+    main()
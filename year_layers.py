@@ -0,0 +1,118 @@
+import os
+import glob
+import logging
+import folium
+import folium_elements
+import map_writer
+
+logger = logging.getLogger(__name__)
+
+
+def event_year(date):
+    """Year of a 'dd.mm.yyyy' spreadsheet date"""
+
+    return int(date.split('.')[-1])
+
+
+def chunk_path(html_path, year):
+    """Javascript file of the features of a year, next to the map html file"""
+
+    return f'{os.path.splitext(html_path)[0]}_{year}.js'
+
+
+def chunk_files(html_path):
+    """Year chunks of a map found next to its html file"""
+
+    return sorted(glob.glob(f'{glob.escape(os.path.splitext(html_path)[0])}_[0-9][0-9][0-9][0-9].js'))
+
+
+class YearLayers:
+    """Year layers of the feature groups of a map, the older years being written to javascript chunks
+
+    Every feature group (or the map itself) gets one layer per year holding the markers and
+    traces of the events of that year. The layers of the most recent years are written in the
+    html document and shown on opening. The features of the older years go to one javascript file
+    per year next to the html file, only loaded by the year slider when the year is selected.
+    """
+
+    def __init__(self, folium_map, html_path, years, recent=2):
+        """Initialise the year layers of a map
+
+        Args:
+            folium_map (folium.Map): map being built
+            html_path (string): html file of the map, the chunks are written next to it
+            years (iterable): years of the events
+            recent (int): number of most recent years in the document, all years if 0
+        """
+
+        self.map = folium_map
+        self.html_path = html_path
+        self.years = sorted(set(years))
+        self.shown = set(self.years[-recent:] if recent > 0 else self.years)
+        # (parent name, year) -> layer, layer name -> year
+        self.layers = {}
+        self.layer_years = {}
+        # year -> map_writer.ChunkWriter of the years not in the document
+        self.writers = {}
+
+    def layer(self, parent, year):
+        """Layer of a year in a feature group (or in the map), created on first use
+
+        Args:
+            parent (folium.FeatureGroup or folium.Map): layer of all years
+            year (int): year of the features
+        """
+
+        key = (parent.get_name(), year)
+        if key not in self.layers:
+            layer = folium.FeatureGroup(name=str(year), control=False, show=year in self.shown).add_to(parent)
+            self.layers[key] = layer
+            self.layer_years[layer.get_name()] = year
+            if year not in self.shown:
+                if year not in self.writers:
+                    self.writers[year] = map_writer.ChunkWriter(self.map, chunk_path(self.html_path, year))
+                self.writers[year].add_root(layer)
+        return self.layers[key]
+
+    def writer(self, layer, default=None):
+        """Writer of the features of a layer: the chunk of its year if not in the document, else default
+
+        Args:
+            layer (folium.FeatureGroup or folium.Map): year layer, see layer(), or any other layer
+            default (map_writer.MapWriter): writer of the document, None if the map is saved by folium
+        """
+
+        year = self.layer_years.get(layer.get_name())
+        return self.writers.get(year, default)
+
+    def close(self):
+        """Write the chunks of the older years, remove the chunks of the years without events and add the year slider
+
+        Must be called before the map is saved.
+
+        Return:
+            (list): chunk files written
+        """
+
+        if not self.years:
+            return []
+
+        chunks = {}
+        for year, writer in sorted(self.writers.items()):
+            size = writer.close()
+            chunks[year] = writer.path
+            logger.debug(f'Year {year} written to {writer.path} ({size} characters)')
+
+        for path in chunk_files(self.html_path):
+            if path not in chunks.values():
+                os.remove(path)
+
+        folium_elements.YearSlider(
+            self.years,
+            [(year, layer) for (_, year), layer in self.layers.items()],
+            {year: os.path.basename(path) for year, path in chunks.items()},
+            [min(self.shown), max(self.shown)]
+        ).add_to(self.map)
+
+        logger.info(f'Year layers: {len(self.shown)} years in the map, {len(chunks)} loaded on demand')
+        return list(chunks.values())